@@ -0,0 +1,180 @@
+'''
+Load generator for a running server: opens a number of connections, fills a database per connection,
+then sends pipelined batches of gets and puts (with or without a ttl) in the given mix for a while.
+Reports the throughput and the latency percentiles as json, i.e.
+python3 -m benchmarks.load --connections 50 --pipeline 16 --mix get=80,put=15,put_ttl=5
+'''
+import asyncio
+import argparse
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+from benchmarks import report
+from config import HOST, PORT, ROOT_PASSWORD, ROOT_USER
+from model import exception
+from model.exception import CustomException
+from model.framing import ERROR_STATUS, REPLY_HEADER, encode_frame
+from model.metrics import PERCENTILES, Histogram
+
+OPERATIONS = ('get', 'put', 'put_ttl')
+# Replies of the line protocol that are errors, the binary protocol has a status byte for that
+LINE_ERRORS = frozenset(str(value) for value in vars(exception).values() if isinstance(value, CustomException))
+
+
+class Connection():
+  'A client connection speaking either protocol, which sends batches of commands and reads their replies.'
+
+  def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, binary: bool) -> None:
+    self._reader = reader
+    self._writer = writer
+    self._binary = binary
+
+  async def send(self, commands: List[List[str]]) -> None:
+    if self._binary:
+      self._writer.write(b''.join(encode_frame(command) for command in commands))
+    else:
+      self._writer.write(''.join(' '.join(command) + '\n' for command in commands).encode())
+    await self._writer.drain()
+
+  async def reply(self) -> Tuple[bool, str]:
+    'Reads the next reply, returns whether it was successful and its payload.'
+    if self._binary:
+      status, length = REPLY_HEADER.unpack(await self._reader.readexactly(REPLY_HEADER.size))
+      payload = (await self._reader.readexactly(length)).decode()
+      return (status != ERROR_STATUS, payload)
+    line = (await self._reader.readline()).decode().rstrip('\n')
+    return (line not in LINE_ERRORS, line)
+
+  async def call(self, *command: str) -> str:
+    await self.send([list(command)])
+    ok, payload = await self.reply()
+    if not ok:
+      raise RuntimeError(f'{command[0]} failed: {payload}')
+    return payload
+
+  def close(self) -> None:
+    self._writer.close()
+
+
+class Load():
+  'The settings of a run and the results every connection adds to.'
+
+  def __init__(self, args: argparse.Namespace) -> None:
+    self.args = args
+    self.mix = _parse_mix(args.mix)
+    self.value = 'v' * args.value_size
+    self.latency = Histogram()
+    self.counts: Dict[str, int] = {operation: 0 for operation in OPERATIONS}
+    self.errors = 0
+
+  async def connect(self, index: int) -> Connection:
+    reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+    connection = Connection(reader, writer, binary=False)
+    await connection.call('login', self.args.user, self.args.password)
+    if self.args.protocol == 'binary':
+      await connection.call('protocol', 'binary')
+      connection = Connection(reader, writer, binary=True)
+    database_name = f'{self.args.database_prefix}{index}'
+    await connection.send([['create_db', database_name]])
+    # The database may be left from an earlier run
+    await connection.reply()
+    await connection.call('select_db', database_name)
+    return connection
+
+  async def fill(self, connection: Connection) -> None:
+    'Puts every key once, so gets hit.'
+    keys = [f'key:{index}' for index in range(self.args.keys)]
+    for start in range(0, len(keys), 1000):
+      batch = [['put', key, self.value] for key in keys[start:start + 1000]]
+      await connection.send(batch)
+      for _ in batch:
+        await connection.reply()
+
+  async def drive(self, connection: Connection, seed: int, deadline: float) -> None:
+    'Sends pipelined batches until the deadline, the latency of a command lasts from sending its batch to its reply.'
+    generator = random.Random(seed)
+    operations = list(self.mix)
+    weights = [self.mix[operation] for operation in operations]
+    while time.perf_counter() < deadline:
+      chosen = generator.choices(operations, weights=weights, k=self.args.pipeline)
+      batch = [self._command(operation, f'key:{generator.randrange(self.args.keys)}') for operation in chosen]
+      sent_at = time.perf_counter_ns()
+      await connection.send(batch)
+      for operation in chosen:
+        ok, _ = await connection.reply()
+        self.latency.record((time.perf_counter_ns() - sent_at) // 1000)
+        self.counts[operation] += 1
+        if not ok:
+          self.errors += 1
+
+  def _command(self, operation: str, key: str) -> List[str]:
+    if operation == 'get':
+      return ['get', key]
+    if operation == 'put':
+      return ['put', key, self.value]
+    return ['put', key, self.value, str(self.args.ttl)]
+
+
+def _parse_mix(mix: str) -> Dict[str, int]:
+  weights: Dict[str, int] = dict()
+  for part in mix.split(','):
+    operation, _, weight = part.partition('=')
+    if operation not in OPERATIONS or not weight.isdigit():
+      raise argparse.ArgumentTypeError(f'invalid mix {mix}: should be like get=80,put=15,put_ttl=5')
+    weights[operation] = int(weight)
+  if sum(weights.values()) == 0:
+    raise argparse.ArgumentTypeError(f'invalid mix {mix}: every weight is 0')
+  return weights
+
+
+async def run(load: Load) -> Dict[str, object]:
+  args = load.args
+  connections = await asyncio.gather(*[load.connect(index) for index in range(args.connections)])
+  await asyncio.gather(*[load.fill(connection) for connection in connections])
+  if args.warmup > 0:
+    warmup = Load(args)
+    await asyncio.gather(*[warmup.drive(connection, seed=args.seed + index, deadline=time.perf_counter() + args.warmup)
+                           for index, connection in enumerate(connections)])
+  started_at = time.perf_counter()
+  deadline = started_at + args.duration
+  await asyncio.gather(*[load.drive(connection, seed=args.seed + index, deadline=deadline)
+                         for index, connection in enumerate(connections)])
+  elapsed = time.perf_counter() - started_at
+  for connection in connections:
+    connection.close()
+  latency = {f'p{percent:g}_us'.replace('.', ''): load.latency.percentile(percent) for percent in PERCENTILES}
+  return {'operations': load.latency.count, 'errors': load.errors, 'counts': load.counts,
+          'elapsed_s': round(elapsed, 3), 'throughput_ops_s': round(load.latency.count / elapsed),
+          'latency': {'mean_us': load.latency.total // max(load.latency.count, 1), **latency, 'max_us': load.latency.max}}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+  parser = argparse.ArgumentParser(description='Drives a running server and prints the throughput and latencies as json.')
+  parser.add_argument('--host', default='127.0.0.1' if HOST == '0.0.0.0' else HOST)
+  parser.add_argument('--port', type=int, default=PORT)
+  parser.add_argument('--user', default=ROOT_USER)
+  parser.add_argument('--password', default=ROOT_PASSWORD)
+  parser.add_argument('--protocol', choices=['line', 'binary'], default='line')
+  parser.add_argument('--connections', type=int, default=10)
+  parser.add_argument('--pipeline', type=int, default=1, help='commands sent together before reading their replies')
+  parser.add_argument('--mix', default='get=80,put=20', help='weights of get, put and put_ttl (default: get=80,put=20)')
+  parser.add_argument('--ttl', type=int, default=60, help='ttl of put_ttl in seconds (default: 60)')
+  parser.add_argument('--keys', type=int, default=10_000, help='keys per connection, put before the run')
+  parser.add_argument('--value-size', type=int, default=32)
+  parser.add_argument('--duration', type=float, default=10.0, help='seconds measured (default: 10)')
+  parser.add_argument('--warmup', type=float, default=1.0, help='seconds run before measuring (default: 1)')
+  parser.add_argument('--seed', type=int, default=0, help='the keys and operations depend on it only')
+  parser.add_argument('--database-prefix', default='bench', help='connection n uses the database <prefix><n>')
+  parser.add_argument('--output', help='writes the json into this file instead of printing it')
+  args = parser.parse_args(argv)
+  try:
+    _parse_mix(args.mix)
+  except argparse.ArgumentTypeError as err:
+    parser.error(str(err))
+  settings = {name: value for name, value in vars(args).items() if name not in ('password', 'output')}
+  results = asyncio.run(run(Load(args)))
+  report.write({'benchmark': 'load', **report.environment(), 'settings': settings, 'results': results}, args.output)
+
+
+if __name__ == '__main__':
+  main()
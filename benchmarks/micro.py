@@ -0,0 +1,218 @@
+'''
+Microbenchmarks of the hot paths of a command: parsing, dispatch, the database operations, the
+write-ahead log record and the metadata file. Every case is run a few times and reported
+in nanoseconds per operation as json, i.e. python3 -m benchmarks.micro --output before.json
+'''
+import os
+import argparse
+import tempfile
+import statistics
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from benchmarks import report
+from model.context import Context
+from model.custom_time import custom_time
+from model.database import Database, ExpireAtEpoch, Key, Value
+from model.framing import encode_frame, read_frame
+from model.persistent_dictionary import PersistentDictionary
+from model.route import Route
+from model.store import DatabaseName, Store, Username
+from model.validator import parse_line
+
+# Keys of the databases the reads and overwrites go to
+KEYS = 10_000
+VALUE = Value('v' * 32)
+
+# Takes the number of operations to run and returns the seconds they took, without the setup
+Case = Callable[[int], float]
+
+
+def _keys(count: int) -> List[Key]:
+  return [Key(f'key:{index}') for index in range(count)]
+
+
+def _filled_database(keys: List[Key]) -> Database:
+  database = Database()
+  for key in keys:
+    database.put(key=key, value=VALUE)
+  return database
+
+
+def database_get(operations: int) -> float:
+  keys = _keys(KEYS)
+  database = _filled_database(keys)
+  started_at = time.perf_counter()
+  for index in range(operations):
+    database.get(key=keys[index % KEYS])
+  return time.perf_counter() - started_at
+
+
+def database_put_new(operations: int) -> float:
+  keys = _keys(operations)
+  database = Database()
+  started_at = time.perf_counter()
+  for key in keys:
+    database.put(key=key, value=VALUE)
+  return time.perf_counter() - started_at
+
+
+def database_put_overwrite(operations: int) -> float:
+  keys = _keys(KEYS)
+  database = _filled_database(keys)
+  started_at = time.perf_counter()
+  for index in range(operations):
+    database.put(key=keys[index % KEYS], value=VALUE)
+  return time.perf_counter() - started_at
+
+
+def database_put_ttl(operations: int) -> float:
+  keys = _keys(KEYS)
+  database = _filled_database(keys)
+  now = custom_time.time
+  started_at = time.perf_counter()
+  for index in range(operations):
+    # Spread over an hour, so the expiry wheel gets a new second now and then
+    database.put(key=keys[index % KEYS], value=VALUE, expire_at=ExpireAtEpoch(now + 60 + index % 3600))
+  return time.perf_counter() - started_at
+
+
+def delete_expired_keys(operations: int) -> float:
+  'Deletes as many expired keys, spread over 100 seconds, in a single sweep.'
+  database = Database()
+  now = custom_time.time
+  for index, key in enumerate(_keys(operations)):
+    database.put(key=key, value=VALUE, expire_at=ExpireAtEpoch(now + 1 + index % 100))
+  custom_time.time = now + 1000
+  try:
+    started_at = time.perf_counter()
+    database.delete_expired_keys()
+    return time.perf_counter() - started_at
+  finally:
+    custom_time.time = None
+
+
+def parse_line_put(operations: int) -> float:
+  line = f'put key:1 {VALUE} 60'.encode()
+  started_at = time.perf_counter()
+  for _ in range(operations):
+    parse_line(line)
+  return time.perf_counter() - started_at
+
+
+def read_frame_put(operations: int) -> float:
+  buffer = bytearray(encode_frame(['put', 'key:1', VALUE, '60']))
+  started_at = time.perf_counter()
+  for _ in range(operations):
+    read_frame(buffer, 0)
+  return time.perf_counter() - started_at
+
+
+def execute_get(operations: int) -> float:
+  'Dispatches gets of a logged in connection with a selected database, as the connection hands them over.'
+  # Imported here, the router pulls in every handler
+  from model.router import Router
+  store = Store()
+  router = Router(store=store)
+  ctx = Context(store=store, username=Username('root'), database_name=DatabaseName('db'),
+                database=_filled_database(_keys(KEYS)))
+  params = [('key:' + str(index),) for index in range(KEYS)]
+  try:
+    started_at = time.perf_counter()
+    for index in range(operations):
+      router.execute(ctx, b'get', params[index % KEYS])
+    return time.perf_counter() - started_at
+  finally:
+    router.delete_sequential_save_file()
+
+
+def save_successful_command(operations: int) -> float:
+  'Buffers put records in the write-ahead log, its writer thread commits them meanwhile.'
+  # Imported here, the router pulls in every handler
+  from model.router import Router
+  router = Router(store=Store())
+  params = ('key:1', VALUE, '60')
+  try:
+    started_at = time.perf_counter()
+    for _ in range(operations):
+      router.save_successful_command(database_name=DatabaseName('db'), route=Route.put, params=params,
+                                     username=Username('root'))
+    return time.perf_counter() - started_at
+  finally:
+    router.delete_sequential_save_file()
+
+
+def persistent_dictionary_set(operations: int) -> float:
+  'Every change is appended and fsynced on its own, like registering a user.'
+  dictionary = PersistentDictionary[str, str](filepath='persistent_dictionary_set.json')
+  started_at = time.perf_counter()
+  for index in range(operations):
+    dictionary[f'user:{index % 100}'] = VALUE
+  return time.perf_counter() - started_at
+
+
+def persistent_dictionary_batch(operations: int) -> float:
+  'Changes are appended and fsynced 100 at a time.'
+  dictionary = PersistentDictionary[str, str](filepath='persistent_dictionary_batch.json')
+  started_at = time.perf_counter()
+  for start in range(0, operations, 100):
+    with dictionary.batch():
+      for index in range(start, min(start + 100, operations)):
+        dictionary[f'user:{index % 100}'] = VALUE
+  return time.perf_counter() - started_at
+
+
+# Operations per run of every case at scale 1, fewer for the ones that fsync
+CASES: Dict[str, Tuple[Case, int]] = {
+    'database_get': (database_get, 200_000),
+    'database_put_new': (database_put_new, 100_000),
+    'database_put_overwrite': (database_put_overwrite, 200_000),
+    'database_put_ttl': (database_put_ttl, 100_000),
+    'delete_expired_keys': (delete_expired_keys, 100_000),
+    'parse_line': (parse_line_put, 200_000),
+    'read_frame': (read_frame_put, 200_000),
+    'execute_get': (execute_get, 200_000),
+    'save_successful_command': (save_successful_command, 100_000),
+    'persistent_dictionary_set': (persistent_dictionary_set, 200),
+    'persistent_dictionary_batch': (persistent_dictionary_batch, 10_000),
+}
+
+
+def run(names: List[str], repeat: int, scale: float) -> Dict[str, Dict[str, float]]:
+  '''
+  Runs every case in a temporary directory, so the state files of the server are never touched.
+  Reports the best and the median run, the best is the least disturbed by the rest of the machine.
+  '''
+  results: Dict[str, Dict[str, float]] = dict()
+  working_directory = os.getcwd()
+  with tempfile.TemporaryDirectory(prefix='in-memo-db-bench-') as directory:
+    os.chdir(directory)
+    os.mkdir('state_files')
+    try:
+      for name in names:
+        case, operations = CASES[name]
+        operations = max(1, int(operations * scale))
+        timings = [case(operations) / operations * 1e9 for _ in range(repeat)]
+        results[name] = {'operations': operations, 'best_ns': round(min(timings), 1),
+                         'median_ns': round(statistics.median(timings), 1),
+                         'ops_per_s': round(1e9 / min(timings))}
+    finally:
+      os.chdir(working_directory)
+  return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+  parser = argparse.ArgumentParser(description='Runs the microbenchmarks and prints the results as json.')
+  parser.add_argument('cases', nargs='*', metavar='case', help=f'cases to run, every case by default: {", ".join(CASES)}')
+  parser.add_argument('--repeat', type=int, default=5, help='runs of every case (default: 5)')
+  parser.add_argument('--scale', type=float, default=1.0, help='multiplies the operations per run (default: 1)')
+  parser.add_argument('--output', help='writes the json into this file instead of printing it')
+  args = parser.parse_args(argv)
+  unknown = [name for name in args.cases if name not in CASES]
+  if len(unknown) > 0:
+    parser.error(f'unknown cases: {", ".join(unknown)}')
+  results = run(names=args.cases or list(CASES), repeat=args.repeat, scale=args.scale)
+  report.write({'benchmark': 'micro', **report.environment(), 'repeat': args.repeat, 'results': results}, args.output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,32 @@
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Any, Dict, Optional
+
+
+def environment() -> Dict[str, Any]:
+  'Returns what a result depends on besides the code: the commit, the interpreter and the machine.'
+  return {'commit': _commit(), 'time': int(time.time()), 'python': platform.python_version(),
+          'implementation': platform.python_implementation(), 'machine': platform.machine(),
+          'cpus': os.cpu_count()}
+
+
+def _commit() -> Optional[str]:
+  try:
+    completed = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True)
+  return completed.stdout.strip() + ('-dirty' if dirty.stdout.strip() != '' else '')
+
+
+def write(report: Dict[str, Any], output: Optional[str]) -> None:
+  'Prints the report as json, or writes it into the output file so runs of different commits can be compared.'
+  content = json.dumps(report, indent=2)
+  if output is None:
+    print(content)
+    return None
+  with open(output, 'w', encoding='UTF-8') as file:
+    file.write(content + '\n')
@@ -0,0 +1,93 @@
+'''
+Compares the database sections of the snapshots with pickle, which snapshots were made of before: the
+seconds to write and to read a database, the size of the file and the peak of the memory allocated
+meanwhile (measured with tracemalloc in a separate run), i.e. python3 -m benchmarks.snapshot --keys 1000000
+'''
+import os
+import pickle
+import argparse
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+from benchmarks import report
+from model.custom_time import custom_time
+from model.database import Database, ExpireAtEpoch, Key, Value
+from model.snapshot import read_database, write_database
+
+
+def _filled_database(keys: int, value_bytes: int, expiring: float) -> Database:
+  database = Database()
+  now = custom_time.time
+  expiring_every = round(1 / expiring) if expiring > 0 else 0
+  for index in range(keys):
+    expire_at = ExpireAtEpoch(now + 3600 + index % 3600) if expiring_every > 0 and index % expiring_every == 0 else None
+    database.put(key=Key(f'key:{index}'), value=Value(f'{index:x}'.rjust(value_bytes, 'v')), expire_at=expire_at)
+  return database
+
+
+def _pickle_write(filename: str, database: Database) -> None:
+  with open(filename, 'wb') as file:
+    pickle.dump(database, file=file)
+
+
+def _pickle_read(filename: str) -> Database:
+  # Snapshots read the pickle of a database into memory first, to unpickle it at its offset
+  with open(filename, 'rb') as file:
+    database: Database = pickle.loads(file.read())
+    return database
+
+
+def _section_write(filename: str, database: Database) -> None:
+  with open(filename, 'wb') as file:
+    write_database(file, database)
+
+
+def _section_read(filename: str) -> Database:
+  with open(filename, 'rb') as file:
+    return read_database(file, 0, os.fstat(file.fileno()).st_size)
+
+
+def _measure(run: Callable[[], Any], repeat: int) -> Dict[str, float]:
+  'Returns the best seconds of the runs, and the peak of the memory allocated by an extra traced run.'
+  timings: List[float] = list()
+  for _ in range(repeat):
+    started_at = time.perf_counter()
+    run()
+    timings.append(time.perf_counter() - started_at)
+  tracemalloc.start()
+  try:
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return {'best_s': round(min(timings), 3), 'peak_bytes': peak}
+
+
+def run(keys: int, value_bytes: int, expiring: float, repeat: int) -> Dict[str, Dict[str, Any]]:
+  database = _filled_database(keys=keys, value_bytes=value_bytes, expiring=expiring)
+  results: Dict[str, Dict[str, Any]] = dict()
+  with tempfile.TemporaryDirectory(prefix='in-memo-db-bench-') as directory:
+    for name, write, read in (('pickle', _pickle_write, _pickle_read), ('section', _section_write, _section_read)):
+      filename = os.path.join(directory, name)
+      save = _measure(lambda: write(filename, database), repeat)
+      load = _measure(lambda: read(filename), repeat)
+      results[name] = {'save': save, 'load': load, 'file_bytes': os.path.getsize(filename)}
+  return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+  parser = argparse.ArgumentParser(description='Compares writing and reading a database as a snapshot section and as a pickle.')
+  parser.add_argument('--keys', type=int, default=1_000_000, help='keys of the database (default: 1000000)')
+  parser.add_argument('--value-bytes', type=int, default=32, help='length of every value (default: 32)')
+  parser.add_argument('--expiring', type=float, default=0.1, help='share of the keys with a ttl (default: 0.1)')
+  parser.add_argument('--repeat', type=int, default=3, help='timed runs of every measurement (default: 3)')
+  parser.add_argument('--output', help='writes the json into this file instead of printing it')
+  args = parser.parse_args(argv)
+  results = run(keys=args.keys, value_bytes=args.value_bytes, expiring=args.expiring, repeat=args.repeat)
+  report.write({'benchmark': 'snapshot', **report.environment(), 'keys': args.keys, 'value_bytes': args.value_bytes,
+                'expiring': args.expiring, 'repeat': args.repeat, 'results': results}, args.output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,119 @@
+import asyncio
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from model import exception
+from model.exception import CustomException
+from model.framing import OK_STATUS, PUSH_STATUS, REPLY_HEADER, encode_frame
+
+# Every error the server replies with is one of these, so it is raised as the same object the server raised
+ERRORS: Dict[str, CustomException] = {str(value): value for value in vars(exception).values()
+                                      if isinstance(value, CustomException)}
+
+
+def error_of(payload: str) -> CustomException:
+  'Returns the exception of an error reply, a new CustomException if it is unknown (i.e. sent by a newer server).'
+  known = ERRORS.get(payload)
+  return known if known is not None else CustomException(payload)
+
+
+class Connection():
+  '''
+  A connection speaking the binary protocol that pipelines on its own: the commands issued during
+  a step of the event loop are sent with a single write, and a reader task hands the replies to
+  them in order. Callers never wait for each other's round trips, only for their own reply.
+  '''
+
+  def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    self._reader = reader
+    self._writer = writer
+    # Frames issued during the current step of the event loop, and the futures waiting for replies
+    self._pending: List[bytes] = []
+    self._waiters: Deque['asyncio.Future[str]'] = deque()
+    self._error: Optional[ConnectionError] = None
+    self._reader_task = asyncio.get_running_loop().create_task(self._read_replies())
+
+  @classmethod
+  async def open(cls, host: str, port: int) -> 'Connection':
+    'Connects to the server and switches the connection to the binary protocol.'
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'protocol binary\n')
+    await writer.drain()
+    # The reply to the protocol command itself still comes as a line
+    line = await reader.readline()
+    if line != b'protocol: ok\n':
+      writer.close()
+      raise ConnectionError(f'unexpected reply to protocol binary: {line!r}')
+    return cls(reader, writer)
+
+  @property
+  def closed(self) -> bool:
+    return self._error is not None
+
+  @property
+  def in_flight(self) -> int:
+    'Returns the number of commands waiting for their reply.'
+    return len(self._waiters)
+
+  def execute(self, *args: str) -> 'asyncio.Future[str]':
+    '''
+    Sends a command and returns a future of its reply. An error reply is raised as the exception
+    of model/exception.py with the same message, a lost connection as ConnectionError.
+    '''
+    if self._error is not None:
+      raise self._error
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    if len(self._pending) == 0:
+      loop.call_soon(self._flush)
+    self._pending.append(encode_frame(args))
+    self._waiters.append(future)
+    return future
+
+  def _flush(self) -> None:
+    if self._error is None and len(self._pending) > 0:
+      self._writer.write(b''.join(self._pending))
+    self._pending.clear()
+
+  async def _read_replies(self) -> None:
+    try:
+      while True:
+        status, length = REPLY_HEADER.unpack(await self._reader.readexactly(REPLY_HEADER.size))
+        payload = (await self._reader.readexactly(length)).decode(errors='surrogateescape')
+        if status == PUSH_STATUS:
+          # Messages of subscriptions, which are not made on these connections
+          continue
+        future = self._waiters.popleft()
+        if future.cancelled():
+          continue
+        if status == OK_STATUS:
+          future.set_result(payload)
+        else:
+          future.set_exception(error_of(payload))
+    except (asyncio.IncompleteReadError, ConnectionError, IndexError) as err:
+      self._fail(ConnectionError(f'connection lost: {err!r}'))
+    except asyncio.CancelledError:
+      self._fail(ConnectionError('connection closed'))
+      raise
+
+  def _fail(self, error: ConnectionError) -> None:
+    'Closes the connection, the commands that did not get their reply fail with the error.'
+    if self._error is not None:
+      return None
+    self._error = error
+    self._pending.clear()
+    while len(self._waiters) > 0:
+      future = self._waiters.popleft()
+      if not future.done():
+        future.set_exception(error)
+    self._writer.close()
+
+  async def close(self) -> None:
+    self._reader_task.cancel()
+    try:
+      await self._reader_task
+    except asyncio.CancelledError:
+      pass
+    try:
+      await self._writer.wait_closed()
+    except ConnectionError:
+      pass
@@ -0,0 +1,137 @@
+import ast
+import asyncio
+from types import TracebackType
+from typing import Dict, List, Optional, Tuple, Type
+from client.connection import Connection
+from model.exception import CustomException, InvalidCredentialsError
+
+# Commands that change the session of a connection, which every user of the pool shares
+SESSION_COMMANDS = frozenset(['protocol', 'login', 'login_with_token', 'select_db', 'subscribe', 'unsubscribe', 'multi',
+                              'exec', 'discard'])
+
+
+class Pool():
+  '''
+  A few authenticated connections with the database already selected, i.e.
+  async with Pool(host, port, username, password, database='sessions') as pool: await pool.get('key')
+  Every command goes to the connection with the fewest replies outstanding, so concurrent commands
+  are pipelined. Only the first connection logs in with the password, which the server hashes with
+  PBKDF2, the others and the reconnections use a session token. Commands that were sent on a lost
+  connection fail with ConnectionError and are not retried, as they may have run.
+  '''
+
+  def __init__(self, host: str, port: int, username: str, password: str, database: Optional[str] = None,
+               size: int = 4) -> None:
+    self._host = host
+    self._port = port
+    self._username = username
+    self._password = password
+    self._database = database
+    self._size = size
+    self._token: Optional[str] = None
+    self._connections: List[Connection] = []
+    # Made in open(), before python 3.10 a lock belongs to the loop running when it is made
+    self._reconnecting: Optional[asyncio.Lock] = None
+
+  async def open(self) -> None:
+    self._reconnecting = asyncio.Lock()
+    first = await self._connect()
+    self._connections = [first, *await asyncio.gather(*[self._connect() for _ in range(self._size - 1)])]
+
+  async def close(self) -> None:
+    await asyncio.gather(*[connection.close() for connection in self._connections])
+    self._connections = []
+
+  async def __aenter__(self) -> 'Pool':
+    await self.open()
+    return self
+
+  async def __aexit__(self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException],
+                      traceback: Optional[TracebackType]) -> None:
+    await self.close()
+
+  async def _connect(self) -> Connection:
+    connection = await Connection.open(host=self._host, port=self._port)
+    try:
+      if self._token is not None:
+        try:
+          await connection.execute('login_with_token', self._username, self._token)
+        except CustomException as err:
+          if err is not InvalidCredentialsError:
+            raise
+          # The token expired
+          self._token = None
+      if self._token is None:
+        await connection.execute('login', self._username, self._password)
+        self._token = await connection.execute('login_token')
+      if self._database is not None:
+        await connection.execute('select_db', self._database)
+    except BaseException:
+      await connection.close()
+      raise
+    return connection
+
+  async def execute(self, *args: str) -> str:
+    'Runs a command on the least busy connection and returns the reply, errors are raised as in Connection.execute().'
+    if args[0] in SESSION_COMMANDS:
+      raise ValueError(f'{args[0]} would change the session of a pooled connection, use a Connection of your own')
+    index = min(range(len(self._connections)), key=lambda index: self._connections[index].in_flight)
+    connection = self._connections[index]
+    if connection.closed:
+      connection = await self._reconnect(index)
+    return await connection.execute(*args)
+
+  async def _reconnect(self, index: int) -> Connection:
+    async with self._reconnecting:  # type: ignore
+      if self._connections[index].closed:
+        await self._connections[index].close()
+        self._connections[index] = await self._connect()
+    return self._connections[index]
+
+  async def get(self, key: str) -> str:
+    return await self.execute('get', key)
+
+  async def put(self, key: str, value: str, ttl: Optional[int] = None) -> None:
+    await self.execute('put', key, value, *([] if ttl is None else [str(ttl)]))
+
+  async def delete(self, key: str) -> None:
+    await self.execute('delete', key)
+
+  async def mget(self, keys: List[str]) -> List[Optional[str]]:
+    values: List[Optional[str]] = ast.literal_eval(await self.execute('mget', *keys))
+    return values
+
+  async def mput(self, items: Dict[str, str]) -> None:
+    await self.execute('mput', *[part for item in items.items() for part in item])
+
+  async def mdelete(self, keys: List[str]) -> None:
+    await self.execute('mdelete', *keys)
+
+  async def incrby(self, key: str, amount: int = 1) -> int:
+    return int(await self.execute('incrby', key, str(amount)))
+
+  async def append(self, key: str, suffix: str) -> int:
+    return int(await self.execute('append', key, suffix))
+
+  async def hset(self, key: str, fields: Dict[str, str]) -> int:
+    return int(await self.execute('hset', key, *[part for field in fields.items() for part in field]))
+
+  async def hget(self, key: str, field: str) -> str:
+    return await self.execute('hget', key, field)
+
+  async def hmget(self, key: str, fields: List[str]) -> List[Optional[str]]:
+    values: List[Optional[str]] = ast.literal_eval(await self.execute('hmget', key, *fields))
+    return values
+
+  async def hdel(self, key: str, fields: List[str]) -> int:
+    return int(await self.execute('hdel', key, *fields))
+
+  async def hgetall(self, key: str) -> Dict[str, str]:
+    fields: Dict[str, str] = ast.literal_eval(await self.execute('hgetall', key))
+    return fields
+
+  async def scan(self, cursor: str = '0', match: Optional[str] = None, count: Optional[int] = None) -> Tuple[str, List[str]]:
+    'Returns the next cursor, which is 0 at the end, and a batch of keys.'
+    options = [*([] if match is None else ['match', match]), *([] if count is None else ['count', str(count)])]
+    next_cursor, keys = ast.literal_eval(await self.execute('scan', cursor, *options))
+    return (str(next_cursor), keys)
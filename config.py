@@ -7,7 +7,82 @@ dotenv.load_config()
 ROOT_USER = os.environ['ROOT_USER']
 ROOT_PASSWORD = os.environ['ROOT_PASSWORD']
 
-PORT = os.environ['PORT']
+PORT = int(os.environ['PORT'])
 HOST = os.environ['HOST']
+# Bytes of the longest line of the line protocol, so a client never sending a newline cannot fill the memory
+MAX_LINE_BYTES = int(os.environ['MAX_LINE_BYTES'])
 
 PBKDF2_HMAC_ITERATIONS = int(os.environ['PBKDF2_HMAC_ITERATIONS'])
+# Threads hashing passwords off the event loop
+KDF_THREADS = int(os.environ['KDF_THREADS'])
+# Lifetime of the tokens issued by login_token
+SESSION_TOKEN_TTL_S = int(os.environ['SESSION_TOKEN_TTL_S'])
+# Tokens a user can hold at once, the oldest is revoked past it
+SESSION_TOKENS_PER_USER = int(os.environ['SESSION_TOKENS_PER_USER'])
+
+# Upper bound of time spent deleting expired keys before yielding to clients
+TTL_SWEEP_TIME_BUDGET_MS = int(os.environ['TTL_SWEEP_TIME_BUDGET_MS'])
+
+# Durability of the write-ahead log: always, everysec or never
+WAL_FSYNC_POLICY = os.environ['WAL_FSYNC_POLICY']
+# Buffered records are committed together when either of these is reached
+WAL_GROUP_COMMIT_MS = int(os.environ['WAL_GROUP_COMMIT_MS'])
+WAL_GROUP_COMMIT_BYTES = int(os.environ['WAL_GROUP_COMMIT_BYTES'])
+
+# Seconds between two background snapshots, 0 disables them
+SNAPSHOT_INTERVAL_S = int(os.environ['SNAPSHOT_INTERVAL_S'])
+# Databases nobody selected for this many seconds are spilled to disk and dropped from memory, 0 keeps them
+DB_SPILL_IDLE_S = int(os.environ['DB_SPILL_IDLE_S'])
+
+# Worker processes, each serving a shard of the databases, 1 serves everything in a single process
+WORKERS = int(os.environ['WORKERS'])
+
+# Memory ceilings in bytes of all databases and of each database, 0 means no limit.
+# With several workers, every worker gets an equal share of MAXMEMORY_BYTES.
+MAXMEMORY_BYTES = int(os.environ['MAXMEMORY_BYTES'])
+DB_MAXMEMORY_BYTES = int(os.environ['DB_MAXMEMORY_BYTES'])
+# Keys evicted at a ceiling: noeviction, allkeys-lru, allkeys-lfu, allkeys-random or volatile-ttl
+MAXMEMORY_POLICY = os.environ['MAXMEMORY_POLICY']
+# Keys sampled per eviction, more samples approximate the policy better at a higher cost
+MAXMEMORY_SAMPLES = int(os.environ['MAXMEMORY_SAMPLES'])
+
+# Keys a single scan call looks at at most, larger counts are capped
+SCAN_MAX_COUNT = int(os.environ['SCAN_MAX_COUNT'])
+# Keep the keys of every database in order too (1) so prefix scans only visit matching keys
+ORDERED_KEY_INDEX = int(os.environ['ORDERED_KEY_INDEX']) == 1
+
+# Codec of the values of new databases (none, zlib or lzma), set_compression changes it per database.
+# Values shorter than COMPRESSION_MIN_BYTES are stored raw, every database keeps COMPRESSION_CACHE_BYTES
+# of decompressed values of its hot keys
+COMPRESSION = os.environ['COMPRESSION']
+COMPRESSION_MIN_BYTES = int(os.environ['COMPRESSION_MIN_BYTES'])
+COMPRESSION_CACHE_BYTES = int(os.environ['COMPRESSION_CACHE_BYTES'])
+# Codec the write-ahead log writer compresses its batches of at least COMPRESSION_MIN_BYTES with
+WAL_COMPRESSION = os.environ['WAL_COMPRESSION']
+
+# Hashes are flat encoded in a single bytearray while they stay within both limits, then kept in a dict
+HASH_MAX_FLAT_FIELDS = int(os.environ['HASH_MAX_FLAT_FIELDS'])
+HASH_MAX_FLAT_FIELD_BYTES = int(os.environ['HASH_MAX_FLAT_FIELD_BYTES'])
+
+# Publish the events of every key on the keyspace channels (1), which costs a call per write
+NOTIFY_KEYSPACE_EVENTS = int(os.environ['NOTIFY_KEYSPACE_EVENTS']) == 1
+# Bytes a subscriber may fall behind, past that its messages are dropped or it is disconnected
+PUBSUB_BUFFER_BYTES = int(os.environ['PUBSUB_BUFFER_BYTES'])
+PUBSUB_OVERFLOW_POLICY = os.environ['PUBSUB_OVERFLOW_POLICY']
+
+# Serve the metrics in the Prometheus text format on this port (0 disables it), worker n of a sharded server uses PORT + n
+METRICS_PORT = int(os.environ['METRICS_PORT'])
+METRICS_HOST = os.environ['METRICS_HOST']
+
+# Commands running at least this many microseconds are kept in the slowlog, which holds the latest SLOWLOG_MAX_LEN of them
+SLOWLOG_SLOWER_THAN_US = int(os.environ['SLOWLOG_SLOWER_THAN_US'])
+SLOWLOG_MAX_LEN = int(os.environ['SLOWLOG_MAX_LEN'])
+
+# host:port of the replication port of a leader to follow as a read-only replica, empty for a leader
+REPLICA_OF = os.environ['REPLICA_OF']
+# Replicas connect to this port of a leader (0 disables it)
+REPLICATION_PORT = int(os.environ['REPLICATION_PORT'])
+REPLICATION_HOST = os.environ['REPLICATION_HOST']
+# The latest bytes of the stream kept for replicas that reconnect, and how far one may fall behind before it is dropped
+REPLICATION_BACKLOG_BYTES = int(os.environ['REPLICATION_BACKLOG_BYTES'])
+REPLICATION_OUTPUT_LIMIT_BYTES = int(os.environ['REPLICATION_OUTPUT_LIMIT_BYTES'])
@@ -1,6 +1,22 @@
 STATE_FILES_DIRNAME = 'state_files'
 DBS_FILENAME = f'{STATE_FILES_DIRNAME}/dbs.pickle'
-SEQUENTIAL_SAVE_FILENAME = f'{STATE_FILES_DIRNAME}/sequential_save.txt'
+# Segments of the write-ahead log, formatted with their generation number
+SEQUENTIAL_SAVE_FILENAME = f'{STATE_FILES_DIRNAME}/sequential_save.{{}}.log'
+# Text log of the versions before the segments, converted into the first segment once
+LEGACY_SEQUENTIAL_SAVE_FILENAME = f'{STATE_FILES_DIRNAME}/sequential_save.txt'
 USERS_JSON_FILENAME = f'{STATE_FILES_DIRNAME}/users.json'
 DBS_OF_USERS_JSON_FILENAME = f'{STATE_FILES_DIRNAME}/dbs_of_users.json'
 USERS_OF_DBS_JSON_FILENAME = f'{STATE_FILES_DIRNAME}/users_of_dbs.json'
+# Held while worker processes of a sharded server change the files above
+METADATA_LOCK_FILENAME = f'{STATE_FILES_DIRNAME}/metadata.lock'
+# Every worker process of a sharded server keeps its own snapshot and log segments, formatted with its id
+SHARD_DIRNAME = f'{STATE_FILES_DIRNAME}/shard_{{}}'
+SHARD_DBS_FILENAME = f'{SHARD_DIRNAME}/dbs.pickle'
+SHARD_SEQUENTIAL_SAVE_FILENAME = f'{SHARD_DIRNAME}/sequential_save.{{{{}}}}.log'
+# Connections are handed over to a worker process through its unix socket
+HANDOFF_SOCKET_FILENAME = f'{STATE_FILES_DIRNAME}/worker_{{}}.sock'
+# Published messages are relayed to a worker process through its datagram socket
+RELAY_SOCKET_FILENAME = f'{STATE_FILES_DIRNAME}/relay_{{}}.sock'
+# Snapshots a leader makes for a replica, formatted with a counter, and the last one a replica received
+REPLICATION_SNAPSHOT_FILENAME = f'{STATE_FILES_DIRNAME}/replication_snapshot.{{}}.pickle'
+REPLICA_SNAPSHOT_FILENAME = f'{STATE_FILES_DIRNAME}/replica_snapshot.pickle'
@@ -1,23 +1,56 @@
-from config import ROOT_USER
-from model.database import Key
-from model.exception import CannotDeleteRootUserError, InvalidCredentialsError, InvalidNumberOfParamsError, InvalidTTLValueError, NoDbSelectedError, UserNotLoggedInError, UserUnauthorizedError
+from config import ROOT_USER, SCAN_MAX_COUNT
+from model.compression import Codec
+from model.database import Key, expire_at_after, parse_integer
+from model.exception import CannotDeleteRootUserError, DbNotExistError, DiscardWithoutMultiError, InvalidCodecError, InvalidDbNameError, NestedTransactionError, InvalidCredentialsError, InvalidInfoSectionError, InvalidIntegerValueError, InvalidNumberOfParamsError, InvalidProtocolError, InvalidScanOptionError, InvalidTTLValueError, NoDbSelectedError, ReservedChannelError, UserNotLoggedInError, UserUnauthorizedError
+from model.framing import Protocol
+from model.metrics import metrics
+from model.slowlog import slowlog
+from model.pubsub import KEYSPACE_SEPARATOR, Subscriber, keyspace_database
 from model.router import Context
 
 
-def login(ctx: Context) -> None:
+def protocol(ctx: Context) -> None:
+  try:
+    protocol_name = ctx.params[0]
+  except IndexError:
+    raise InvalidNumberOfParamsError
+  try:
+    ctx.protocol = Protocol[protocol_name]
+  except KeyError:
+    raise InvalidProtocolError
+  ctx.response = 'protocol: ok'
+
+
+async def login(ctx: Context) -> None:
   try:
     username = ctx.params[0]
     password = ctx.params[1]
   except IndexError:
     raise InvalidNumberOfParamsError
-  if not ctx.store.authenticate_user(username, password):
+  if not await ctx.store.authenticate_user(username, password):
     raise InvalidCredentialsError
   ctx.username = username
-  ctx.database_name = str()
-  ctx.database = None
+  ctx.select(database_name=str(), database=None)
   ctx.response = 'login: ok'
 
 
+def login_token(ctx: Context) -> None:
+  ctx.response = ctx.store.issue_session_token(username=ctx.username)
+
+
+def login_with_token(ctx: Context) -> None:
+  try:
+    username = ctx.params[0]
+    token = ctx.params[1]
+  except IndexError:
+    raise InvalidNumberOfParamsError
+  if not ctx.store.authenticate_session_token(username=username, token=token):
+    raise InvalidCredentialsError
+  ctx.username = username
+  ctx.select(database_name=str(), database=None)
+  ctx.response = 'login_with_token: ok'
+
+
 def whoami(ctx: Context) -> None:
   if ctx.username == '':
     raise UserNotLoggedInError
@@ -29,6 +62,9 @@ def create_db(ctx: Context) -> None:
     new_db_name = ctx.params[0]
   except IndexError:
     raise InvalidNumberOfParamsError
+  # The keyspace channels of the database would be mistaken for the channels of another one
+  if KEYSPACE_SEPARATOR in new_db_name:
+    raise InvalidDbNameError
   ctx.store.create_database(username=ctx.username, new_db_name=new_db_name)
   ctx.store.add_user_to_owners(username=ROOT_USER, db_name=new_db_name)
   ctx.response = 'create_db: ok'
@@ -51,8 +87,7 @@ def select_db(ctx: Context) -> None:
     db_name = ctx.params[0]
   except IndexError:
     raise InvalidNumberOfParamsError
-  ctx.database = ctx.store.get_database_by_name(username=ctx.username, db_name=db_name)
-  ctx.database_name = db_name
+  ctx.select(database_name=db_name, database=ctx.store.get_database_by_name(username=ctx.username, db_name=db_name))
   ctx.response = 'select_db: ok'
 
 
@@ -76,16 +111,15 @@ def put(ctx: Context) -> None:
     value = ctx.params[1]
   except IndexError:
     raise InvalidNumberOfParamsError
-  ctx.database.put(key=key, value=value)
   try:
     ttl_string = ctx.params[2]
   except IndexError:
-    ctx.database.remove_ttl(key=key)
+    expire_at = None
   else:
     if not ttl_string.isdigit():
       raise InvalidTTLValueError
-    ttl = int(ttl_string)
-    ctx.database.set_ttl(key=key, ttl=ttl)
+    expire_at = expire_at_after(ttl=int(ttl_string))
+  ctx.database.put(key=key, value=value, expire_at=expire_at)
   ctx.response = 'put: ok'
 
 
@@ -104,19 +138,228 @@ def update(ctx: Context) -> None:
     value = ctx.params[1]
   except IndexError:
     raise InvalidNumberOfParamsError
-  ctx.database.update(key=key, value=value)
   try:
     ttl_string = ctx.params[2]
   except IndexError:
-    ctx.database.remove_ttl(key=key)
+    expire_at = None
   else:
     if not ttl_string.isdigit():
       raise InvalidTTLValueError
-    ttl = int(ttl_string)
-    ctx.database.set_ttl(key=key, ttl=ttl)
+    expire_at = expire_at_after(ttl=int(ttl_string))
+  ctx.database.update(key=key, value=value, expire_at=expire_at)
   ctx.response = 'update: ok'
 
 
+def mget(ctx: Context) -> None:
+  if len(ctx.params) == 0:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.mget(keys=ctx.params))
+
+
+def mput(ctx: Context) -> None:
+  if len(ctx.params) == 0 or len(ctx.params) % 2 != 0:
+    raise InvalidNumberOfParamsError
+  ctx.database.mput(items=zip(ctx.params[0::2], ctx.params[1::2]))
+  ctx.response = 'mput: ok'
+
+
+def mdelete(ctx: Context) -> None:
+  if len(ctx.params) == 0:
+    raise InvalidNumberOfParamsError
+  ctx.database.mdelete(keys=ctx.params)
+  ctx.response = 'mdelete: ok'
+
+
+def incr(ctx: Context) -> None:
+  if len(ctx.params) != 1:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.incrby(key=ctx.params[0], amount=1))
+
+
+def decr(ctx: Context) -> None:
+  if len(ctx.params) != 1:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.incrby(key=ctx.params[0], amount=-1))
+
+
+def incrby(ctx: Context) -> None:
+  if len(ctx.params) != 2:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.incrby(key=ctx.params[0], amount=parse_integer(ctx.params[1])))
+
+
+def append(ctx: Context) -> None:
+  if len(ctx.params) != 2:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.append(key=ctx.params[0], suffix=ctx.params[1]))
+
+
+def getset(ctx: Context) -> None:
+  if len(ctx.params) != 2:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.getset(key=ctx.params[0], value=ctx.params[1]))
+
+
+def hset(ctx: Context) -> None:
+  if len(ctx.params) < 3 or len(ctx.params) % 2 != 1:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.hset(key=ctx.params[0], items=zip(ctx.params[1::2], ctx.params[2::2])))
+
+
+def hget(ctx: Context) -> None:
+  if len(ctx.params) != 2:
+    raise InvalidNumberOfParamsError
+  ctx.response = ctx.database.hget(key=ctx.params[0], field=ctx.params[1])
+
+
+def hmget(ctx: Context) -> None:
+  if len(ctx.params) < 2:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.hmget(key=ctx.params[0], fields=ctx.params[1:]))
+
+
+def hdel(ctx: Context) -> None:
+  if len(ctx.params) < 2:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.hdel(key=ctx.params[0], fields=ctx.params[1:]))
+
+
+def hgetall(ctx: Context) -> None:
+  if len(ctx.params) != 1:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.hgetall(key=ctx.params[0]))
+
+
+def subscribe(ctx: Context) -> None:
+  if len(ctx.params) == 0:
+    raise InvalidNumberOfParamsError
+  for channel in ctx.params:
+    db_name = keyspace_database(channel)
+    if db_name is not None and not ctx.store.owns_database(username=ctx.username, db_name=db_name):
+      raise DbNotExistError
+  if ctx.subscriber is None:
+    ctx.subscriber = Subscriber(transport=ctx.transport, protocol=ctx.protocol)
+  for channel in ctx.params:
+    ctx.store.pubsub.subscribe(subscriber=ctx.subscriber, channel=channel)
+  ctx.response = str(len(ctx.subscriber.channels))
+
+
+def unsubscribe(ctx: Context) -> None:
+  if ctx.subscriber is not None:
+    for channel in ctx.params if len(ctx.params) > 0 else list(ctx.subscriber.channels):
+      ctx.store.pubsub.unsubscribe(subscriber=ctx.subscriber, channel=channel)
+    if len(ctx.subscriber.channels) == 0:
+      ctx.subscriber = None
+  ctx.response = str(0 if ctx.subscriber is None else len(ctx.subscriber.channels))
+
+
+def publish(ctx: Context) -> None:
+  try:
+    channel = ctx.params[0]
+    message = ctx.params[1]
+  except IndexError:
+    raise InvalidNumberOfParamsError
+  if keyspace_database(channel) is not None:
+    raise ReservedChannelError
+  ctx.response = str(ctx.store.pubsub.publish(channel=channel, message=message))
+
+
+def memory_usage(ctx: Context) -> None:
+  if len(ctx.params) > 1:
+    raise InvalidNumberOfParamsError
+  ctx.response = str(ctx.database.memory_usage(key=ctx.params[0] if len(ctx.params) == 1 else None))
+
+
+def db_info(ctx: Context) -> None:
+  ctx.response = str(ctx.database.info())
+
+
+def set_compression(ctx: Context) -> None:
+  if len(ctx.params) != 1:
+    raise InvalidNumberOfParamsError
+  try:
+    codec = Codec(ctx.params[0])
+  except ValueError:
+    raise InvalidCodecError
+  ctx.database.set_compression(codec=codec)
+  ctx.response = 'set_compression: ok'
+
+
+def info(ctx: Context) -> None:
+  'Reports the metrics of the process serving the connection, only the databases of the user are listed.'
+  if len(ctx.params) > 1:
+    raise InvalidNumberOfParamsError
+  store_info = ctx.store.info()
+  owned = set(ctx.store.list_dbs_of_user(username=ctx.username))
+  store_info['databases'] = {name: db_info for name, db_info in store_info['databases'].items() if name in owned}
+  sections = metrics.info(store_info=store_info)
+  if len(ctx.params) == 0:
+    ctx.response = str(sections)
+    return None
+  try:
+    ctx.response = str(sections[ctx.params[0]])
+  except KeyError:
+    raise InvalidInfoSectionError
+
+
+def slowlog_get(ctx: Context) -> None:
+  'Returns the latest slow commands of the process serving the connection, 10 unless a count is given.'
+  if ctx.username != ROOT_USER:
+    raise UserUnauthorizedError
+  if len(ctx.params) > 1:
+    raise InvalidNumberOfParamsError
+  count = 10
+  if len(ctx.params) == 1:
+    if not ctx.params[0].isdigit():
+      raise InvalidIntegerValueError
+    count = int(ctx.params[0])
+  ctx.response = str([entry.to_dict() for entry in slowlog.get(count=count)])
+
+
+def slowlog_reset(ctx: Context) -> None:
+  if ctx.username != ROOT_USER:
+    raise UserUnauthorizedError
+  slowlog.reset()
+  ctx.response = 'slowlog_reset: ok'
+
+
+def multi(ctx: Context) -> None:
+  if ctx.transaction is not None:
+    raise NestedTransactionError
+  ctx.transaction = list()
+  ctx.transaction_failed = False
+  ctx.response = 'multi: ok'
+
+
+def discard(ctx: Context) -> None:
+  if ctx.transaction is None:
+    raise DiscardWithoutMultiError
+  ctx.transaction = None
+  ctx.transaction_failed = False
+  ctx.response = 'discard: ok'
+
+
+def scan(ctx: Context) -> None:
+  try:
+    cursor = ctx.params[0]
+  except IndexError:
+    raise InvalidNumberOfParamsError
+  options = ctx.params[1:]
+  if len(options) % 2 != 0:
+    raise InvalidNumberOfParamsError
+  pattern = None
+  count = 10
+  for option, argument in zip(options[0::2], options[1::2]):
+    if option == 'match':
+      pattern = argument
+    elif option == 'count' and argument.isdigit() and int(argument) > 0:
+      count = min(int(argument), SCAN_MAX_COUNT)
+    else:
+      raise InvalidScanOptionError
+  next_cursor, keys = ctx.database.scan(cursor=cursor, pattern=pattern, count=count)
+  ctx.response = str([next_cursor, keys])
+
+
 def delete_user(ctx: Context) -> None:
   if ctx.username != ROOT_USER:
     raise UserUnauthorizedError
@@ -138,8 +381,7 @@ def delete_db(ctx: Context) -> None:
   ctx.store.delete_database(username=ctx.username, db_to_delete=db_to_delete)
   current_selected_db_name = ctx.database_name
   if current_selected_db_name == db_to_delete:
-    ctx.database_name = str()
-    ctx.database = None
+    ctx.select(database_name=str(), database=None)
   ctx.response = 'delete_db: ok'
 
 
@@ -151,11 +393,11 @@ def list_dbs(ctx: Context) -> None:
   ctx.response = str(ctx.store.list_dbs_of_user(username=ctx.username))
 
 
-def register_user(ctx: Context) -> None:
+async def register_user(ctx: Context) -> None:
   try:
     username_to_create = ctx.params[0]
     password = ctx.params[1]
   except IndexError:
     raise InvalidNumberOfParamsError
-  ctx.store.create_user(username_to_create=username_to_create, password=password)
+  await ctx.store.create_user(username_to_create=username_to_create, password=password)
   ctx.response = 'create_user: ok'
@@ -4,41 +4,195 @@ import os
 import signal
 import logging
 import sys
-from config import HOST, PORT
+import time
+import socket
+import functools
+import mmap
+from typing import Any, Dict, List, Optional
+from config import DB_SPILL_IDLE_S, HOST, MAXMEMORY_BYTES, METRICS_HOST, METRICS_PORT, PORT, SNAPSHOT_INTERVAL_S, TTL_SWEEP_TIME_BUDGET_MS, WORKERS
+from config import REPLICA_OF, REPLICATION_HOST, REPLICATION_PORT
+from constants import STATE_FILES_DIRNAME
+from model.connection import Connection, adopt
+from model.context import Context
 from model.router import Router
+from model.sharding import Shards, bind_handoff_sockets, bind_relay_sockets, layout_matches, map_keyspace_flags
 from model.store import Store
+from model.metrics import metrics
+from model.replication import Follower, Leader
 
 
 async def ttl_coro(store: Store) -> None:
   while True:
     await asyncio.sleep(delay=1.0)
-    store.delete_expired_keys_from_dbs()
+    # A mass expiry is spread over several sweeps, clients are served in between
+    while True:
+      started_at = time.perf_counter_ns()
+      done = store.delete_expired_keys_from_dbs(time_budget=TTL_SWEEP_TIME_BUDGET_MS / 1000)
+      metrics.ttl_sweeps.record((time.perf_counter_ns() - started_at) // 1000)
+      if done:
+        break
+      await asyncio.sleep(delay=0)
 
 
-async def main_coro() -> None:
+async def snapshot_coro(store: Store, router: Router) -> None:
+  while True:
+    await asyncio.sleep(delay=SNAPSHOT_INTERVAL_S)
+    # Rotating and forking happen in the same step of the event loop, so the
+    # snapshot holds exactly the commands of the segments up to this generation
+    generation = router.rotate_sequential_save_file()
+    if await store.save_dbs_in_background(generation=generation):
+      router.truncate_sequential_save_file(generation=generation)
+
+
+async def spill_coro(store: Store) -> None:
+  while True:
+    await asyncio.sleep(delay=max(1.0, DB_SPILL_IDLE_S / 4))
+    store.spill_idle_databases(idle_s=DB_SPILL_IDLE_S)
+
+
+async def serve_metrics(store: Store, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+  'Answers a single HTTP request of a Prometheus scrape with the metrics of this process, whatever its path.'
   try:
-    store = Store()
-    store.load_dbs_from_disk()
-    router = Router(store=store)
-    router.load_sequential_save_file()
-    server = await asyncio.start_server(router, host=HOST, port=PORT)
+    await reader.readuntil(b'\r\n\r\n')
+    body = metrics.prometheus(store_info=store.info()).encode()
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                 b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+    await writer.drain()
+  except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as err:
+    logging.warning(f'metrics request failed: {err!r}')
+  finally:
+    writer.close()
+
+
+async def main_coro(shards: Optional[Shards] = None) -> None:
+  try:
+    if shards is None:
+      store = Store()
+    else:
+      store = Store(dbs_filename=shards.dbs_filename, shared_metadata=True,
+                    maxmemory_bytes=MAXMEMORY_BYTES // shards.workers)
+    generation = store.load_dbs_from_disk()
+    router = Router(store=store, shards=shards)
+    router.load_sequential_save_file(generation=generation)
+    # Workers of a sharded server listen on the same port, the kernel spreads new connections between them
+    server = await asyncio.get_running_loop().create_server(lambda: Connection(router=router, ctx=Context(store=store)),
+                                                            host=HOST, port=PORT, reuse_port=shards is not None)
     logging.info(f'serving on {HOST}:{PORT}')
+    if shards is not None:
+      asyncio.create_task(shards.serve(adopt=functools.partial(adopt, router)))
+      store.pubsub.relay = shards.relay
+      store.pubsub.share_keyspace_subscribed = shards.share_keyspace_subscribed
+      store.pubsub.keyspace_subscribed_elsewhere = shards.keyspace_subscribed_elsewhere
+      shards.receive_relayed(deliver=store.pubsub.deliver)
+    if METRICS_PORT > 0:
+      metrics_port = METRICS_PORT if shards is None else METRICS_PORT + shards.worker_id
+      await asyncio.start_server(functools.partial(serve_metrics, store), host=METRICS_HOST, port=metrics_port)
+      logging.info(f'serving metrics on {METRICS_HOST}:{metrics_port}')
+    if REPLICA_OF != '':
+      router.read_only = True
+      follower = Follower(store=store, leader=REPLICA_OF)
+      metrics.replication = follower.info
+      asyncio.create_task(follower.run())
+      logging.info(f'replicating {REPLICA_OF}')
+    elif REPLICATION_PORT > 0:
+      router.leader = Leader(store=store)
+      store.propagate_deletions = router.leader.feed_deletions
+      metrics.replication = router.leader.info
+      await asyncio.start_server(router.leader, host=REPLICATION_HOST, port=REPLICATION_PORT)
+      asyncio.create_task(router.leader.ping())
+      logging.info(f'serving replicas on {REPLICATION_HOST}:{REPLICATION_PORT}')
     asyncio.create_task(ttl_coro(store=store))
+    if SNAPSHOT_INTERVAL_S > 0:
+      asyncio.create_task(snapshot_coro(store=store, router=router))
+    if DB_SPILL_IDLE_S > 0:
+      asyncio.create_task(spill_coro(store=store))
     await server.start_serving()
     await asyncio.Event().wait()
   except asyncio.CancelledError:
     server.close()
     await server.wait_closed()
-    store.save_dbs_to_disk()
+    store.save_dbs_to_disk(generation=router.rotate_sequential_save_file())
     router.delete_sequential_save_file()
+    store.close()
     logging.info('graceful shutdown: ok')
     exit(0)
 
-if __name__ == '__main__':
-  logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s', stream=sys.stdout, level=logging.INFO)
-  logging.info(f'pid: {os.getpid()}')
-  loop = asyncio.get_event_loop()
-  main_task = loop.create_task(main_coro())
+
+def run(shards: Optional[Shards] = None) -> None:
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  main_task = loop.create_task(main_coro(shards=shards))
   loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
   loop.add_signal_handler(signal.SIGINT, main_task.cancel)
   loop.run_until_complete(main_task)
+
+
+def run_worker(worker_id: int, listeners: List[socket.socket], relay_sockets: List[socket.socket],
+               keyspace_flags: mmap.mmap) -> None:
+  'Runs a worker process of a sharded server, never returns to the caller.'
+  exit_code = 1
+  try:
+    logging.getLogger().handlers[0].setFormatter(logging.Formatter(f'%(asctime)s [%(levelname)s] worker {worker_id}: %(message)s'))
+    logging.info(f'pid: {os.getpid()}')
+    metrics.worker_id = worker_id
+    run(shards=Shards(worker_id=worker_id, workers=WORKERS, listeners=listeners, relay_sockets=relay_sockets,
+                      keyspace_flags=keyspace_flags))
+    exit_code = 0
+  except SystemExit as err:
+    exit_code = err.code if isinstance(err.code, int) else 1
+  finally:
+    sys.stdout.flush()
+    os._exit(exit_code)
+
+
+def supervise() -> None:
+  '''
+  Forks the worker processes of a sharded server and waits for them. SIGTERM is passed on to
+  every worker, and if one of them dies, the others are stopped as well.
+  '''
+  listeners = bind_handoff_sockets(workers=WORKERS)
+  relay_sockets = bind_relay_sockets(workers=WORKERS)
+  keyspace_flags = map_keyspace_flags(workers=WORKERS)
+  pids: Dict[int, int] = dict()
+  for worker_id in range(WORKERS):
+    pid = os.fork()
+    if pid == 0:
+      run_worker(worker_id=worker_id, listeners=listeners, relay_sockets=relay_sockets, keyspace_flags=keyspace_flags)
+    pids[pid] = worker_id
+  for listener in [*listeners, *relay_sockets]:
+    listener.close()
+
+  def terminate(*_: Any) -> None:
+    for pid in pids:
+      os.kill(pid, signal.SIGTERM)
+
+  signal.signal(signal.SIGTERM, terminate)
+  # The terminal sends SIGINT to the workers as well, passing it on would interrupt their shutdown
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  exit_code = 0
+  while len(pids) > 0:
+    pid, status = os.waitpid(-1, 0)
+    worker_id = pids.pop(pid)
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+      logging.error(f'worker {worker_id} exited with status {status}, stopping the others')
+      exit_code = 1
+      terminate()
+  exit(exit_code)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s', stream=sys.stdout, level=logging.INFO)
+  logging.info(f'pid: {os.getpid()}')
+  if not layout_matches(workers=WORKERS):
+    logging.error(f'{STATE_FILES_DIRNAME} was written with a different number of workers than {WORKERS}')
+    exit(1)
+  if REPLICA_OF != '' and REPLICATION_PORT > 0:
+    logging.error('a replica cannot serve replicas of its own, set either REPLICA_OF or REPLICATION_PORT')
+    exit(1)
+  if WORKERS > 1 and (REPLICA_OF != '' or REPLICATION_PORT > 0):
+    logging.error('replication needs a single worker, every worker would have a stream of its own')
+    exit(1)
+  if WORKERS == 1:
+    run()
+  else:
+    supervise()
@@ -0,0 +1,49 @@
+import lzma
+import zlib
+import struct
+from enum import Enum, unique
+from typing import Dict, Union
+
+
+@unique
+class Codec(Enum):
+  none = 'none'
+  zlib = 'zlib'
+  lzma = 'lzma'
+
+
+# In front of compressed data: the id of the codec and the length of the original data,
+# so data compressed with any codec can be read back whatever the codec is now
+COMPRESSED_HEADER = struct.Struct('<BI')
+CODEC_IDS: Dict[Codec, int] = {Codec.zlib: 1, Codec.lzma: 2}
+# Raw LZMA2 streams, the xz container would add tens of bytes to every value. A low preset compresses small
+# values as well as the default one, and the dictionary, which is set up on every call, is sized to the data.
+LZMA_PRESET = 2
+LZMA_MIN_DICT_SIZE = 4096
+LZMA_MAX_DICT_SIZE = 8 * 1024 * 1024
+LZMA_DECODER_FILTERS = [{'id': lzma.FILTER_LZMA2, 'dict_size': LZMA_MAX_DICT_SIZE}]
+
+
+def compress(codec: Codec, data: Union[bytes, bytearray]) -> bytes:
+  'Returns the header and the compressed data. Both codecs release the GIL, so it can run in a thread.'
+  header = COMPRESSED_HEADER.pack(CODEC_IDS[codec], len(data))
+  if codec is Codec.zlib:
+    return header + zlib.compress(data)
+  dict_size = min(max(len(data), LZMA_MIN_DICT_SIZE), LZMA_MAX_DICT_SIZE)
+  return header + lzma.compress(data, format=lzma.FORMAT_RAW,
+                                filters=[{'id': lzma.FILTER_LZMA2, 'preset': LZMA_PRESET, 'dict_size': dict_size}])
+
+
+def original_size(data: Union[bytes, bytearray], offset: int = 0) -> int:
+  'Returns the length of the original data of what compress() returned, written at offset.'
+  size: int = COMPRESSED_HEADER.unpack_from(data, offset)[1]
+  return size
+
+
+def decompress(data: Union[bytes, bytearray], offset: int = 0) -> bytes:
+  'Returns the original data of what compress() returned, written at offset.'
+  codec_id, size = COMPRESSED_HEADER.unpack_from(data, offset)
+  with memoryview(data) as view:
+    if codec_id == CODEC_IDS[Codec.zlib]:
+      return zlib.decompress(view[offset + COMPRESSED_HEADER.size:], bufsize=max(size, 1))
+    return lzma.decompress(view[offset + COMPRESSED_HEADER.size:], format=lzma.FORMAT_RAW, filters=LZMA_DECODER_FILTERS)
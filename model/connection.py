@@ -0,0 +1,228 @@
+import socket
+import asyncio
+import logging
+from typing import Awaitable, Optional, cast
+from asyncio import BaseTransport, Transport
+from config import MAX_LINE_BYTES
+from model.context import Context
+from model.exception import CustomException, LineTooLongError
+from model.framing import FrameError, Protocol, encode_reply, read_frame
+from model.metrics import metrics
+from model.router import Router
+from model.validator import parse_line
+
+# Bytes buffered while a command waits before reading stops, pipelining clients are not slowed down by it
+MAX_WAITING_BUFFER_BYTES = 1024 * 1024
+# Replies are written once they add up to this many bytes, and the rest of the buffer waits if the client lags behind
+REPLY_FLUSH_BYTES = 256 * 1024
+
+
+class Connection(asyncio.Protocol):
+  '''
+  Serves a client straight from the bytes the event loop receives: every complete command of the
+  receive buffer is parsed in place and run, and the replies of a batch are written with a single
+  call. Connections start with the line protocol, and can switch to length-prefixed binary frames
+  (and back) with the protocol command at any point. Only the commands that have to wait (i.e.
+  PBKDF2, an fsync, a handoff) run in a task, the commands after them stay in the buffer meanwhile.
+  '''
+
+  def __init__(self, router: Router, ctx: Context, pending: bytes = bytes(), adopted: bool = False) -> None:
+    self._router = router
+    self._ctx = ctx
+    self._buffer = bytearray(pending)
+    # Replies of the current batch, the buffer is kept for the lifetime of the connection
+    self._replies = bytearray()
+    self._adopted = adopted
+    # Set by connection_made(), which the event loop calls before any other method
+    self._transport: Transport
+    # Runs a command that has to wait, set until the buffer can be processed again
+    self._waiting: Optional['asyncio.Task[None]'] = None
+    self._reading = True
+    self._writing = True
+    self._drained: Optional['asyncio.Future[None]'] = None
+    self._eof = False
+
+  def connection_made(self, transport: BaseTransport) -> None:
+    self._transport = cast(Transport, transport)
+    self._ctx.transport = self._transport
+    if not self._adopted:
+      logging.info('new client connected')
+      metrics.total_connections += 1
+    metrics.connected_clients += 1
+    if len(self._buffer) > 0:
+      self._process()
+
+  def data_received(self, data: bytes) -> None:
+    metrics.bytes_in += len(data)
+    self._buffer += data
+    if self._waiting is None and self._writing:
+      self._process()
+    elif len(self._buffer) > MAX_WAITING_BUFFER_BYTES:
+      self._throttle()
+
+  def eof_received(self) -> bool:
+    'Keeps the connection open until the commands that were received are answered.'
+    self._eof = True
+    if self._waiting is None:
+      logging.info('client closed connection')
+      return False
+    return True
+
+  def connection_lost(self, exc: Optional[Exception]) -> None:
+    metrics.connected_clients -= 1
+    if self._ctx.database is not None:
+      self._ctx.store.release(db_name=self._ctx.database_name, database=self._ctx.database)
+      self._ctx.database = None
+    if self._ctx.subscriber is not None:
+      self._ctx.store.pubsub.unsubscribe_all(self._ctx.subscriber)
+    if self._drained is not None and not self._drained.done():
+      self._drained.set_result(None)
+
+  def pause_writing(self) -> None:
+    'The client does not read its replies, so its commands are not read either.'
+    self._writing = False
+    self._throttle()
+
+  def resume_writing(self) -> None:
+    self._writing = True
+    self._throttle()
+    if self._drained is not None and not self._drained.done():
+      self._drained.set_result(None)
+    if self._waiting is None:
+      self._process()
+
+  def _throttle(self) -> None:
+    reading = self._writing and self._ctx.hand_off_to is None and (
+        self._waiting is None or len(self._buffer) <= MAX_WAITING_BUFFER_BYTES)
+    if reading != self._reading and not self._transport.is_closing():
+      self._reading = reading
+      if reading:
+        self._transport.resume_reading()
+      else:
+        self._transport.pause_reading()
+
+  def _process(self) -> None:
+    'Runs the buffered commands in order until one has to wait, then writes the replies of those that ran.'
+    ctx = self._ctx
+    buffer = self._buffer
+    position = 0
+    try:
+      while True:
+        # The reply goes out in the protocol the command came in, even if the command switches it
+        protocol = ctx.protocol
+        if protocol is Protocol.line:
+          end = buffer.find(b'\n', position)
+          if end < 0:
+            if len(buffer) - position > MAX_LINE_BYTES:
+              raise LineTooLongError
+            break
+          if end - position > MAX_LINE_BYTES:
+            raise LineTooLongError
+          name, params = parse_line(buffer[position:end])
+          end += 1
+        else:
+          frame = read_frame(buffer, position)
+          if frame is None:
+            break
+          end, name, params = frame
+        result = self._router.execute(ctx, name, params)
+        if ctx.hand_off_to is not None:
+          self._wait(self._hand_off(bytes(buffer[position:])))
+          position = len(buffer)
+          return None
+        position = end
+        if result is True or result is False:
+          self._reply(protocol, result)
+        else:
+          self._wait(self._finish(protocol, result))
+          return None
+        if len(self._replies) >= REPLY_FLUSH_BYTES:
+          if not self._router.synced():
+            self._wait(None)
+            return None
+          self._write()
+          if not self._writing:
+            break
+    except FrameError as err:
+      # The next frame cannot be found, the replies so far are sent before the connection is closed
+      logging.warning(err)
+      position = len(buffer)
+      self._eof = True
+    except CustomException as err:
+      # Neither can the end of a line that is too long, the client gets the error as the reply to it
+      logging.warning(err)
+      metrics.invalid_commands += 1
+      ctx.response = str(err)
+      self._reply(Protocol.line, False)
+      position = len(buffer)
+      self._eof = True
+    finally:
+      del buffer[:position]
+    if len(self._replies) > 0:
+      if self._router.synced():
+        self._write()
+      else:
+        self._wait(None)
+    if self._eof and self._waiting is None:
+      logging.info('client closed connection')
+      self._transport.close()
+
+  def _reply(self, protocol: Protocol, ok: bool) -> None:
+    if protocol is Protocol.line:
+      self._replies += f'{self._ctx.response}\n'.encode(errors='surrogateescape')
+    else:
+      self._replies += encode_reply(ok, self._ctx.response)
+
+  def _write(self) -> None:
+    if len(self._replies) == 0:
+      return None
+    metrics.bytes_out += len(self._replies)
+    if not self._transport.is_closing():
+      self._transport.write(self._replies)
+    # Clearing keeps the allocation, the transport copied what it could not send right away
+    del self._replies[:]
+
+  def _wait(self, pending: Optional[Awaitable[None]]) -> None:
+    'Stops processing the buffer until pending finished, the replies so far are written first once they are durable.'
+    self._waiting = asyncio.get_running_loop().create_task(self._resume(pending))
+
+  async def _resume(self, pending: Optional[Awaitable[None]]) -> None:
+    try:
+      await self._router.sync()
+      self._write()
+      if pending is not None:
+        await pending
+    except Exception as err:
+      # The replies of the buffer cannot be vouched for anymore, the client sees the connection drop instead
+      logging.error(f'closing connection, a waiting command failed: {err}')
+      self._waiting = None
+      self._transport.close()
+      return None
+    self._waiting = None
+    if self._transport.is_closing():
+      return None
+    self._throttle()
+    self._process()
+
+  async def _finish(self, protocol: Protocol, pending: Awaitable[bool]) -> None:
+    self._reply(protocol, await pending)
+
+  async def _hand_off(self, pending: bytes) -> None:
+    'Passes the connection with the commands it did not run yet to the worker owning their database.'
+    self._transport.pause_reading()
+    self._transport.set_write_buffer_limits(high=0)
+    if self._transport.get_write_buffer_size() > 0:
+      self._drained = asyncio.get_running_loop().create_future()
+      await self._drained
+    if self._transport.is_closing():
+      return None
+    await self._router.hand_off(self._ctx, self._transport, pending + bytes(self._buffer))
+    self._buffer.clear()
+
+
+async def adopt(router: Router, sock: socket.socket, username: str, database_name: str, protocol: Protocol,
+                pending: bytes) -> None:
+  'Serves a connection handed over by another worker process, its session continues where it was left.'
+  ctx = router.resume_session(username=username, database_name=database_name, protocol=protocol)
+  await asyncio.get_running_loop().connect_accepted_socket(
+      lambda: Connection(router=router, ctx=ctx, pending=pending, adopted=True), sock=sock)
@@ -1,6 +1,10 @@
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
+from asyncio import WriteTransport
 from model.store import DatabaseName, Store, Username
 from model.database import Database
+from model.framing import Protocol
+from model.pubsub import Subscriber
+from model.route import Route
 from dataclasses import dataclass
 
 
@@ -9,8 +13,26 @@ class Context:
   'A temporary storage for the connected clients to store their state during the lifetime of the connection.'
 
   store: Store
-  response: str = str()
-  username: Username = str()
-  database_name: DatabaseName = str()
+  response: Optional[str] = str()
+  username: Username = Username(str())
+  database_name: DatabaseName = DatabaseName(str())
   database: Optional[Database] = None
   params: Tuple[str, ...] = tuple()
+  protocol: Protocol = Protocol.line
+  # Set when the next command has to run on another worker process of a sharded server
+  hand_off_to: Optional[int] = None
+  # The transport the replies are written to, and the subscriptions of the connection if it has any
+  transport: Optional[WriteTransport] = None
+  subscriber: Optional[Subscriber] = None
+  # The commands queued since multi, and whether one of them was rejected, which makes exec fail
+  transaction: Optional[List[Tuple[Route, Tuple[str, ...]]]] = None
+  transaction_failed: bool = False
+
+  def select(self, database_name: DatabaseName, database: Optional[Database]) -> None:
+    'Switches the selected database, the store counts the connections having a database selected.'
+    if self.database is not None:
+      self.store.release(db_name=self.database_name, database=self.database)
+    if database is not None:
+      self.store.select(db_name=database_name)
+    self.database_name = database_name
+    self.database = database
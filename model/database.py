@@ -1,55 +1,772 @@
-from typing import Dict, NewType
+import re
+import heapq
+import random
+import struct
+import time
+import fnmatch
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NewType, Optional, Tuple, Union
+from config import COMPRESSION, COMPRESSION_CACHE_BYTES, COMPRESSION_MIN_BYTES
+from config import HASH_MAX_FLAT_FIELD_BYTES, HASH_MAX_FLAT_FIELDS, MAXMEMORY_SAMPLES, ORDERED_KEY_INDEX
+from model.compression import COMPRESSED_HEADER, Codec, compress, decompress, original_size
 from model.custom_time import custom_time
-from model.exception import InvalidKeyError
+from model.eviction import EVICTION_POLICY, TRACKS_ACCESS, EvictionPolicy, eviction_score, initial_access, touched
+from model.exception import InvalidCursorError, InvalidFieldError, InvalidIntegerValueError, InvalidKeyError, WrongTypeError
+from model.sorted_keys import SortedKeys
 
 Key = NewType('Key', str)
 Value = NewType('Value', str)
 ExpireAtEpoch = NewType('ExpireAtEpoch', int)
 
+# Number of expired keys deleted between two checks of the sweep deadline
+DEADLINE_CHECK_INTERVAL = 64
+
+# Every value is stored in a single bytes object: the expiration time (0: never),
+# the access field used by the eviction policies, then the utf-8 value. Hashes are stored
+# in a bytearray with the same header, so the type of a key is the type of its slot.
+# Compressed strings are a CompressedSlot, the header is followed by the output of compress().
+SLOT_HEADER = struct.Struct('<qI')
+# Small hashes follow the header with their fields one after the other: the lengths of the
+# field and the value, then the field and the value themselves
+FLAT_FIELD_HEADER = struct.Struct('<II')
+NO_EXPIRATION = 0
+# Estimated bytes of an entry besides its key and value: the hash table slot, the str and bytes
+# object headers, the expiry wheel and sample list slots, measured with tracemalloc on CPython 3.8+
+ENTRY_OVERHEAD = 138
+# Estimated bytes of a field of a large hash besides the field and the value: the hash table slot and two str headers
+HASH_FIELD_OVERHEAD = 140
+# Expired keys found while sampling are always evicted first
+EXPIRED_SCORE = 2**64
+# A scan cursor of the ordered key index is the next key to look at after this marker,
+# so it cannot be mistaken for the '0' that starts and ends a scan
+ORDERED_CURSOR_MARKER = '>'
+# Characters of a glob pattern that end its literal prefix
+GLOB_SPECIAL_CHARACTERS = re.compile(r'[*?\[\\]')
+# Counters are kept in the range of a signed 64-bit integer, like in other key-value stores
+INTEGER = re.compile(r'-?[0-9]+')
+INTEGER_MIN = -2**63
+INTEGER_MAX = 2**63 - 1
+
+
+def expire_at_after(ttl: int) -> ExpireAtEpoch:
+  'Returns the expiration time of a key whose ttl is set right now.'
+  return ExpireAtEpoch(custom_time.time + ttl)
+
+
+def parse_integer(string: str) -> int:
+  'Returns the integer written in the string in decimal. Raises InvalidIntegerValueError if it is not a 64-bit signed integer.'
+  if INTEGER.fullmatch(string) is None:
+    raise InvalidIntegerValueError
+  integer = int(string)
+  if not INTEGER_MIN <= integer <= INTEGER_MAX:
+    raise InvalidIntegerValueError
+  return integer
+
+
+def _decode(slot: bytes) -> Value:
+  return Value(slot[SLOT_HEADER.size:].decode(errors='surrogateescape'))
+
+
+class CompressedSlot(bytes):
+  'The slot of a string whose value is compressed, a bytes object like the slot of any other string.'
+
+
+class HashTable(bytearray):
+  '''
+  The slot of a hash that outgrew the flat encoding: the bytearray holds the header only,
+  the fields are kept in a dict next to it, with their estimated size.
+  '''
+
+  def __init__(self, header: bytes = b'', fields: Optional[Dict[str, str]] = None) -> None:
+    super().__init__(header)
+    self.fields: Dict[str, str] = dict() if fields is None else fields
+    self.fields_size = sum(len(field) + len(value) for field, value in self.fields.items()) + HASH_FIELD_OVERHEAD * len(self.fields)
+
+  def set(self, field: str, value: str) -> bool:
+    'Sets a field and tells whether it is new.'
+    previous = self.fields.get(field)
+    self.fields[field] = value
+    if previous is None:
+      self.fields_size += HASH_FIELD_OVERHEAD + len(field) + len(value)
+      return True
+    self.fields_size += len(value) - len(previous)
+    return False
+
+  def discard(self, field: str) -> bool:
+    'Removes a field and tells whether it existed.'
+    value = self.fields.pop(field, None)
+    if value is None:
+      return False
+    self.fields_size -= HASH_FIELD_OVERHEAD + len(field) + len(value)
+    return True
+
+
+Slot = Union[bytes, bytearray]
+
+
+def _is_string(slot: Slot) -> bool:
+  return type(slot) is bytes or type(slot) is CompressedSlot
+
+
+def _slot_size(slot: Slot) -> int:
+  return len(slot) + slot.fields_size if type(slot) is HashTable else len(slot)
+
+
+def _flat_items(slot: Slot) -> Iterator[Tuple[str, str]]:
+  'Iterates through the fields of a flat encoded hash slot and their values.'
+  offset = SLOT_HEADER.size
+  while offset < len(slot):
+    field_length, value_length = FLAT_FIELD_HEADER.unpack_from(slot, offset)
+    offset += FLAT_FIELD_HEADER.size
+    field = slot[offset:offset + field_length].decode(errors='surrogateescape')
+    offset += field_length
+    yield (field, slot[offset:offset + value_length].decode(errors='surrogateescape'))
+    offset += value_length
+
+
+def _flat_get(slot: Slot, field: str) -> Optional[str]:
+  'Returns the value of a field of a flat encoded hash slot, only the matching value is decoded.'
+  encoded_field = field.encode(errors='surrogateescape')
+  offset = SLOT_HEADER.size
+  while offset < len(slot):
+    field_length, value_length = FLAT_FIELD_HEADER.unpack_from(slot, offset)
+    offset += FLAT_FIELD_HEADER.size
+    if field_length == len(encoded_field) and slot[offset:offset + field_length] == encoded_field:
+      offset += field_length
+      return slot[offset:offset + value_length].decode(errors='surrogateescape')
+    offset += field_length + value_length
+  return None
+
+
+def _encode_hash(header: bytes, fields: Dict[str, str]) -> Slot:
+  'Returns the slot of a hash: flat encoded if it is small enough, a HashTable otherwise.'
+  if len(fields) > HASH_MAX_FLAT_FIELDS:
+    return HashTable(header, fields)
+  slot = bytearray(header)
+  for field, value in fields.items():
+    encoded_field = field.encode(errors='surrogateescape')
+    encoded_value = value.encode(errors='surrogateescape')
+    if len(encoded_field) > HASH_MAX_FLAT_FIELD_BYTES or len(encoded_value) > HASH_MAX_FLAT_FIELD_BYTES:
+      return HashTable(header, fields)
+    slot += FLAT_FIELD_HEADER.pack(len(encoded_field), len(encoded_value))
+    slot += encoded_field
+    slot += encoded_value
+  return slot
+
+
+def _with_header(slot: Slot, expire_at: int, access: int) -> Slot:
+  'Returns the slot with a new header. The bytearray of a hash is changed in place, a string slot is copied.'
+  if type(slot) is bytes:
+    return SLOT_HEADER.pack(expire_at, access) + slot[SLOT_HEADER.size:]
+  if type(slot) is CompressedSlot:
+    return CompressedSlot(SLOT_HEADER.pack(expire_at, access) + slot[SLOT_HEADER.size:])
+  SLOT_HEADER.pack_into(slot, 0, expire_at, access)
+  return slot
+
+
+def _is_live(slot: Slot, now: int) -> bool:
+  'Tells whether the slot has not expired, without touching its access field.'
+  expire_at: int = SLOT_HEADER.unpack_from(slot)[0]
+  return expire_at == NO_EXPIRATION or now <= expire_at
+
+
+class MemoryAccount():
+  'Estimated bytes used by the entries of every database attached to it, i.e. the databases of a store.'
+
+  def __init__(self) -> None:
+    self.used = 0
+
 
 class Database:
-  'Single self-contained storage object that the user can select and manipulate through the handlers.'
+  '''
+  Single self-contained storage object that the user can select and manipulate through the handlers.
+  Each key maps to a compact slot holding the value, its expiration time and access metadata,
+  and the memory used by the entries is accounted for incrementally.
+  '''
 
   def __init__(self) -> None:
-    self._dictionary: Dict[Key, Value] = dict()
-    self._expire_at_epoch_by_keys: Dict[Key, ExpireAtEpoch] = dict()
-
-  def delete_expired_keys(self) -> None:
-    'Iterates through keys that have expiration to call the delete and remove methods on them.'
-    # We create a list from the iterable keys in order to prevent RuntimeError from getting raised,
-    # since we don't care whether the dictionary changes size during iteration.
-    for key in list(self._expire_at_epoch_by_keys.keys()):
-      if custom_time.time > self._expire_at_epoch_by_keys[key]:
-        self.delete(key=key)
-        self.remove_ttl(key=key)
+    self._dictionary: Dict[Key, Slot] = dict()
+    # Keys to draw eviction samples from in O(1), in the order scan walks through them. Deleted keys
+    # are only dropped when the list is compacted, so entries no longer in the dictionary are skipped.
+    self._sample_keys: List[Key] = list()
+    # Entries dropped from the list by every compaction so far, scan cursors are offset by it
+    self._sample_keys_dropped = 0
+    # Keys in order for prefix scans, rebuilt on load instead of being pickled
+    self._ordered_keys: Optional[SortedKeys] = SortedKeys() if ORDERED_KEY_INDEX else None
+    # Keys by the second they expire at, and a min-heap of those seconds. Entries are never removed
+    # when a ttl changes, they are skipped during the sweep if they no longer match the slot.
+    self._expiry_wheel: Dict[int, List[Key]] = dict()
+    self._expiry_seconds: List[int] = list()
+    self._expiry_wheel_entries = 0
+    self._expiring_keys = 0
+    self._evicted_keys = 0
+    self._used_memory = 0
+    self._memory = MemoryAccount()
+    # Called with the keyspace events of the database, set by the store when notifications are enabled
+    self._notify: Optional[Callable[[str, Key], None]] = None
+    # Codec of the values written from now on, None stores them raw
+    self._codec: Optional[Codec] = None if Codec(COMPRESSION) is Codec.none else Codec(COMPRESSION)
+    self._compressed_keys = 0
+    self._compressed_bytes = 0
+    self._uncompressed_bytes = 0
+    self._reset_decompressed()
+
+  def _reset_decompressed(self) -> None:
+    # Values of the compressed slots read lately, least recently read first, dropped when their key changes
+    self._decompressed: 'OrderedDict[Key, Value]' = OrderedDict()
+    self._decompressed_bytes = 0
+    self._decompressed_hits = 0
+    self._decompressed_misses = 0
+
+  def __getstate__(self) -> Dict[str, Any]:
+    state = self.__dict__.copy()
+    del state['_memory']
+    del state['_notify']
+    del state['_ordered_keys']
+    for name in ('_decompressed', '_decompressed_bytes', '_decompressed_hits', '_decompressed_misses'):
+      del state[name]
+    return state
+
+  def __setstate__(self, state: Dict[str, Any]) -> None:
+    'Converts databases pickled before values were stored in slots, or before slots had an access field.'
+    if '_sample_keys' in state:
+      self.__dict__.update(state)
+      self.__dict__.setdefault('_sample_keys_dropped', 0)
+      if '_codec' not in state:
+        self._codec = None if Codec(COMPRESSION) is Codec.none else Codec(COMPRESSION)
+        self._compressed_keys = self._compressed_bytes = self._uncompressed_bytes = 0
+      self._reset_decompressed()
+      self._memory = MemoryAccount()
+      self._notify = None
+      self._ordered_keys = SortedKeys(self._dictionary) if ORDERED_KEY_INDEX else None
+      return None
+    self.__init__()  # type: ignore
+    if '_expire_at_epoch_by_keys' in state:
+      expire_at_epoch_by_keys = state['_expire_at_epoch_by_keys']
+      for key, value in state['_dictionary'].items():
+        self.put(key=key, value=value, expire_at=expire_at_epoch_by_keys.get(key))
+      return None
+    for key, slot in state['_dictionary'].items():
+      expire_at, = struct.unpack_from('<q', slot)
+      self._store(key=key, value=slot[8:].decode(errors='surrogateescape'), expire_at=expire_at)
+
+  def attach(self, memory: MemoryAccount, notify: Optional[Callable[[str, Key], None]] = None) -> None:
+    '''
+    Accounts the memory used by the database to the given account from now on.
+    notify is called with the event and the key whenever a key is written, deleted, expires or is evicted.
+    '''
+    self._memory = memory
+    memory.used += self._used_memory
+    self._notify = notify
+
+  def detach(self) -> None:
+    'Removes the memory used by the database from its account, should be called when it is deleted.'
+    self._memory.used -= self._used_memory
+    self._memory = MemoryAccount()
+    self._notify = None
+
+  @property
+  def used_memory(self) -> int:
+    return self._used_memory
+
+  def __len__(self) -> int:
+    return len(self._dictionary)
+
+  def _store(self, key: Key, value: Value, expire_at: int) -> None:
+    'Stores a value, replacing any previous one, and keeps the indexes and the accounting up to date.'
+    previous = self._dictionary.get(key)
+    if previous is None:
+      self._index_new_key(key=key)
+      access = initial_access()
+    else:
+      self._forget(key=key, slot=previous)
+      previous_expire_at, access = SLOT_HEADER.unpack_from(previous)
+      if TRACKS_ACCESS:
+        access = touched(access)
+      if previous_expire_at == expire_at:
+        # The expiry wheel already holds the key, so rewriting a counter with a ttl adds no entry
+        self._store_slot(key=key, slot=self._encode(value, expire_at, access), index_expiration=False)
+        return None
+    self._store_slot(key=key, slot=self._encode(value, expire_at, access))
+
+  def _encode(self, value: Value, expire_at: int, access: int) -> bytes:
+    'Returns the slot of a string, compressed if it is long enough and compressing it saves space.'
+    encoded = value.encode(errors='surrogateescape')
+    if self._codec is not None and len(encoded) >= COMPRESSION_MIN_BYTES:
+      compressed = compress(self._codec, encoded)
+      if len(compressed) < len(encoded):
+        return CompressedSlot(SLOT_HEADER.pack(expire_at, access) + compressed)
+    return SLOT_HEADER.pack(expire_at, access) + encoded
+
+  def _decompress(self, key: Key, slot: bytes) -> Value:
+    'Returns the value of a compressed slot, the values of the hot keys are kept decompressed.'
+    value = self._decompressed.get(key)
+    if value is not None:
+      self._decompressed.move_to_end(key)
+      self._decompressed_hits += 1
+      return value
+    self._decompressed_misses += 1
+    value = Value(decompress(slot, SLOT_HEADER.size).decode(errors='surrogateescape'))
+    if len(value) <= COMPRESSION_CACHE_BYTES:
+      self._decompressed[key] = value
+      self._decompressed_bytes += len(value)
+      while self._decompressed_bytes > COMPRESSION_CACHE_BYTES:
+        self._decompressed_bytes -= len(self._decompressed.popitem(last=False)[1])
+    return value
+
+  def _value(self, key: Key, slot: bytes) -> Value:
+    return _decode(slot) if type(slot) is bytes else self._decompress(key, slot)
+
+  def _index_new_key(self, key: Key) -> None:
+    self._sample_keys.append(key)
+    if len(self._sample_keys) > 2 * len(self._dictionary) + 1024:
+      self._compact_sample_keys()
+    if self._ordered_keys is not None:
+      self._ordered_keys.add(key)
+
+  def _compact_sample_keys(self) -> None:
+    'Drops the deleted keys from the sample list. Live keys keep their order, they only move towards the front.'
+    self._sample_keys_dropped += len(self._sample_keys) - len(self._dictionary)
+    self._sample_keys = list(self._dictionary)
+
+  def _store_slot(self, key: Key, slot: Slot, index_expiration: bool = True) -> None:
+    self._dictionary[key] = slot
+    size = ENTRY_OVERHEAD + len(key) + _slot_size(slot)
+    self._used_memory += size
+    self._memory.used += size
+    if type(slot) is CompressedSlot:
+      self._compressed_keys += 1
+      self._compressed_bytes += len(slot) - SLOT_HEADER.size
+      self._uncompressed_bytes += original_size(slot, SLOT_HEADER.size)
+    expire_at, _ = SLOT_HEADER.unpack_from(slot)
+    if expire_at != NO_EXPIRATION:
+      self._expiring_keys += 1
+      if index_expiration:
+        self._index_expiration(key=key, expire_at=expire_at)
+
+  def _forget(self, key: Key, slot: Slot) -> None:
+    size = ENTRY_OVERHEAD + len(key) + _slot_size(slot)
+    self._used_memory -= size
+    self._memory.used -= size
+    if type(slot) is CompressedSlot:
+      self._compressed_keys -= 1
+      self._compressed_bytes -= len(slot) - SLOT_HEADER.size
+      self._uncompressed_bytes -= original_size(slot, SLOT_HEADER.size)
+      value = self._decompressed.pop(key, None)
+      if value is not None:
+        self._decompressed_bytes -= len(value)
+    if SLOT_HEADER.unpack_from(slot)[0] != NO_EXPIRATION:
+      self._expiring_keys -= 1
+
+  def _index_expiration(self, key: Key, expire_at: int) -> None:
+    keys = self._expiry_wheel.get(expire_at)
+    if keys is None:
+      keys = self._expiry_wheel[expire_at] = list()
+      heapq.heappush(self._expiry_seconds, expire_at)
+    keys.append(key)
+    self._expiry_wheel_entries += 1
+    # Keys whose ttl keeps being refreshed leave stale entries behind, compact them once they dominate
+    if self._expiry_wheel_entries > 2 * len(self._dictionary) + 1024:
+      self._rebuild_expiry_wheel()
+
+  def _rebuild_expiry_wheel(self) -> None:
+    self._expiry_wheel = dict()
+    for key, slot in self._dictionary.items():
+      expire_at, _ = SLOT_HEADER.unpack_from(slot)
+      if expire_at != NO_EXPIRATION:
+        self._expiry_wheel.setdefault(expire_at, list()).append(key)
+    self._expiry_seconds = list(self._expiry_wheel)
+    heapq.heapify(self._expiry_seconds)
+    self._expiry_wheel_entries = self._expiring_keys
+
+  def _live_slot(self, key: Key, now: Optional[int] = None) -> Optional[Slot]:
+    '''
+    Returns the slot of the key, or None if it does not exist. Expired keys are deleted, so reads
+    never see them between sweeps. The access field is updated for the eviction policy.
+    Expiration is checked at now if it is given, i.e. the execution time of a replayed command.
+    '''
+    slot = self._dictionary.get(key)
+    if slot is None:
+      return None
+    expire_at, access = SLOT_HEADER.unpack_from(slot)
+    if expire_at != NO_EXPIRATION and (custom_time.time if now is None else now) > expire_at:
+      self._remove(key=key)
+      self._event('expired', key)
+      return None
+    if TRACKS_ACCESS:
+      new_access = touched(access)
+      # The slot is only copied when the field changes, at most once a second for LRU
+      if new_access != access:
+        slot = _with_header(slot, expire_at, new_access)
+        self._dictionary[key] = slot
+    return slot
+
+  def _string_slot(self, key: Key, now: Optional[int] = None) -> Optional[bytes]:
+    'Returns the live slot of a key holding a string, or None. Raises WrongTypeError if the key holds a hash.'
+    slot = self._live_slot(key=key, now=now)
+    if slot is not None and not _is_string(slot):
+      raise WrongTypeError
+    return slot  # type: ignore
+
+  def _hash_slot(self, key: Key, now: Optional[int] = None) -> Optional[Slot]:
+    'Returns the live slot of a key holding a hash, or None. Raises WrongTypeError if the key holds a string.'
+    slot = self._live_slot(key=key, now=now)
+    if slot is not None and _is_string(slot):
+      raise WrongTypeError
+    return slot
+
+  def delete_expired_keys(self, deadline: Optional[float] = None, expired: Optional[List[Key]] = None) -> bool:
+    '''
+    Deletes the keys of every second of the expiry wheel that has passed. Only expired entries
+    are touched. Stops early when time.monotonic() passes the deadline, and returns whether
+    every expired key has been deleted. The deleted keys are appended to expired if given.
+    '''
+    now = custom_time.time
+    seconds = self._expiry_seconds
+    deleted = 0
+    while len(seconds) > 0 and now > seconds[0]:
+      keys = self._expiry_wheel[seconds[0]]
+      while len(keys) > 0:
+        key = keys.pop()
+        self._expiry_wheel_entries -= 1
+        slot = self._dictionary.get(key)
+        if slot is not None and SLOT_HEADER.unpack_from(slot)[0] == seconds[0]:
+          self._remove(key=key)
+          self._event('expired', key)
+          if expired is not None:
+            expired.append(key)
+        deleted += 1
+        if deadline is not None and deleted % DEADLINE_CHECK_INTERVAL == 0 and time.monotonic() > deadline:
+          return False
+      del self._expiry_wheel[heapq.heappop(seconds)]
+    return True
 
   def remove_ttl(self, key: Key) -> None:
-    'Removes a key from the expiration tracker dictionary.'
-    self._expire_at_epoch_by_keys.pop(key, None)
+    'Removes the expiration time of a key.'
+    self.set_expire_at(key=key, expire_at=ExpireAtEpoch(NO_EXPIRATION))
 
   def set_ttl(self, key: Key, ttl: int) -> None:
     'Updates or sets the new expiration time for the given key to current time + ttl seconds.'
-    self._expire_at_epoch_by_keys[key] = ExpireAtEpoch(custom_time.time + ttl)
+    self.set_expire_at(key=key, expire_at=expire_at_after(ttl=ttl))
+
+  def set_expire_at(self, key: Key, expire_at: ExpireAtEpoch) -> None:
+    'Updates or sets the expiration time of the given key to an absolute epoch, if the key exists.'
+    slot = self._dictionary.get(key)
+    if slot is None:
+      return None
+    previous_expire_at, access = SLOT_HEADER.unpack_from(slot)
+    if previous_expire_at != expire_at:
+      self._forget(key=key, slot=slot)
+      self._store_slot(key=key, slot=_with_header(slot, expire_at, access))
 
   def get(self, key: Key) -> Value:
     '''
     Returns the value stored under the specified key from the database.
-    If desired key does not exist, then raises InvalidKeyError.
+    If desired key does not exist or has expired, then raises InvalidKeyError.
+    Raises WrongTypeError if the key holds a hash.
     '''
-    if key not in self._dictionary:
+    slot = self._string_slot(key=key)
+    if slot is None:
       raise InvalidKeyError
-    return self._dictionary[key]
+    return _decode(slot) if type(slot) is bytes else self._decompress(key, slot)
 
-  def put(self, key: Key, value: Value) -> None:
-    'Set value under the specified key even if it did not exist earlier.'
-    self._dictionary[key] = value
+  def put(self, key: Key, value: Value, expire_at: Optional[ExpireAtEpoch] = None) -> None:
+    'Set value under the specified key even if it did not exist earlier. The key never expires without an expiration time.'
+    self._store(key=key, value=value, expire_at=NO_EXPIRATION if expire_at is None else expire_at)
+    self._event('set', key)
 
   def delete(self, key: Key) -> None:
     'If key exist in database then it gets deleted, otherwise nothing happens.'
-    self._dictionary.pop(key, None)
+    if self._remove(key=key):
+      self._event('del', key)
+
+  def _remove(self, key: Key) -> bool:
+    'Deletes a key without an event, returns whether it existed.'
+    slot = self._dictionary.pop(key, None)
+    if slot is None:
+      return False
+    self._forget(key=key, slot=slot)
+    if self._ordered_keys is not None:
+      self._ordered_keys.discard(key)
+    return True
 
-  def update(self, key: Key, value: Value) -> None:
+  def _event(self, event: str, key: Key) -> None:
+    if self._notify is not None:
+      self._notify(event, key)
+
+  def update(self, key: Key, value: Value, expire_at: Optional[ExpireAtEpoch] = None) -> None:
     'Set value under the specified key only if it existed before. Raises InvalidKeyError otherwise.'
-    if key not in self._dictionary:
+    if self._live_slot(key=key) is None:
+      raise InvalidKeyError
+    self.put(key=key, value=value, expire_at=expire_at)
+
+  def mget(self, keys: Iterable[Key]) -> List[Optional[Value]]:
+    'Returns the values stored under the specified keys in order, None for the keys that do not exist or hold a hash.'
+    values: List[Optional[Value]] = []
+    for key in keys:
+      slot = self._live_slot(key=key)
+      if type(slot) is bytes:
+        values.append(_decode(slot))
+      elif type(slot) is CompressedSlot:
+        values.append(self._decompress(key, slot))
+      else:
+        values.append(None)
+    return values
+
+  def mput(self, items: Iterable[Tuple[Key, Value]]) -> None:
+    'Sets every key value pair even if the keys did not exist earlier, none of them expires.'
+    for key, value in items:
+      self._store(key=key, value=value, expire_at=NO_EXPIRATION)
+      self._event('set', key)
+
+  def mdelete(self, keys: Iterable[Key]) -> None:
+    'Deletes every specified key that exists in the database, the missing ones are ignored.'
+    for key in keys:
+      self.delete(key=key)
+
+  def incrby(self, key: Key, amount: int, now: Optional[int] = None) -> int:
+    '''
+    Adds amount to the integer stored under the key and returns the result, a missing key counts as 0.
+    The key keeps its expiration time. Raises InvalidIntegerValueError if the value or the result
+    is not a 64-bit signed integer. now is the execution time of a replayed command.
+    '''
+    slot = self._string_slot(key=key, now=now)
+    if slot is None:
+      result = amount
+      expire_at = NO_EXPIRATION
+    else:
+      result = parse_integer(self._value(key, slot)) + amount
+      expire_at, _ = SLOT_HEADER.unpack_from(slot)
+    if not INTEGER_MIN <= result <= INTEGER_MAX:
+      raise InvalidIntegerValueError
+    self._store(key=key, value=Value(str(result)), expire_at=expire_at)
+    self._event('incrby', key)
+    return result
+
+  def append(self, key: Key, suffix: str, now: Optional[int] = None) -> int:
+    '''
+    Appends the suffix to the value stored under the key, or stores it if the key does not exist,
+    and returns the length of the new value. The key keeps its expiration time.
+    now is the execution time of a replayed command.
+    '''
+    slot = self._string_slot(key=key, now=now)
+    if slot is None:
+      value = suffix
+      expire_at = NO_EXPIRATION
+    else:
+      value = self._value(key, slot) + suffix
+      expire_at, _ = SLOT_HEADER.unpack_from(slot)
+    self._store(key=key, value=Value(value), expire_at=expire_at)
+    self._event('append', key)
+    return len(value)
+
+  def getset(self, key: Key, value: Value) -> Optional[Value]:
+    'Sets the value of the key without an expiration time and returns the previous value, None if the key did not exist.'
+    slot = self._string_slot(key=key)
+    previous = None if slot is None else self._value(key, slot)
+    self._store(key=key, value=value, expire_at=NO_EXPIRATION)
+    self._event('set', key)
+    return previous
+
+  def hset(self, key: Key, items: Iterable[Tuple[str, str]], now: Optional[int] = None) -> int:
+    '''
+    Sets the fields of the hash stored under the key, creating it if the key does not exist, and
+    returns the number of new fields. Only the hash is touched, the key keeps its expiration time.
+    Raises WrongTypeError if the key holds a string. now is the execution time of a replayed command.
+    '''
+    slot = self._hash_slot(key=key, now=now)
+    if slot is None:
+      self._index_new_key(key=key)
+      slot = bytearray(SLOT_HEADER.pack(NO_EXPIRATION, initial_access()))
+    else:
+      self._forget(key=key, slot=slot)
+    if type(slot) is HashTable:
+      added = sum(slot.set(field, value) for field, value in items)
+    else:
+      fields = dict(_flat_items(slot))
+      size = len(fields)
+      fields.update(items)
+      added = len(fields) - size
+      slot = _encode_hash(bytes(slot[:SLOT_HEADER.size]), fields)
+    # The header did not change, so the expiry wheel still holds the key if it has a ttl
+    self._store_slot(key=key, slot=slot, index_expiration=False)
+    self._event('hset', key)
+    return added
+
+  def hget(self, key: Key, field: str) -> str:
+    'Returns the value of a field of the hash. Raises InvalidKeyError or InvalidFieldError if either is missing, WrongTypeError for a string.'
+    slot = self._hash_slot(key=key)
+    if slot is None:
       raise InvalidKeyError
-    self._dictionary[key] = value
+    value = slot.fields.get(field) if type(slot) is HashTable else _flat_get(slot, field)
+    if value is None:
+      raise InvalidFieldError
+    return value
+
+  def hmget(self, key: Key, fields: Iterable[str]) -> List[Optional[str]]:
+    'Returns the values of the fields of the hash in order, None for the missing ones. Raises WrongTypeError for a string.'
+    slot = self._hash_slot(key=key)
+    if slot is None:
+      return [None for _ in fields]
+    if type(slot) is HashTable:
+      return [slot.fields.get(field) for field in fields]
+    return [_flat_get(slot, field) for field in fields]
+
+  def hdel(self, key: Key, fields: Iterable[str], now: Optional[int] = None) -> int:
+    '''
+    Removes the fields from the hash and returns how many of them existed. The key is deleted
+    with its last field. Raises WrongTypeError for a string. now is the execution time of a replayed command.
+    '''
+    slot = self._hash_slot(key=key, now=now)
+    if slot is None:
+      return 0
+    self._forget(key=key, slot=slot)
+    if type(slot) is HashTable:
+      removed = sum(slot.discard(field) for field in fields)
+      remaining = len(slot.fields)
+    else:
+      hash_fields = dict(_flat_items(slot))
+      removed = sum(hash_fields.pop(field, None) is not None for field in fields)
+      remaining = len(hash_fields)
+      slot = _encode_hash(bytes(slot[:SLOT_HEADER.size]), hash_fields)
+    self._store_slot(key=key, slot=slot, index_expiration=False)
+    if removed > 0:
+      self._event('hdel', key)
+    if remaining == 0:
+      self.delete(key=key)
+    return removed
+
+  def hgetall(self, key: Key) -> Dict[str, str]:
+    'Returns every field of the hash with its value, an empty dict if the key does not exist. Raises WrongTypeError for a string.'
+    slot = self._hash_slot(key=key)
+    if slot is None:
+      return dict()
+    if type(slot) is HashTable:
+      return dict(slot.fields)
+    return dict(_flat_items(slot))
+
+  def scan(self, cursor: str, pattern: Optional[str] = None, count: int = 10) -> Tuple[str, List[Key]]:
+    '''
+    Looks at the next count keys from the cursor and returns the ones matching the glob pattern,
+    together with the cursor to continue from. A scan starts and ends with the cursor '0'. Every
+    key that exists during the whole scan is returned at least once, keys written or deleted
+    meanwhile may or may not be. Expired keys are skipped. With the ordered key index, keys come
+    in order and a pattern with a literal prefix only looks at the keys starting with it.
+    Raises InvalidCursorError for a cursor that was not returned by a scan of this kind.
+    '''
+    matches = None if pattern is None or pattern == '*' else re.compile(fnmatch.translate(pattern)).match
+    if self._ordered_keys is not None:
+      return self._scan_ordered(cursor=cursor, pattern=pattern, matches=matches, count=count)
+    if not cursor.isdigit():
+      raise InvalidCursorError
+    # Compactions only move keys towards the front, by at most the entries they dropped
+    start = max(0, int(cursor) - self._sample_keys_dropped)
+    end = start + count
+    now = custom_time.time
+    keys: List[Key] = []
+    for key in self._sample_keys[start:end]:
+      slot = self._dictionary.get(key)
+      if slot is not None and _is_live(slot, now) and (matches is None or matches(key)):
+        keys.append(key)
+    next_cursor = '0' if end >= len(self._sample_keys) else str(end + self._sample_keys_dropped)
+    return (next_cursor, keys)
+
+  def _scan_ordered(self, cursor: str, pattern: Optional[str], matches: Optional[Callable[[str], Any]],
+                    count: int) -> Tuple[str, List[Key]]:
+    'Scans the ordered key index, the cursor is the next key to look at, so it survives any change.'
+    prefix = '' if pattern is None else GLOB_SPECIAL_CHARACTERS.split(pattern, maxsplit=1)[0]
+    if cursor == '0':
+      start = prefix
+    elif cursor.startswith(ORDERED_CURSOR_MARKER):
+      start = max(prefix, cursor[len(ORDERED_CURSOR_MARKER):])
+    else:
+      raise InvalidCursorError
+    now = custom_time.time
+    keys: List[Key] = []
+    looked_at = 0
+    for key in self._ordered_keys.irange(start):  # type: ignore
+      if not key.startswith(prefix):
+        break
+      if looked_at == count:
+        return (ORDERED_CURSOR_MARKER + key, keys)
+      looked_at += 1
+      if _is_live(self._dictionary[Key(key)], now) and (matches is None or matches(key)):
+        keys.append(Key(key))
+    return ('0', keys)
+
+  def memory_usage(self, key: Optional[Key] = None) -> int:
+    'Returns the estimated bytes used by the entries of the database, or by a single key. Raises InvalidKeyError for a missing key.'
+    if key is None:
+      return self._used_memory
+    slot = self._live_slot(key=key)
+    if slot is None:
+      raise InvalidKeyError
+    return ENTRY_OVERHEAD + len(key) + _slot_size(slot)
+
+  def set_compression(self, codec: Codec) -> None:
+    'Sets the codec of the values written from now on, the stored values are read whatever codec they were written with.'
+    self._codec = None if codec is Codec.none else codec
+
+  def info(self) -> Dict[str, Any]:
+    '''
+    Returns the number of keys, the number of keys with a ttl, the estimated bytes used by them, the number of
+    evicted keys, the codec, the compressed values with the bytes they take and would take raw, and the hits and
+    misses of the decompressed values.
+    '''
+    return {'keys': len(self._dictionary), 'expiring_keys': self._expiring_keys, 'used_memory': self._used_memory,
+            'evicted_keys': self._evicted_keys, 'compression': Codec.none.value if self._codec is None else self._codec.value,
+            'compressed_keys': self._compressed_keys, 'compressed_bytes': self._compressed_bytes,
+            'uncompressed_bytes': self._uncompressed_bytes,
+            'compression_ratio': round(self._uncompressed_bytes / self._compressed_bytes, 2) if self._compressed_bytes > 0 else 1.0,
+            'decompressed_hits': self._decompressed_hits, 'decompressed_misses': self._decompressed_misses}
+
+  def eviction_candidate(self) -> Optional[Tuple[int, Key]]:
+    '''
+    Returns the key the eviction policy would evict first with its score, higher scores are
+    evicted first. Keys are sampled, so it runs in O(1). Returns None if the policy finds no key.
+    '''
+    if EVICTION_POLICY == EvictionPolicy.noeviction or len(self._dictionary) == 0:
+      return None
+    if EVICTION_POLICY == EvictionPolicy.volatile_ttl:
+      return self._soonest_expiring()
+    now = custom_time.time
+    candidate: Optional[Tuple[int, Key]] = None
+    for key in self._sampled_keys():
+      expire_at, access = SLOT_HEADER.unpack_from(self._dictionary[key])
+      if expire_at != NO_EXPIRATION and now > expire_at:
+        score = EXPIRED_SCORE
+      else:
+        score = eviction_score(access)
+      if candidate is None or score > candidate[0]:
+        candidate = (score, key)
+    return candidate
+
+  def _sampled_keys(self) -> List[Key]:
+    'Returns up to MAXMEMORY_SAMPLES random keys, at least one if the database is not empty.'
+    if len(self._sample_keys) > 2 * len(self._dictionary):
+      # At least every second entry is a live key after this, so drawing a live one takes a few tries
+      self._compact_sample_keys()
+    keys: List[Key] = []
+    while len(keys) == 0:
+      keys = [key for key in random.choices(self._sample_keys, k=MAXMEMORY_SAMPLES) if key in self._dictionary]
+    return keys
+
+  def _soonest_expiring(self) -> Optional[Tuple[int, Key]]:
+    'Returns the key with the nearest expiration time from the expiry wheel, dropping the stale entries on the way.'
+    seconds = self._expiry_seconds
+    while len(seconds) > 0:
+      keys = self._expiry_wheel[seconds[0]]
+      while len(keys) > 0:
+        slot = self._dictionary.get(keys[-1])
+        if slot is not None and SLOT_HEADER.unpack_from(slot)[0] == seconds[0]:
+          return (-seconds[0], keys[-1])
+        keys.pop()
+        self._expiry_wheel_entries -= 1
+      del self._expiry_wheel[heapq.heappop(seconds)]
+    return None
+
+  def evict(self, key: Key) -> None:
+    'Deletes a key chosen by the eviction policy and counts it.'
+    self._remove(key=key)
+    self._evicted_keys += 1
+    self._event('evicted', key)
@@ -0,0 +1,65 @@
+import random
+from enum import Enum, unique
+from config import DB_MAXMEMORY_BYTES, MAXMEMORY_BYTES, MAXMEMORY_POLICY
+from model.custom_time import custom_time
+
+
+@unique
+class EvictionPolicy(Enum):
+  noeviction = 'noeviction'
+  allkeys_lru = 'allkeys-lru'
+  allkeys_lfu = 'allkeys-lfu'
+  allkeys_random = 'allkeys-random'
+  volatile_ttl = 'volatile-ttl'
+
+
+EVICTION_POLICY = EvictionPolicy(MAXMEMORY_POLICY)
+# Reads only update the access field of the keys when a policy is going to look at it
+TRACKS_ACCESS = (EVICTION_POLICY in (EvictionPolicy.allkeys_lru, EvictionPolicy.allkeys_lfu)
+                 and (MAXMEMORY_BYTES > 0 or DB_MAXMEMORY_BYTES > 0))
+
+# The access field is 32 bits. For LRU it holds the time of the last access in seconds, for LFU
+# the time of the last access in minutes (16 bits) and a logarithmic access counter (8 bits).
+ACCESS_MASK = 0xFFFFFFFF
+LFU_TIME_MASK = 0xFFFF
+LFU_MAX_COUNTER = 255
+# New keys start above zero, so they are not evicted before they had a chance to be read
+LFU_INIT_VAL = 5
+# The higher the factor, the more accesses it takes to increment a counter that is already high
+LFU_LOG_FACTOR = 10
+# Counters of keys that are not accessed are decremented once every this many minutes
+LFU_DECAY_MINUTES = 1
+
+
+def initial_access() -> int:
+  'Returns the access field of a key that is written for the first time.'
+  if not TRACKS_ACCESS:
+    return 0
+  if EVICTION_POLICY == EvictionPolicy.allkeys_lfu:
+    return ((custom_time.time // 60) & LFU_TIME_MASK) << 8 | LFU_INIT_VAL
+  return custom_time.time & ACCESS_MASK
+
+
+def touched(access: int) -> int:
+  'Returns the access field of a key after it has been read or overwritten.'
+  if EVICTION_POLICY != EvictionPolicy.allkeys_lfu:
+    return custom_time.time & ACCESS_MASK
+  counter = _lfu_counter(access)
+  # The counter grows logarithmically, hot keys do not saturate it after a few hundred reads
+  if counter < LFU_MAX_COUNTER and random.random() * ((counter - LFU_INIT_VAL) * LFU_LOG_FACTOR + 1) < 1:
+    counter += 1
+  return ((custom_time.time // 60) & LFU_TIME_MASK) << 8 | counter
+
+
+def eviction_score(access: int) -> int:
+  'Returns how good an eviction candidate a key is by its access field, higher scores are evicted first.'
+  if EVICTION_POLICY == EvictionPolicy.allkeys_lfu:
+    return LFU_MAX_COUNTER - _lfu_counter(access)
+  # Idle seconds, the clock wraps around after 136 years
+  return (custom_time.time - access) & ACCESS_MASK
+
+
+def _lfu_counter(access: int) -> int:
+  'Returns the counter of an LFU access field, decremented by the minutes elapsed since the last access.'
+  elapsed_minutes = ((custom_time.time // 60) - (access >> 8)) & LFU_TIME_MASK
+  return max(0, (access & LFU_MAX_COUNTER) - elapsed_minutes // LFU_DECAY_MINUTES)
@@ -15,3 +15,23 @@ NoDbSelectedError = CustomException('no database selected')
 UserUnauthorizedError = CustomException('only root user can do this action')
 InvalidTTLValueError = CustomException('invalid ttl: should be integer')
 CannotDeleteRootUserError = CustomException('cannot delete root user')
+InvalidProtocolError = CustomException('invalid protocol: should be line or binary')
+OutOfMemoryError = CustomException('out of memory: the eviction policy cannot free enough memory')
+InvalidIntegerValueError = CustomException('value is not an integer or out of range')
+InvalidFieldError = CustomException('invalid field')
+WrongTypeError = CustomException('wrong type: the key holds a value of another type')
+SubscribedConnectionError = CustomException('only subscribe, unsubscribe and publish are allowed while subscribed')
+ReservedChannelError = CustomException('keyspace channels can only be published on by the server')
+InvalidCursorError = CustomException('invalid cursor')
+InvalidScanOptionError = CustomException('invalid scan option: should be match <pattern> or count <positive integer>')
+InvalidInfoSectionError = CustomException('invalid section: should be server, clients, stats, memory, latency, persistence, ttl, replication or keyspace')
+ReadOnlyReplicaError = CustomException('read-only replica: send writes to the leader')
+NestedTransactionError = CustomException('multi calls can not be nested')
+ExecWithoutMultiError = CustomException('exec without multi')
+DiscardWithoutMultiError = CustomException('discard without multi')
+TransactionAbortedError = CustomException('transaction discarded because of previous errors')
+NotTransactionalCommandError = CustomException('only commands of the selected database can be queued in a transaction')
+InvalidCodecError = CustomException('invalid codec: should be none, zlib or lzma')
+LineTooLongError = CustomException('line too long: send long commands as binary frames')
+InvalidDbNameError = CustomException('invalid database name: cannot contain __:')
+InternalError = CustomException('internal error: the command failed unexpectedly')
@@ -0,0 +1,77 @@
+import struct
+from enum import Enum, unique
+from typing import List, Optional, Sequence, Tuple
+
+# Request frame: number of args, a length table with one entry per arg, then the args back to back
+ARG_COUNT = struct.Struct('!I')
+ARG_LENGTH = struct.Struct('!I')
+# Reply frame: status byte and payload length followed by the payload itself
+REPLY_HEADER = struct.Struct('!cI')
+OK_STATUS = b'+'
+ERROR_STATUS = b'-'
+# Messages pushed to subscribers carry a request frame as their payload: 'message', the channel and the message
+PUSH_STATUS = b'>'
+
+MAX_ARG_COUNT = 1024 * 1024
+MAX_FRAME_LENGTH = 512 * 1024 * 1024
+
+
+@unique
+class Protocol(Enum):
+  line = 'line'
+  binary = 'binary'
+
+
+class FrameError(Exception):
+  'Raised when the peer sends a frame that cannot be parsed, the stream cannot be resynchronized after this.'
+
+
+def read_frame(buffer: bytearray, offset: int) -> Optional[Tuple[int, bytes, Tuple[str, ...]]]:
+  '''
+  Parses the frame starting at offset straight out of the receive buffer. Returns where the frame
+  ends, the raw name of its route and its decoded params, or None if the frame is incomplete.
+  '''
+  available = len(buffer) - offset
+  if available < ARG_COUNT.size:
+    return None
+  arg_count, = ARG_COUNT.unpack_from(buffer, offset)
+  if arg_count == 0 or arg_count > MAX_ARG_COUNT:
+    raise FrameError(f'invalid number of args: {arg_count}')
+  payload_start = ARG_COUNT.size + arg_count * ARG_LENGTH.size
+  if available < payload_start:
+    return None
+  lengths = struct.unpack_from(f'!{arg_count}I', buffer, offset + ARG_COUNT.size)
+  frame_length = payload_start + sum(lengths)
+  if frame_length > MAX_FRAME_LENGTH:
+    raise FrameError(f'frame too large: {frame_length} bytes')
+  if available < frame_length:
+    return None
+  start = offset + payload_start
+  name = bytes(buffer[start:start + lengths[0]])
+  start += lengths[0]
+  params: List[str] = []
+  with memoryview(buffer) as view:
+    for length in lengths[1:]:
+      params.append(str(view[start:start + length], 'utf-8', 'surrogateescape'))
+      start += length
+  return (offset + frame_length, name, tuple(params))
+
+
+def encode_reply(ok: bool, response: Optional[str]) -> bytes:
+  'Encodes a response into a reply frame, values stored through binary frames round-trip unchanged.'
+  payload = f'{response}'.encode(errors='surrogateescape')
+  return REPLY_HEADER.pack(OK_STATUS if ok else ERROR_STATUS, len(payload)) + payload
+
+
+def encode_frame(args: Sequence[str]) -> bytes:
+  'Encodes args into a request frame.'
+  encoded_args = [arg.encode(errors='surrogateescape') for arg in args]
+  return b''.join([ARG_COUNT.pack(len(encoded_args)),
+                   struct.pack(f'!{len(encoded_args)}I', *[len(arg) for arg in encoded_args]),
+                   *encoded_args])
+
+
+def encode_push(args: Sequence[str]) -> bytes:
+  'Encodes a message pushed to a subscriber into a reply frame whose payload is a request frame of the args.'
+  payload = encode_frame(args)
+  return REPLY_HEADER.pack(PUSH_STATUS, len(payload)) + payload
@@ -0,0 +1,185 @@
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+from model.route import Route
+
+# Durations are recorded in microseconds into log-linear buckets, like in HDR histograms: values below
+# 2**SUB_BUCKET_BITS get a bucket each, larger ones share it with the values whose top SUB_BUCKET_BITS bits
+# are the same, so a bucket is never wider than 1/16 of its values
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_HALF = 1 << (SUB_BUCKET_BITS - 1)
+# Durations of 2**40 microseconds (about 12 days) or more fall into the last bucket
+MAX_BITS = 40
+BUCKETS = (MAX_BITS - SUB_BUCKET_BITS + 2) * SUB_BUCKET_HALF
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+PROMETHEUS_PREFIX = 'in_memo_db'
+
+
+class Histogram():
+  'Counts of durations in log-linear buckets, recording one is a few integer operations.'
+
+  __slots__ = ('counts', 'count', 'total', 'max')
+
+  def __init__(self) -> None:
+    self.counts: List[int] = [0] * BUCKETS
+    self.count = 0
+    self.total = 0
+    self.max = 0
+
+  def record(self, microseconds: int) -> None:
+    shift = microseconds.bit_length() - SUB_BUCKET_BITS
+    index = microseconds if shift <= 0 else shift * SUB_BUCKET_HALF + (microseconds >> shift)
+    self.counts[min(index, BUCKETS - 1)] += 1
+    self.count += 1
+    self.total += microseconds
+    if microseconds > self.max:
+      self.max = microseconds
+
+  def percentile(self, percent: float) -> int:
+    'Returns the highest duration of the bucket holding the given percentile in microseconds, 0 when empty.'
+    rank = max(1, round(self.count * percent / 100))
+    seen = 0
+    for index, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        return min(_bucket_end(index), self.max)
+    return 0
+
+  def summary(self) -> Dict[str, int]:
+    'Returns the number of recorded durations, their mean, percentiles and maximum in microseconds.'
+    summary = {'count': self.count, 'mean_us': self.total // self.count if self.count > 0 else 0}
+    for percent in PERCENTILES:
+      summary[f'p{percent:g}_us'] = self.percentile(percent)
+    summary['max_us'] = self.max
+    return summary
+
+
+def _bucket_end(index: int) -> int:
+  if index < 2 * SUB_BUCKET_HALF:
+    return index
+  shift = index // SUB_BUCKET_HALF - 1
+  return ((index % SUB_BUCKET_HALF + SUB_BUCKET_HALF + 1) << shift) - 1
+
+
+class RouteStats():
+  'Latencies of the successful and failed commands of a route.'
+
+  __slots__ = ('latency', 'errors')
+
+  def __init__(self) -> None:
+    self.latency = Histogram()
+    self.errors = 0
+
+
+class Metrics():
+  '''
+  Counters and histograms of the server process. Everything is updated in place by the code
+  it measures, without locks: the write-ahead log thread only touches its own histograms.
+  '''
+
+  def __init__(self) -> None:
+    self.started_at = time.time()
+    # Set on the workers of a sharded server, every worker reports its own numbers
+    self.worker_id: Optional[int] = None
+    self.routes: Dict[Route, RouteStats] = {route: RouteStats() for route in Route}
+    self.invalid_commands = 0
+    self.connected_clients = 0
+    self.total_connections = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.wal_writes = Histogram()
+    self.wal_fsyncs = Histogram()
+    self.wal_bytes = 0
+    # Bytes of the records written, before the batches were compressed
+    self.wal_record_bytes = 0
+    self.ttl_sweeps = Histogram()
+    # Set when this process is a leader or a replica, returns its replication state
+    self.replication: Optional[Callable[[], Dict[str, Any]]] = None
+
+  def info(self, store_info: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    'Returns every metric by section, together with the memory and keyspace figures of the store.'
+    return {
+        'server': {'pid': os.getpid(), 'worker_id': self.worker_id, 'uptime_s': int(time.time() - self.started_at)},
+        'clients': {'connected_clients': self.connected_clients, 'total_connections': self.total_connections},
+        'stats': {'commands': sum(stats.latency.count for stats in self.routes.values()),
+                  'invalid_commands': self.invalid_commands, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out},
+        'memory': {'used_memory': store_info['used_memory'], 'maxmemory': store_info['maxmemory'],
+                   'databases_on_disk': store_info['databases_on_disk']},
+        'latency': {route.value: {**stats.latency.summary(), 'errors': stats.errors}
+                    for route, stats in self.routes.items() if stats.latency.count > 0},
+        'persistence': {'wal_bytes': self.wal_bytes, 'wal_record_bytes': self.wal_record_bytes, 'wal_writes': self.wal_writes.summary(),
+                        'wal_fsyncs': self.wal_fsyncs.summary()},
+        'ttl': {'sweeps': self.ttl_sweeps.summary()},
+        'replication': {'role': 'none'} if self.replication is None else self.replication(),
+        'keyspace': store_info['databases']
+    }
+
+  def prometheus(self, store_info: Dict[str, Any]) -> str:
+    'Returns every metric in the Prometheus text exposition format.'
+    lines: List[str] = []
+
+    def metric(name: str, kind: str, help_text: str, samples: List[str]) -> None:
+      lines.extend([f'# HELP {PROMETHEUS_PREFIX}_{name} {help_text}', f'# TYPE {PROMETHEUS_PREFIX}_{name} {kind}'])
+      lines.extend(f'{PROMETHEUS_PREFIX}_{sample}' for sample in samples)
+
+    def summary(name: str, histogram: Histogram, labels: str = '') -> List[str]:
+      samples = [f'{name}{{{labels}{"," if labels != "" else ""}quantile="{percent / 100:g}"}} {histogram.percentile(percent) / 1e6}'
+                 for percent in PERCENTILES]
+      label_set = f'{{{labels}}}' if labels != '' else ''
+      return [*samples, f'{name}_sum{label_set} {histogram.total / 1e6}', f'{name}_count{label_set} {histogram.count}']
+
+    used = [(route.value, stats) for route, stats in self.routes.items() if stats.latency.count > 0]
+    metric('commands_total', 'counter', 'Commands run by route.',
+           [f'commands_total{{route="{route}"}} {stats.latency.count}' for route, stats in used])
+    metric('command_errors_total', 'counter', 'Commands that failed by route.',
+           [f'command_errors_total{{route="{route}"}} {stats.errors}' for route, stats in used])
+    metric('command_duration_seconds', 'summary', 'Time spent running commands by route.',
+           [sample for route, stats in used for sample in summary('command_duration_seconds', stats.latency, f'route="{route}"')])
+    metric('invalid_commands_total', 'counter', 'Commands that could not be parsed.', [f'invalid_commands_total {self.invalid_commands}'])
+    metric('connected_clients', 'gauge', 'Open client connections.', [f'connected_clients {self.connected_clients}'])
+    metric('connections_total', 'counter', 'Accepted client connections.', [f'connections_total {self.total_connections}'])
+    metric('received_bytes_total', 'counter', 'Bytes read from clients.', [f'received_bytes_total {self.bytes_in}'])
+    metric('sent_bytes_total', 'counter', 'Bytes written to clients.', [f'sent_bytes_total {self.bytes_out}'])
+    metric('wal_written_bytes_total', 'counter', 'Bytes appended to the write-ahead log.', [f'wal_written_bytes_total {self.wal_bytes}'])
+    metric('wal_record_bytes_total', 'counter', 'Bytes of the records written to the write-ahead log before compression.',
+           [f'wal_record_bytes_total {self.wal_record_bytes}'])
+    metric('wal_write_duration_seconds', 'summary', 'Time spent writing a group commit.', summary('wal_write_duration_seconds', self.wal_writes))
+    metric('wal_fsync_duration_seconds', 'summary', 'Time spent in fsync.', summary('wal_fsync_duration_seconds', self.wal_fsyncs))
+    metric('ttl_sweep_duration_seconds', 'summary', 'Time spent deleting expired keys per sweep.', summary('ttl_sweep_duration_seconds', self.ttl_sweeps))
+    metric('used_memory_bytes', 'gauge', 'Estimated bytes used by the keys and values.', [f'used_memory_bytes {store_info["used_memory"]}'])
+    metric('maxmemory_bytes', 'gauge', 'Memory ceiling of the process, 0 if there is none.', [f'maxmemory_bytes {store_info["maxmemory"]}'])
+    metric('databases_on_disk', 'gauge', 'Databases not loaded into memory yet or spilled to disk.',
+           [f'databases_on_disk {store_info["databases_on_disk"]}'])
+    if self.replication is not None:
+      replication = self.replication()
+      if replication['role'] == 'leader':
+        metric('replication_offset_bytes', 'gauge', 'Bytes streamed to the replicas since the start.',
+               [f'replication_offset_bytes {replication["offset"]}'])
+        metric('replica_lag_bytes', 'gauge', 'Bytes streamed but not acknowledged by replica.',
+               [f'replica_lag_bytes{{replica="{_escape(address)}"}} {replica["lag_bytes"]}'
+                for address, replica in replication['replicas'].items()])
+      else:
+        metric('replication_offset_bytes', 'gauge', 'Bytes of the stream of the leader applied.',
+               [f'replication_offset_bytes {replication["offset"]}'])
+        metric('replication_lag_bytes', 'gauge', 'Bytes the leader streamed but were not applied yet.',
+               [f'replication_lag_bytes {replication["lag_bytes"]}'])
+        metric('replication_lag_seconds', 'gauge', 'Delay of the latest ping of the leader.',
+               [f'replication_lag_seconds {(replication["lag_ms"] or 0) / 1000}'])
+    databases = store_info['databases'].items()
+    metric('keys', 'gauge', 'Keys by database.', [f'keys{{db="{_escape(name)}"}} {info["keys"]}' for name, info in databases])
+    metric('expiring_keys', 'gauge', 'Keys with a ttl by database.',
+           [f'expiring_keys{{db="{_escape(name)}"}} {info["expiring_keys"]}' for name, info in databases])
+    metric('evicted_keys_total', 'counter', 'Keys evicted by database.',
+           [f'evicted_keys_total{{db="{_escape(name)}"}} {info["evicted_keys"]}' for name, info in databases])
+    metric('compressed_bytes', 'gauge', 'Bytes of the compressed values by database.',
+           [f'compressed_bytes{{db="{_escape(name)}"}} {info["compressed_bytes"]}' for name, info in databases])
+    metric('uncompressed_bytes', 'gauge', 'Bytes the compressed values would take raw by database.',
+           [f'uncompressed_bytes{{db="{_escape(name)}"}} {info["uncompressed_bytes"]}' for name, info in databases])
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(label_value: str) -> str:
+  return label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
@@ -1,45 +1,210 @@
 import json
 import os
-from typing import Dict, Generic, Iterator, Tuple, TypeVar, cast
+import logging
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Generic, Iterator, List, Optional, Set, Tuple, TypeVar, cast
 
 K = TypeVar('K', str, int)
-# immutable types only
-V = TypeVar('V', str, Tuple[str, ...])
+# immutable types only, sets are only changed through PersistentSetDictionary
+V = TypeVar('V', str, Tuple[str, ...], Set[str])
+
+# The log is rewritten once it holds this many times more entries than the dictionary
+COMPACTION_RATIO = 2
+COMPACTION_MIN_ENTRIES = 1024
 
 
 class PersistentDictionary(Generic[K, V]):
   '''
   A dict() like object whose properties can be set, deleted,
-  iterated through and read which writes every change into a json file.
+  iterated through and read which appends every change to a json lines file.
+  The file is compacted once most of its entries are overwritten, and the
+  changes made inside a batch() block are written with a single durable write.
+  Entries appended by other processes are picked up by refresh().
   '''
 
   def __init__(self, filepath: str) -> None:
     self._filepath = filepath
     self._dict: Dict[K, V] = dict()
+    self._pending: List[str] = list()
+    self._batch_depth = 0
+    self._entries = 0
+    # The file stays open, so its inode cannot be reused while refresh() compares it
+    self._file: Optional[BinaryIO] = None
+    # Bytes of the file that have been applied to the dict
+    self._offset = 0
     file_exists = os.path.isfile(self._filepath)
     if not file_exists:
-      self._write_file(obj=self._dict)
+      self._compact()
     else:
-      self._dict = self._read_file()
+      self._read_file(truncate_torn=True)
+
+  def _read_file(self, truncate_torn: bool) -> None:
+    self._dict = dict()
+    self._entries = 0
+    self._offset = 0
+    content = self._reopen().read()
+    if content.startswith(b'{'):
+      # Files written before the log format hold a single json object
+      self._dict = {key: self._decode(value) for key, value in json.loads(content).items()}
+      self._compact()
+      return None
+    self._apply_entries(content)
+    if self._offset < len(content) and truncate_torn:
+      # Entries appended after a torn one would be unreadable, so it is cut off
+      logging.warning(f'cutting off torn entry at the end of {self._filepath}')
+      os.truncate(self._filepath, self._offset)
+
+  def _reopen(self) -> BinaryIO:
+    if self._file is not None:
+      self._file.close()
+    self._file = open(self._filepath, 'rb')
+    return self._file
+
+  def _apply_entries(self, content: bytes) -> None:
+    'Applies every complete entry of the content, which is read from the current offset.'
+    start = 0
+    while True:
+      end = content.find(b'\n', start)
+      if end == -1:
+        return None
+      try:
+        entry = json.loads(content[start:end])
+      except ValueError:
+        return None
+      self._apply(entry)
+      self._entries += 1
+      self._offset += end + 1 - start
+      start = end + 1
+
+  def _apply(self, entry: List[Any]) -> None:
+    'Replays a single log entry.'
+    if entry[0] == 'set':
+      self._dict[entry[1]] = self._decode(entry[2])
+    elif entry[0] == 'del':
+      self._dict.pop(entry[1], None)
+
+  def _encode(self, value: V) -> Any:
+    return value
 
-  def _read_file(self) -> Dict[K, V]:
-    with open(self._filepath, 'r') as file:
-      return cast(Dict[K, V], json.load(fp=file))
+  def _decode(self, value: Any) -> V:
+    return cast(V, tuple(value) if isinstance(value, list) else value)
 
-  def _write_file(self, obj: Dict[K, V]) -> None:
-    with open(self._filepath, 'w') as file:
-      json.dump(obj=obj, fp=file)
+  def _log(self, entry: List[Any]) -> None:
+    self._pending.append(json.dumps(entry) + '\n')
+    if self._batch_depth == 0:
+      self._flush()
+
+  def _flush(self) -> None:
+    if len(self._pending) == 0:
+      return None
+    content = ''.join(self._pending).encode()
+    with open(self._filepath, 'ab') as file:
+      file.write(content)
+      file.flush()
+      os.fsync(file.fileno())
+    self._offset += len(content)
+    self._entries += len(self._pending)
+    self._pending.clear()
+    if self._entries > COMPACTION_RATIO * len(self._dict) + COMPACTION_MIN_ENTRIES:
+      self._compact()
+
+  def _compact(self) -> None:
+    'Rewrites the file with a single entry per key, the old file is replaced atomically.'
+    temporary_filepath = f'{self._filepath}.tmp'
+    content = ''.join(json.dumps(['set', key, self._encode(value)]) + '\n' for key, value in self._dict.items()).encode()
+    with open(temporary_filepath, 'wb') as file:
+      file.write(content)
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(temporary_filepath, self._filepath)
+    self._reopen()
+    self._offset = len(content)
+    self._entries = len(self._dict)
+
+  def refresh(self) -> None:
+    '''
+    Applies the entries other processes appended to the file since the last call,
+    or reads it again if it was compacted by one of them. Changes made by this
+    object are never re-applied, as they are already counted in the offset.
+    '''
+    file = cast(BinaryIO, self._file)
+    try:
+      if os.stat(self._filepath).st_ino != os.fstat(file.fileno()).st_ino:
+        self._read_file(truncate_torn=False)
+        return None
+    except FileNotFoundError:
+      return None
+    file.seek(self._offset)
+    self._apply_entries(file.read())
+
+  def close(self) -> None:
+    'Closes the file kept open for refresh(), the dictionary cannot be refreshed afterwards.'
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  @contextmanager
+  def batch(self) -> Iterator[None]:
+    'Collects the changes made inside the block and appends them to the file with a single write.'
+    self._batch_depth += 1
+    try:
+      yield None
+    finally:
+      self._batch_depth -= 1
+      if self._batch_depth == 0:
+        self._flush()
 
   def __getitem__(self, key: K) -> V:
     return self._dict[key]
 
   def __setitem__(self, key: K, value: V) -> None:
     self._dict[key] = value
-    self._write_file(obj=self._dict)
+    self._log(['set', key, self._encode(value)])
 
   def __delitem__(self, key: K) -> None:
     del self._dict[key]
-    self._write_file(obj=self._dict)
+    self._log(['del', key])
+
+  def __contains__(self, key: object) -> bool:
+    return key in self._dict
+
+  def __len__(self) -> int:
+    return len(self._dict)
 
   def __iter__(self) -> Iterator[K]:
     return iter(self._dict)
+
+
+class PersistentSetDictionary(PersistentDictionary[K, Set[str]]):
+  '''
+  A PersistentDictionary of sets, whose members are added and removed
+  one by one, so changing a large set only appends a single entry.
+  '''
+
+  def _apply(self, entry: List[Any]) -> None:
+    if entry[0] == 'add':
+      self._dict.setdefault(entry[1], set()).add(entry[2])
+    elif entry[0] == 'discard':
+      self._dict.get(entry[1], set()).discard(entry[2])
+    else:
+      super()._apply(entry)
+
+  def _encode(self, value: Set[str]) -> Any:
+    return sorted(value)
+
+  def _decode(self, value: Any) -> Set[str]:
+    return set(value)
+
+  def add(self, key: K, member: str) -> None:
+    'Adds a member to the set stored under the key, creating the set if it did not exist.'
+    members = self._dict.setdefault(key, set())
+    if member not in members:
+      members.add(member)
+      self._log(['add', key, member])
+
+  def discard(self, key: K, member: str) -> None:
+    'Removes a member from the set stored under the key if it is there, otherwise nothing happens.'
+    members = self._dict.get(key)
+    if members is not None and member in members:
+      members.discard(member)
+      self._log(['discard', key, member])
@@ -0,0 +1,181 @@
+import re
+import asyncio
+import logging
+from asyncio import WriteTransport
+from enum import Enum, unique
+from typing import Callable, Dict, List, Optional, Set
+from config import PUBSUB_BUFFER_BYTES, PUBSUB_OVERFLOW_POLICY
+from model.framing import Protocol, encode_push
+from model.metrics import metrics
+from model.route import Route
+
+# Keyspace events of a database are published on both channels, formatted with the database name and
+# the key (the message is the event), or with the database name and the event (the message is the key)
+KEYSPACE_CHANNEL = '__keyspace@{}__:{}'
+KEYEVENT_CHANNEL = '__keyevent@{}__:{}'
+# Ends the database name in the channels, database names cannot contain it, so the first one after the @ does
+KEYSPACE_SEPARATOR = '__:'
+# Subscribing to these needs the ownership of the database, and clients cannot publish on them
+KEYSPACE_CHANNEL_PATTERN = re.compile(rf'__key(?:space|event)@(.*?){KEYSPACE_SEPARATOR}')
+# The only routes a connection can run while it has subscriptions
+SUBSCRIBER_ROUTES = frozenset([Route.subscribe, Route.unsubscribe, Route.publish])
+
+# Called with the channel and the message, i.e. to pass a message on to other worker processes
+Relay = Callable[[str, str], None]
+# Called by a database with the event and the key
+Notifier = Callable[[str, str], None]
+
+
+@unique
+class OverflowPolicy(Enum):
+  'What happens to a message for a subscriber whose output buffer is full.'
+  drop = 'drop'
+  disconnect = 'disconnect'
+
+
+OVERFLOW_POLICY = OverflowPolicy(PUBSUB_OVERFLOW_POLICY)
+
+
+class Subscriber():
+  'A subscribed connection: its transport, the protocol its messages are encoded in and its channels.'
+
+  __slots__ = ('transport', 'protocol', 'channels', 'pending', 'pending_bytes', 'dropped')
+
+  def __init__(self, transport: WriteTransport, protocol: Protocol) -> None:
+    self.transport = transport
+    self.protocol = protocol
+    self.channels: Set[str] = set()
+    # Messages delivered during the current step of the event loop, written together at its end
+    self.pending: List[bytes] = []
+    self.pending_bytes = 0
+    # Messages that were not sent because the output buffer was full
+    self.dropped = 0
+
+
+class PubSub():
+  '''
+  Routes published messages to the subscribers of their channel. Messages are encoded once
+  per protocol, and the messages a subscriber gets during a step of the event loop are written
+  into its transport with a single call without awaiting, so publishing never waits for a
+  subscriber. The bytes a subscriber has not read yet are bounded by PUBSUB_BUFFER_BYTES, past
+  that its messages are dropped or it is disconnected, so a slow consumer cannot grow memory.
+  '''
+
+  def __init__(self) -> None:
+    self._subscribers: Dict[str, Set[Subscriber]] = dict()
+    # Set on a sharded server, so subscribers of the other workers get the messages as well
+    self.relay: Optional[Relay] = None
+    # Subscribers with pending messages
+    self._flush_queue: List[Subscriber] = []
+    # Keyspace channels with subscribers in this process. On a sharded server, whether there are any is shared
+    # with the other workers, so keyspace events are only relayed while another worker has subscribers.
+    self._keyspace_channels = 0
+    self.share_keyspace_subscribed: Optional[Callable[[bool], None]] = None
+    self.keyspace_subscribed_elsewhere: Optional[Callable[[], bool]] = None
+
+  def subscribe(self, subscriber: Subscriber, channel: str) -> None:
+    subscribers = self._subscribers.get(channel)
+    if subscribers is None:
+      subscribers = self._subscribers[channel] = set()
+      if keyspace_database(channel) is not None:
+        self._count_keyspace_channels(1)
+    subscribers.add(subscriber)
+    subscriber.channels.add(channel)
+
+  def unsubscribe(self, subscriber: Subscriber, channel: str) -> None:
+    subscribers = self._subscribers.get(channel)
+    if subscribers is not None:
+      subscribers.discard(subscriber)
+      if len(subscribers) == 0:
+        del self._subscribers[channel]
+        if keyspace_database(channel) is not None:
+          self._count_keyspace_channels(-1)
+    subscriber.channels.discard(channel)
+
+  def _count_keyspace_channels(self, change: int) -> None:
+    self._keyspace_channels += change
+    if self.share_keyspace_subscribed is not None:
+      self.share_keyspace_subscribed(self._keyspace_channels > 0)
+
+  def unsubscribe_all(self, subscriber: Subscriber) -> None:
+    'Removes every subscription of a connection, should be called when it is closed.'
+    for channel in list(subscriber.channels):
+      self.unsubscribe(subscriber=subscriber, channel=channel)
+
+  def publish(self, channel: str, message: str) -> int:
+    'Sends a message to the subscribers of the channel, returns the number of subscribers of this process that got it.'
+    if self.relay is not None:
+      self.relay(channel, message)
+    return self.deliver(channel=channel, message=message)
+
+  def deliver(self, channel: str, message: str) -> int:
+    'Sends a message to the subscribers of this process only, returns how many of them got it.'
+    subscribers = self._subscribers.get(channel)
+    if subscribers is None:
+      return 0
+    encoded: Dict[Protocol, bytes] = dict()
+    delivered = 0
+    for subscriber in subscribers:
+      transport = subscriber.transport
+      if transport.is_closing():
+        continue
+      data = encoded.get(subscriber.protocol)
+      if data is None:
+        data = encoded[subscriber.protocol] = _encode_message(subscriber.protocol, channel, message)
+      if transport.get_write_buffer_size() + subscriber.pending_bytes + len(data) > PUBSUB_BUFFER_BYTES:
+        subscriber.dropped += 1
+        if OVERFLOW_POLICY == OverflowPolicy.disconnect:
+          logging.warning(f'disconnecting a subscriber of {channel} that fell {PUBSUB_BUFFER_BYTES} bytes behind')
+          # Unlike close(), abort() frees the buffer right away instead of waiting for the client to read it
+          transport.abort()
+          subscriber.pending.clear()
+          subscriber.pending_bytes = 0
+        continue
+      if len(subscriber.pending) == 0:
+        if len(self._flush_queue) == 0:
+          asyncio.get_running_loop().call_soon(self._flush)
+        self._flush_queue.append(subscriber)
+      subscriber.pending.append(data)
+      subscriber.pending_bytes += len(data)
+      delivered += 1
+    return delivered
+
+  def _flush(self) -> None:
+    for subscriber in self._flush_queue:
+      if len(subscriber.pending) > 0 and not subscriber.transport.is_closing():
+        metrics.bytes_out += subscriber.pending_bytes
+        subscriber.transport.write(b''.join(subscriber.pending))
+      subscriber.pending.clear()
+      subscriber.pending_bytes = 0
+    self._flush_queue.clear()
+
+  def keyspace_notifier(self, db_name: str) -> Notifier:
+    'Returns the function a database calls with its events, which publishes them on the keyspace channels.'
+
+    def notify(event: str, key: str) -> None:
+      # Every write calls this, so nothing is formatted unless a keyspace channel has subscribers in some worker
+      local = self._keyspace_channels > 0
+      relayed = self.keyspace_subscribed_elsewhere is not None and self.keyspace_subscribed_elsewhere()
+      if not local and not relayed:
+        return None
+      keyspace_channel = KEYSPACE_CHANNEL.format(db_name, key)
+      keyevent_channel = KEYEVENT_CHANNEL.format(db_name, event)
+      if relayed and self.relay is not None:
+        self.relay(keyspace_channel, event)
+        self.relay(keyevent_channel, key)
+      if local:
+        self.deliver(channel=keyspace_channel, message=event)
+        self.deliver(channel=keyevent_channel, message=key)
+    return notify
+
+
+def keyspace_database(channel: str) -> Optional[str]:
+  'Returns the name of the database whose events are published on the channel, None for other channels.'
+  match = KEYSPACE_CHANNEL_PATTERN.match(channel)
+  return None if match is None else match.group(1)
+
+
+def _encode_message(protocol: Protocol, channel: str, message: str) -> bytes:
+  if protocol == Protocol.line:
+    return f'message {channel} {message}\n'.encode(errors='surrogateescape')
+  return encode_push(['message', channel, message])
@@ -0,0 +1,180 @@
+import time
+import zlib
+import logging
+from typing import BinaryIO, Callable, Dict, List, cast
+from config import ROOT_USER
+from model.compression import Codec
+from model.database import Database, ExpireAtEpoch, Key, Value
+from model.store import DatabaseName, Store, Username
+from model.write_ahead_log import LEGACY_PAYLOAD_HEADER, PAYLOAD_HEADER, RECORD_HEADER, SEGMENT_MAGIC
+from model.write_ahead_log import decode_batch, decode_payload, is_batch
+
+# Bytes read from a segment at once, records are parsed straight out of this buffer
+RECOVERY_CHUNK_SIZE = 16 * 1024 * 1024
+# Seconds between two progress reports while a long log is replayed
+PROGRESS_INTERVAL = 5.0
+
+# Called with the execution time and the command, whose first item is the route
+Applier = Callable[[int, List[str]], None]
+
+
+class Recovery():
+  '''
+  Replays write-ahead log segments into the store after a crash. Segments are streamed
+  in large chunks, databases are looked up once per name instead of once per record,
+  and expiration times are restored from the execution time saved with each command.
+  '''
+
+  def __init__(self, store: Store) -> None:
+    self._store = store
+    # Keyed by the names as they are in the records
+    self._databases: Dict[str, Database] = dict()
+    self._appliers: Dict[str, Applier] = {
+        'put': self._put,
+        'update': self._put,
+        'delete': self._delete,
+        'mput': self._mput,
+        'mdelete': self._mdelete,
+        'incr': self._incr,
+        'decr': self._decr,
+        'incrby': self._incrby,
+        'append': self._append,
+        'getset': self._getset,
+        'hset': self._hset,
+        'hdel': self._hdel,
+        'create_db': self._create_db,
+        'delete_db': self._delete_db,
+        'exec': self._exec,
+        'set_compression': self._set_compression
+    }
+    self.records = 0
+    self.bytes = 0
+    self.seconds = 0.0
+
+  def replay_segment(self, filepath: str) -> None:
+    'Applies every valid record of a segment in order, then cuts off its torn tail if it has one.'
+    started_at = time.monotonic()
+    with open(filepath, 'rb+') as file:
+      valid_length = self._replay_file(file=file)
+      file.truncate(valid_length)
+    self.seconds += time.monotonic() - started_at
+
+  def _replay_file(self, file: BinaryIO) -> int:
+    'Returns the length of the file up to the end of the last valid record.'
+    header = PAYLOAD_HEADER
+    consumed = 0
+    if file.read(len(SEGMENT_MAGIC)) == SEGMENT_MAGIC:
+      consumed = len(SEGMENT_MAGIC)
+    else:
+      header = LEGACY_PAYLOAD_HEADER
+      file.seek(0)
+    buffer = bytearray()
+    last_report = time.monotonic()
+    while True:
+      chunk = file.read(RECOVERY_CHUNK_SIZE)
+      buffer += chunk
+      position = 0
+      with memoryview(buffer) as view:
+        while len(view) - position >= RECORD_HEADER.size:
+          length, checksum = RECORD_HEADER.unpack_from(view, position)
+          end = position + RECORD_HEADER.size + length
+          if end > len(view):
+            break
+          payload = view[position + RECORD_HEADER.size:end]
+          if zlib.crc32(payload) != checksum:
+            payload.release()
+            logging.warning(f'skipping corrupt record at offset {consumed + position}')
+            return consumed + position
+          if is_batch(payload, header):
+            for exec_time, command in decode_batch(payload, header):
+              self.apply(exec_time=exec_time, command=command)
+              self.records += 1
+            payload.release()
+          else:
+            exec_time, command = decode_payload(payload, header)
+            payload.release()
+            self.apply(exec_time=exec_time, command=command)
+            self.records += 1
+          position = end
+      del buffer[:position]
+      consumed += position
+      self.bytes += position
+      if len(chunk) == 0:
+        if len(buffer) > 0:
+          logging.warning(f'skipping torn record at offset {consumed}')
+        return consumed
+      now = time.monotonic()
+      if now - last_report >= PROGRESS_INTERVAL:
+        logging.info(f'recovery in progress: {self.records} records, {self.bytes / 2**20:.1f} MiB replayed')
+        last_report = now
+
+  def apply(self, exec_time: int, command: List[str]) -> None:
+    'Applies a single command, whose first item is the route.'
+    self._appliers[command[0]](exec_time, command)
+
+  def report(self) -> None:
+    'Logs the number of replayed records, the recovery time and the replay rate.'
+    rate = self.records / self.seconds if self.seconds > 0 else 0.0
+    logging.info(f'recovered {self.records} records ({self.bytes / 2**20:.1f} MiB) '
+                 f'in {self.seconds:.3f}s, {rate:.0f} records/s')
+
+  def _database(self, db_name: str) -> Database:
+    database = self._databases.get(db_name)
+    if database is None:
+      database = self._store.get_database_by_name(username=Username(ROOT_USER), db_name=DatabaseName(db_name))
+      self._databases[db_name] = database
+    return database
+
+  def _put(self, exec_time: int, command: List[str]) -> None:
+    # update only got logged if the key existed, so it is applied as a put without checking expiration
+    expire_at = None if len(command) == 4 else ExpireAtEpoch(exec_time + int(command[4]))
+    self._database(command[1]).put(key=Key(command[2]), value=Value(command[3]), expire_at=expire_at)
+
+  def _delete(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).delete(key=Key(command[2]))
+
+  def _mput(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).mput(items=zip(cast(List[Key], command[2::2]), cast(List[Value], command[3::2])))
+
+  def _mdelete(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).mdelete(keys=cast(List[Key], command[2:]))
+
+  # Expiration is checked at the execution time, so a key that was alive back then keeps its ttl
+  def _incr(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).incrby(key=Key(command[2]), amount=1, now=exec_time)
+
+  def _decr(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).incrby(key=Key(command[2]), amount=-1, now=exec_time)
+
+  def _incrby(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).incrby(key=Key(command[2]), amount=int(command[3]), now=exec_time)
+
+  def _append(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).append(key=Key(command[2]), suffix=command[3], now=exec_time)
+
+  def _getset(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).put(key=Key(command[2]), value=Value(command[3]))
+
+  def _hset(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).hset(key=Key(command[2]), items=zip(command[3::2], command[4::2]), now=exec_time)
+
+  def _hdel(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).hdel(key=Key(command[2]), fields=command[3:], now=exec_time)
+
+  def _exec(self, exec_time: int, command: List[str]) -> None:
+    'A transaction: the length of every record it holds, followed by the record.'
+    position = 1
+    while position < len(command):
+      end = position + 1 + int(command[position])
+      self.apply(exec_time=exec_time, command=command[position + 1:end])
+      position = end
+
+  def _set_compression(self, exec_time: int, command: List[str]) -> None:
+    self._database(command[1]).set_compression(codec=Codec(command[2]))
+
+  def _create_db(self, exec_time: int, command: List[str]) -> None:
+    self._store.create_database(new_db_name=DatabaseName(command[1]), username=Username(ROOT_USER))
+
+  def _delete_db(self, exec_time: int, command: List[str]) -> None:
+    self._databases.pop(command[1], None)
+    self._store.delete_database(db_to_delete=DatabaseName(command[1]), username=Username(ROOT_USER))
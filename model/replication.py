@@ -0,0 +1,346 @@
+import os
+import time
+import pickle
+import zlib
+import asyncio
+import logging
+import secrets
+from asyncio import StreamReader, StreamWriter
+from typing import Any, Dict, List, Optional, Set, Tuple
+from config import REPLICATION_BACKLOG_BYTES, REPLICATION_OUTPUT_LIMIT_BYTES, ROOT_PASSWORD, ROOT_USER
+from constants import REPLICA_SNAPSHOT_FILENAME, REPLICATION_SNAPSHOT_FILENAME
+from model.custom_time import custom_time
+from model.database import Database, Key
+from model.exception import CustomException
+from model.recovery import Recovery
+from model.route import Route
+from model.store import DatabaseName, Store, Username
+from model.write_ahead_log import RECORD_HEADER, decode_payload, encode_record
+
+# The routes a replica serves, every other route changes something the leader owns
+REPLICA_ROUTES = frozenset([Route.protocol, Route.login, Route.login_token, Route.login_with_token, Route.whoami,
+                            Route.select_db, Route.current_db, Route.list_dbs, Route.list_users, Route.get, Route.mget,
+                            Route.hget, Route.hmget, Route.hgetall, Route.scan, Route.memory_usage, Route.db_info,
+                            Route.info, Route.slowlog_get, Route.slowlog_reset, Route.subscribe, Route.unsubscribe,
+                            Route.multi, Route.exec, Route.discard])
+# Changes of users and ownership are not in the write-ahead log, the leader streams them as records of their own
+METADATA_ROUTES = frozenset([Route.register_user, Route.add_user_to_owners, Route.delete_user])
+# Seconds between the pings of a leader (carrying its offset and clock) and the acks of a replica (carrying its offset)
+PING_INTERVAL_S = 1.0
+# Seconds a replica waits before connecting again to a leader it lost
+RETRY_INTERVAL_S = 1.0
+SNAPSHOT_CHUNK_SIZE = 1024 * 1024
+# Longer records mean the stream is out of step, no command comes near it
+MAX_RECORD_LENGTH = 512 * 1024 * 1024
+
+
+async def _read_record(reader: StreamReader) -> Tuple[int, int, List[str]]:
+  'Reads a record of the replication stream, returns its length, the execution time and the command.'
+  length, checksum = RECORD_HEADER.unpack(await reader.readexactly(RECORD_HEADER.size))
+  if length > MAX_RECORD_LENGTH:
+    raise ConnectionError(f'record of {length} bytes in the replication stream')
+  payload = await reader.readexactly(length)
+  if zlib.crc32(payload) != checksum:
+    raise ConnectionError('corrupt record in the replication stream')
+  exec_time, command = decode_payload(payload)
+  return (RECORD_HEADER.size + length, exec_time, command)
+
+
+class ReplicaLink():
+  'A replica connected to the leader: what it was sent and what it acknowledged.'
+
+  def __init__(self, writer: StreamWriter) -> None:
+    self.writer = writer
+    self.address = str(writer.get_extra_info('peername'))
+    # Until its snapshot is sent, the changes for the replica are held here
+    self.syncing = True
+    self.held: List[bytes] = []
+    self.held_bytes = 0
+    self.acked_offset = 0
+    self.acked_at = time.monotonic()
+
+  def send(self, data: bytes) -> None:
+    'Writes without waiting, a replica that falls too far behind is dropped and has to sync again.'
+    if self.writer.transport.is_closing():
+      return None
+    if self.syncing:
+      self.held.append(data)
+      self.held_bytes += len(data)
+      behind = self.held_bytes
+    else:
+      self.writer.write(data)
+      behind = self.writer.transport.get_write_buffer_size()
+    if behind > REPLICATION_OUTPUT_LIMIT_BYTES:
+      logging.warning(f'dropping replica {self.address} that fell {behind} bytes behind')
+      self.writer.transport.abort()
+      self.held.clear()
+
+  def release(self) -> None:
+    'Sends the changes held during the sync, the replica gets every change from now on.'
+    self.syncing = False
+    self.writer.write(b''.join(self.held))
+    self.held.clear()
+    self.held_bytes = 0
+
+
+class Leader():
+  '''
+  Streams the records of every successful change to the connected replicas. The offset counts
+  the bytes of the stream since this process started, which has its own replication id. The
+  latest REPLICATION_BACKLOG_BYTES are kept, so a replica that reconnects with the same id and an
+  offset still in the backlog only gets what it missed, any other gets a snapshot first.
+  '''
+
+  def __init__(self, store: Store) -> None:
+    self._store = store
+    self.replication_id = secrets.token_hex(20)
+    self.offset = 0
+    self._backlog = bytearray()
+    # Offset of the first byte of the backlog
+    self._backlog_offset = 0
+    # Records fed during the current step of the event loop, sent together at its end
+    self._batch = bytearray()
+    self._replicas: Set[ReplicaLink] = set()
+    self._snapshots = 0
+
+  def feed(self, exec_time: int, command: List[str]) -> None:
+    'Adds a change to the stream, it is sent once the current step of the event loop ends.'
+    record = encode_record(exec_time=exec_time, command=command)
+    if len(self._batch) == 0:
+      asyncio.get_running_loop().call_soon(self._flush)
+    self._batch += record
+    self.offset += len(record)
+
+  def feed_deletions(self, db_name: DatabaseName, keys: List[Key]) -> None:
+    'Adds the keys the store of the leader deleted on its own, expired or evicted, to the stream.'
+    self.feed(custom_time.time, [Route.mdelete.value, db_name, *keys])
+
+  def feed_metadata(self, exec_time: int, route: Route, params: Tuple[str, ...]) -> None:
+    'Adds a change of the users or the ownership made by a successful command to the stream.'
+    if route == Route.register_user:
+      self.feed(exec_time, [route.value, params[0], self._store.password_hash(username=Username(params[0]))])
+    elif route == Route.add_user_to_owners:
+      self.feed(exec_time, [route.value, params[0], params[1]])
+    elif route == Route.delete_user:
+      self.feed(exec_time, [route.value, params[0]])
+
+  def _flush(self) -> None:
+    if len(self._batch) == 0:
+      return None
+    batch = bytes(self._batch)
+    self._batch.clear()
+    self._backlog += batch
+    excess = len(self._backlog) - REPLICATION_BACKLOG_BYTES
+    if excess > 0:
+      # Deleting from the front of a bytearray only moves its start
+      del self._backlog[:excess]
+      self._backlog_offset += excess
+    for replica in self._replicas:
+      replica.send(batch)
+
+  async def ping(self) -> None:
+    'Sends the offset and the clock of the leader to every replica periodically, they measure their lag with it.'
+    while True:
+      await asyncio.sleep(PING_INTERVAL_S)
+      self._flush()
+      ping = encode_record(exec_time=0, command=['ping', str(self.offset), str(time.time_ns() // 1_000_000)])
+      for replica in self._replicas:
+        if not replica.syncing:
+          replica.send(ping)
+
+  async def __call__(self, reader: StreamReader, writer: StreamWriter) -> None:
+    'Serves a replica: authenticates it, syncs it up, then reads its acks while it is sent the stream.'
+    replica = ReplicaLink(writer)
+    try:
+      _, _, command = await _read_record(reader)
+      if len(command) != 5 or command[0] != 'sync':
+        raise ConnectionError(f'expected sync, got {command[0]}')
+      _, username, password, replication_id, offset_string = command
+      if username != ROOT_USER or not await self._store.authenticate_user(username=Username(username), password=password):
+        writer.write(encode_record(exec_time=0, command=['error', 'invalid credentials']))
+        raise ConnectionError('invalid credentials')
+      self._flush()
+      offset = int(offset_string)
+      self._replicas.add(replica)
+      if replication_id == self.replication_id and self._backlog_offset <= offset <= self.offset:
+        writer.write(encode_record(exec_time=0, command=['continue', self.replication_id, str(offset)]))
+        writer.write(self._backlog[offset - self._backlog_offset:])
+        replica.release()
+        logging.info(f'replica {replica.address} continues from offset {offset}, {self.offset - offset} bytes behind')
+      else:
+        await self._send_snapshot(replica)
+      while True:
+        _, _, command = await _read_record(reader)
+        if command[0] == 'ack':
+          replica.acked_offset = int(command[1])
+          replica.acked_at = time.monotonic()
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError) as err:
+      logging.warning(f'replica {replica.address} disconnected: {err!r}')
+    finally:
+      self._replicas.discard(replica)
+      writer.close()
+
+  async def _send_snapshot(self, replica: ReplicaLink) -> None:
+    'Sends a snapshot made at the current offset, the changes made meanwhile are held and sent after it.'
+    snapshot_offset = self.offset
+    self._snapshots += 1
+    filename = REPLICATION_SNAPSHOT_FILENAME.format(self._snapshots)
+    started_at = time.monotonic()
+    try:
+      if not await self._store.save_replica_snapshot(filename=filename):
+        raise ConnectionError('making the snapshot failed')
+      size = os.path.getsize(filename)
+      replica.writer.write(encode_record(exec_time=0, command=['full', self.replication_id, str(snapshot_offset), str(size)]))
+      with open(filename, 'rb') as file:
+        await asyncio.get_running_loop().sendfile(replica.writer.transport, file)
+    finally:
+      if os.path.exists(filename):
+        os.remove(filename)
+    replica.release()
+    logging.info(f'replica {replica.address} got a snapshot of {size} bytes at offset {snapshot_offset} '
+                 f'in {time.monotonic() - started_at:.3f}s')
+
+  def info(self) -> Dict[str, Any]:
+    now = time.monotonic()
+    return {'role': 'leader', 'replication_id': self.replication_id, 'offset': self.offset,
+            'backlog_offset': self._backlog_offset, 'backlog_bytes': len(self._backlog),
+            'replicas': {replica.address: {'syncing': replica.syncing, 'acked_offset': replica.acked_offset,
+                                           'lag_bytes': self.offset - replica.acked_offset,
+                                           'ack_age_s': round(now - replica.acked_at, 3)}
+                         for replica in self._replicas}}
+
+
+class Replay(Recovery):
+  '''
+  Applies the stream of a leader: the records of the write-ahead log, the changes of users and
+  ownership, and databases are looked up whoever owns them, like on the leader.
+  '''
+
+  def __init__(self, store: Store) -> None:
+    super().__init__(store=store)
+    self._appliers.update({
+        'create_db': self._create_owned_db,
+        'delete_db': self._drop_db,
+        'register_user': self._register_user,
+        'add_user_to_owners': self._add_user_to_owners,
+        'delete_user': self._delete_user
+    })
+
+  def _database(self, db_name: str) -> Database:
+    # Not cached like during recovery, the store may spill a database between two records
+    return self._store.database(db_name=DatabaseName(db_name))
+
+  def _create_owned_db(self, exec_time: int, command: List[str]) -> None:
+    owner = command[2] if len(command) > 2 else ROOT_USER
+    self._store.create_database(username=Username(owner), new_db_name=DatabaseName(command[1]))
+    self._store.add_user_to_owners(username=Username(ROOT_USER), db_name=DatabaseName(command[1]))
+
+  def _drop_db(self, exec_time: int, command: List[str]) -> None:
+    self._store.drop_database(db_to_delete=DatabaseName(command[1]))
+
+  def _register_user(self, exec_time: int, command: List[str]) -> None:
+    self._store.add_user_with_password_hash(username=Username(command[1]), key_and_salt=command[2])
+
+  def _add_user_to_owners(self, exec_time: int, command: List[str]) -> None:
+    self._store.add_user_to_owners(username=Username(command[1]), db_name=DatabaseName(command[2]))
+
+  def _delete_user(self, exec_time: int, command: List[str]) -> None:
+    self._store.delete_user(user_to_delete=Username(command[1]))
+
+
+class Follower():
+  '''
+  Keeps the store of a read-only replica in sync with a leader. The replication id and offset
+  survive reconnections, so after a short disconnect only the missed part of the stream is sent.
+  '''
+
+  def __init__(self, store: Store, leader: str) -> None:
+    self._store = store
+    self.leader = leader
+    host, _, port = leader.rpartition(':')
+    self._host = host
+    self._port = int(port)
+    self.state = 'connecting'
+    self.replication_id = '?'
+    self.offset = -1
+    self.leader_offset = 0
+    # Time from the leader sending its last ping until it was read, and when anything was read last
+    self.lag_ms: Optional[int] = None
+    self.last_read_at: Optional[float] = None
+    self.full_syncs = 0
+    self.partial_syncs = 0
+    self._replay = Replay(store=store)
+
+  async def run(self) -> None:
+    while True:
+      try:
+        await self._follow()
+      except (OSError, EOFError, ValueError, pickle.UnpicklingError) as err:
+        logging.warning(f'replication from {self.leader} interrupted: {err!r}')
+      self.state = 'connecting'
+      await asyncio.sleep(RETRY_INTERVAL_S)
+
+  async def _follow(self) -> None:
+    reader, writer = await asyncio.open_connection(self._host, self._port)
+    acks: Optional['asyncio.Task[None]'] = None
+    try:
+      writer.write(encode_record(exec_time=0, command=['sync', ROOT_USER, ROOT_PASSWORD, self.replication_id,
+                                                       str(self.offset)]))
+      _, _, reply = await _read_record(reader)
+      if reply[0] == 'full':
+        self.state = 'syncing'
+        await self._load_snapshot(reader, size=int(reply[3]))
+        self.replication_id = reply[1]
+        self.offset = int(reply[2])
+        self.full_syncs += 1
+        logging.info(f'loaded a snapshot of {self.leader} at offset {self.offset}')
+      elif reply[0] == 'continue':
+        self.partial_syncs += 1
+        logging.info(f'continuing replication from {self.leader} at offset {self.offset}')
+      else:
+        raise ConnectionError(f'leader refused to sync: {reply[-1]}')
+      self.state = 'online'
+      acks = asyncio.create_task(self._ack(writer))
+      while True:
+        length, exec_time, command = await _read_record(reader)
+        self.last_read_at = time.monotonic()
+        if command[0] == 'ping':
+          self.leader_offset = int(command[1])
+          self.lag_ms = max(0, time.time_ns() // 1_000_000 - int(command[2]))
+          continue
+        try:
+          self._replay.apply(exec_time=exec_time, command=command)
+        except CustomException as err:
+          logging.warning(f'replicated {command[0]} failed: {err}')
+        self.offset += length
+        self.leader_offset = max(self.leader_offset, self.offset)
+    finally:
+      if acks is not None:
+        acks.cancel()
+      writer.close()
+
+  async def _load_snapshot(self, reader: StreamReader, size: int) -> None:
+    with open(REPLICA_SNAPSHOT_FILENAME, 'wb') as file:
+      remaining = size
+      while remaining > 0:
+        chunk = await reader.read(min(remaining, SNAPSHOT_CHUNK_SIZE))
+        if chunk == b'':
+          raise ConnectionError('leader closed the connection during the snapshot')
+        file.write(chunk)
+        remaining -= len(chunk)
+    self._store.load_replica_snapshot(filename=REPLICA_SNAPSHOT_FILENAME)
+    os.remove(REPLICA_SNAPSHOT_FILENAME)
+    # Databases looked up before the snapshot were replaced
+    self._replay = Replay(store=self._store)
+
+  async def _ack(self, writer: StreamWriter) -> None:
+    while True:
+      writer.write(encode_record(exec_time=0, command=['ack', str(self.offset)]))
+      await asyncio.sleep(PING_INTERVAL_S)
+
+  def info(self) -> Dict[str, Any]:
+    return {'role': 'replica', 'leader': self.leader, 'state': self.state, 'replication_id': self.replication_id,
+            'offset': self.offset, 'leader_offset': self.leader_offset,
+            'lag_bytes': max(0, self.leader_offset - self.offset), 'lag_ms': self.lag_ms,
+            'last_read_s_ago': None if self.last_read_at is None else round(time.monotonic() - self.last_read_at, 3),
+            'full_syncs': self.full_syncs, 'partial_syncs': self.partial_syncs}
@@ -3,7 +3,10 @@ from enum import Enum, unique
 
 @unique
 class Route(Enum):
+  protocol = 'protocol'
   login = 'login'
+  login_token = 'login_token'
+  login_with_token = 'login_with_token'
   whoami = 'whoami'
   register_user = 'register_user'
   add_user_to_owners = 'add_user_to_owners'
@@ -18,3 +21,29 @@ class Route(Enum):
   put = 'put'
   delete = 'delete'
   update = 'update'
+  mget = 'mget'
+  mput = 'mput'
+  mdelete = 'mdelete'
+  memory_usage = 'memory_usage'
+  db_info = 'db_info'
+  scan = 'scan'
+  incr = 'incr'
+  decr = 'decr'
+  incrby = 'incrby'
+  append = 'append'
+  getset = 'getset'
+  hset = 'hset'
+  hget = 'hget'
+  hmget = 'hmget'
+  hdel = 'hdel'
+  hgetall = 'hgetall'
+  subscribe = 'subscribe'
+  unsubscribe = 'unsubscribe'
+  publish = 'publish'
+  info = 'info'
+  slowlog_get = 'slowlog_get'
+  slowlog_reset = 'slowlog_reset'
+  multi = 'multi'
+  exec = 'exec'
+  discard = 'discard'
+  set_compression = 'set_compression'
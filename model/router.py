@@ -1,144 +1,369 @@
 import os
 import logging
-from typing import Callable, Dict, List, Optional, TextIO, Tuple
-from asyncio import StreamReader, StreamWriter
-from config import ROOT_USER
-from constants import SEQUENTIAL_SAVE_FILENAME
+from time import perf_counter_ns
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union, cast
+from asyncio import Transport
+from config import WAL_COMPRESSION, WAL_FSYNC_POLICY, WAL_GROUP_COMMIT_BYTES, WAL_GROUP_COMMIT_MS
+from constants import LEGACY_SEQUENTIAL_SAVE_FILENAME, SEQUENTIAL_SAVE_FILENAME
 from model.context import Context
-from model.database import Database
-from model.exception import CustomException
-from model.store import DatabaseName, Store
+from model.exception import CustomException, InvalidCommandError, NoDbSelectedError, ReadOnlyReplicaError
+from model.exception import SubscribedConnectionError, UserNotLoggedInError, ExecWithoutMultiError
+from model.exception import NotTransactionalCommandError, TransactionAbortedError, InternalError
+from model.framing import Protocol
+from model.store import DatabaseName, Store, Username
 from model.custom_time import custom_time
+from model.compression import Codec
 from model.route import Route
 from handlers import add_user_to_owners, create_db, register_user, current_db, delete, delete_db
 from handlers import get, list_dbs, list_users, login, put, select_db, update, whoami, delete_user
-from model.validator import validate_route
+from handlers import mdelete, mget, mput, protocol, login_token, login_with_token, memory_usage, db_info, scan
+from handlers import incr, decr, incrby, append, getset, hset, hget, hmget, hdel, hgetall, subscribe, unsubscribe, publish, info
+from handlers import slowlog_get, slowlog_reset, multi, discard, set_compression
+from model.validator import MAX_PARAMS, VARIADIC_ROUTES
+from model.write_ahead_log import FsyncPolicy, WriteAheadLog, migrate_legacy_log
+from model.recovery import Recovery
+from model.sharding import Shards
+from model.pubsub import SUBSCRIBER_ROUTES
+from model.metrics import RouteStats, metrics
+from model.slowlog import SLOWER_THAN_US, slowlog
+from model.replication import METADATA_ROUTES, REPLICA_ROUTES, Leader
 
+# Run right away between multi and exec, every other command is queued or rejected
+TRANSACTION_ROUTES = frozenset([Route.multi, Route.exec, Route.discard])
 
-Handler = Callable[[Context], None]
+# Handlers that have to wait for something (i.e. PBKDF2 in a thread) return an awaitable
+Handler = Callable[[Context], Optional[Awaitable[None]]]
+# Builds the write-ahead log record of a successful command from its route, database, params and user
+Recorder = Callable[[str, DatabaseName, Tuple[str, ...], Username], List[str]]
+
+
+def _record_key(name: str, database_name: DatabaseName, params: Tuple[str, ...], username: Username) -> List[str]:
+  return [name, database_name, params[0]]
+
+
+def _record_key_value(name: str, database_name: DatabaseName, params: Tuple[str, ...], username: Username) -> List[str]:
+  'The key, the value and the ttl if there is one.'
+  return [name, database_name, *params[:3]]
+
+
+def _record_params(name: str, database_name: DatabaseName, params: Tuple[str, ...], username: Username) -> List[str]:
+  return [name, database_name, *params]
+
+
+def _record_database(name: str, database_name: DatabaseName, params: Tuple[str, ...], username: Username) -> List[str]:
+  return [name, params[0]]
+
+
+def _record_new_database(name: str, database_name: DatabaseName, params: Tuple[str, ...], username: Username) -> List[str]:
+  'Recovery makes root the owner, a replica needs the user who created it too.'
+  return [name, params[0], username]
+
+
+class Command():
+  '''
+  A route compiled for dispatch: its handler, the session it needs, which are checked against the
+  state of the connection instead of running handlers for it, and how a successful run is logged.
+  '''
+
+  __slots__ = ('route', 'name', 'handler', 'needs_login', 'needs_database', 'makes_room', 'record',
+               'max_params', 'while_subscribed', 'on_replica', 'in_transaction', 'queued', 'stats')
+
+  def __init__(self, route: Route, handler: Handler, needs_login: bool = False, needs_database: bool = False,
+               makes_room: bool = False, record: Optional[Recorder] = None) -> None:
+    self.route = route
+    self.name = route.value
+    self.handler = handler
+    self.needs_login = needs_login or needs_database
+    self.needs_database = needs_database
+    self.makes_room = makes_room
+    self.record = record
+    self.max_params = None if route in VARIADIC_ROUTES else MAX_PARAMS
+    self.while_subscribed = route in SUBSCRIBER_ROUTES
+    self.on_replica = route in REPLICA_ROUTES
+    # Only the commands of the selected database are queued in a transaction, their handlers never wait
+    self.in_transaction = route in TRANSACTION_ROUTES
+    self.queued = needs_database
+    self.stats: RouteStats = metrics.routes[route]
 
 
 class Router():
-  'Stores routes and runs the appropiate handlers when called.'
+  '''
+  Compiles the routes into a dispatch table keyed by the raw names of the commands, and runs the
+  commands the connections parse. The write-ahead log, the replication stream and the handoff
+  to other workers are reached through it.
+  '''
 
-  def __init__(self, store: Store):
+  def __init__(self, store: Store, shards: Optional[Shards] = None):
     self._store: Store = store
-    self._file: Optional[TextIO] = None
-    self._routes: Dict[Route, List[Handler]] = {
-        Route.login: [login],
-        Route.whoami: [whoami],
-        Route.register_user: [register_user],
-        Route.add_user_to_owners: [whoami, add_user_to_owners],
-        Route.create_db: [whoami, create_db],
-        Route.select_db: [whoami, select_db],
-        Route.delete_db: [whoami, delete_db],
-        Route.delete_user: [whoami, delete_user],
-        Route.list_users: [whoami, list_users],
-        Route.list_dbs: [whoami, list_dbs],
-        Route.current_db: [whoami, current_db],
-        Route.get: [whoami, current_db, get],
-        Route.put: [whoami, current_db, put],
-        Route.delete: [whoami, current_db, delete],
-        Route.update: [whoami, current_db, update]
-    }
-
-  async def __call__(self, reader: StreamReader, writer: StreamWriter) -> None:
+    # Set when this process is one of the workers of a sharded server
+    self._shards = shards
+    # Set when replicas follow this process, and on a replica, which only serves reads
+    self.leader: Optional[Leader] = None
+    self.read_only = False
+    self._wal_filename_format = SEQUENTIAL_SAVE_FILENAME if shards is None else shards.wal_filename_format
+    self._wal = WriteAheadLog(filename_format=self._wal_filename_format, fsync_policy=FsyncPolicy(WAL_FSYNC_POLICY),
+                              group_commit_interval=WAL_GROUP_COMMIT_MS / 1000,
+                              group_commit_size=WAL_GROUP_COMMIT_BYTES, codec=Codec(WAL_COMPRESSION))
+    commands = [
+        Command(Route.protocol, protocol),
+        Command(Route.login, login),
+        Command(Route.login_token, login_token, needs_login=True),
+        Command(Route.login_with_token, login_with_token),
+        Command(Route.whoami, whoami),
+        Command(Route.register_user, register_user),
+        Command(Route.add_user_to_owners, add_user_to_owners, needs_login=True),
+        Command(Route.create_db, create_db, needs_login=True, record=_record_new_database),
+        Command(Route.select_db, select_db, needs_login=True),
+        Command(Route.delete_db, delete_db, needs_login=True, record=_record_database),
+        Command(Route.delete_user, delete_user, needs_login=True),
+        Command(Route.list_users, list_users, needs_login=True),
+        Command(Route.list_dbs, list_dbs, needs_login=True),
+        Command(Route.current_db, current_db, needs_login=True),
+        Command(Route.get, get, needs_database=True),
+        Command(Route.put, put, needs_database=True, makes_room=True, record=_record_key_value),
+        Command(Route.delete, delete, needs_database=True, record=_record_key),
+        Command(Route.update, update, needs_database=True, makes_room=True, record=_record_key_value),
+        Command(Route.mget, mget, needs_database=True),
+        Command(Route.mput, mput, needs_database=True, makes_room=True, record=_record_params),
+        Command(Route.mdelete, mdelete, needs_database=True, record=_record_params),
+        Command(Route.memory_usage, memory_usage, needs_database=True),
+        Command(Route.db_info, db_info, needs_database=True),
+        Command(Route.set_compression, set_compression, needs_database=True, record=_record_params),
+        Command(Route.scan, scan, needs_database=True),
+        Command(Route.incr, incr, needs_database=True, makes_room=True, record=_record_params),
+        Command(Route.decr, decr, needs_database=True, makes_room=True, record=_record_params),
+        Command(Route.incrby, incrby, needs_database=True, makes_room=True, record=_record_params),
+        Command(Route.append, append, needs_database=True, makes_room=True, record=_record_params),
+        Command(Route.getset, getset, needs_database=True, makes_room=True, record=_record_params),
+        Command(Route.hset, hset, needs_database=True, makes_room=True, record=_record_params),
+        Command(Route.hget, hget, needs_database=True),
+        Command(Route.hmget, hmget, needs_database=True),
+        Command(Route.hdel, hdel, needs_database=True, record=_record_params),
+        Command(Route.hgetall, hgetall, needs_database=True),
+        Command(Route.subscribe, subscribe, needs_login=True),
+        Command(Route.unsubscribe, unsubscribe, needs_login=True),
+        Command(Route.publish, publish, needs_login=True),
+        Command(Route.info, info, needs_login=True),
+        Command(Route.slowlog_get, slowlog_get, needs_login=True),
+        Command(Route.slowlog_reset, slowlog_reset, needs_login=True),
+        Command(Route.multi, multi, needs_login=True),
+        Command(Route.exec, self._exec, needs_login=True),
+        Command(Route.discard, discard, needs_login=True)
+    ]
+    self._routes: Dict[Route, Command] = {command.route: command for command in commands}
+    self._commands: Dict[bytes, Command] = {command.name.encode(): command for command in commands}
+
+  def resume_session(self, username: str, database_name: str, protocol: Protocol) -> Context:
+    'Returns the context of a connection handed over by another worker process, its session continues where it was left.'
+    shards = cast(Shards, self._shards)
+    ctx = Context(store=self._store, username=Username(username), database_name=DatabaseName(database_name),
+                  protocol=protocol)
+    if ctx.database_name != '' and shards.shard_of(ctx.database_name) == shards.worker_id:
+      try:
+        ctx.select(database_name=ctx.database_name,
+                   database=self._store.get_database_by_name(username=ctx.username, db_name=ctx.database_name))
+      except CustomException:
+        # The database was deleted while the connection was served by another worker
+        ctx.database_name = DatabaseName(str())
+    return ctx
+
+  async def hand_off(self, ctx: Context, transport: Transport, pending: bytes) -> None:
+    'Passes the connection to the worker in ctx.hand_off_to, every reply written so far has to be flushed.'
+    await cast(Shards, self._shards).hand_off(cast(int, ctx.hand_off_to), transport, ctx, pending)
+
+  def synced(self) -> bool:
+    'Tells whether replies can be sent right away, without waiting for the write-ahead log.'
+    return self._wal.synced()
+
+  async def sync(self) -> None:
+    'Waits until the commands run so far are as durable as the fsync policy promises.'
+    await self._wal.sync()
+
+  def execute(self, ctx: Context, name: bytes, params: Tuple[str, ...]) -> Union[bool, Awaitable[bool]]:
     '''
-    Handles the communication between server and client through
-    the read and write streams provided by asyncio.start_server()
-    It parses input line by line and calls the appropriate handlers
-    in order if they where defined for the route provided by the user.
+    Runs a parsed command and leaves the response in the context. Returns whether the command
+    succeeded, or an awaitable of that if a handler has to wait, the next command of the connection
+    only runs after it finished. On a sharded server, commands that belong to another worker only
+    mark the context for a handoff.
     '''
-    logging.info('new client connected')
-    ctx = Context(store=self._store)
-    while True:
-      line = await reader.readline()
-      if reader.at_eof():
-        logging.info('client closed connection')
-        break
+    ctx.response = None
+    started_at = perf_counter_ns()
+    command = self._commands.get(name)
+    if command is None or (command.max_params is not None and len(params) > command.max_params):
+      if ctx.transaction is not None:
+        ctx.transaction_failed = True
+      return _fail(ctx, None, params, InvalidCommandError, started_at)
+    try:
+      # Subscriptions live in this process, so the connection can neither be handed off nor switch protocols
+      if ctx.subscriber is not None and not command.while_subscribed:
+        raise SubscribedConnectionError
+      if self.read_only and not command.on_replica:
+        raise ReadOnlyReplicaError
+      # Neither can the session change or the connection be handed off in the middle of a transaction
+      if ctx.transaction is not None and not command.queued and not command.in_transaction:
+        raise NotTransactionalCommandError
+      if self._shards is not None:
+        worker_id = self._shards.home_of(ctx, command.route, params)
+        if worker_id != self._shards.worker_id:
+          ctx.hand_off_to = worker_id
+          return False
+      if command.needs_login and ctx.username == '':
+        raise UserNotLoggedInError
+      if command.needs_database and ctx.database is None:
+        raise NoDbSelectedError
+      if ctx.transaction is not None and command.queued:
+        ctx.transaction.append((command.route, params))
+        ctx.response = 'queued'
+        return True
+      ctx.params = params
+      if command.makes_room and ctx.database is not None:
+        self._store.make_room(db_name=ctx.database_name, database=ctx.database)
+      pending = command.handler(ctx)
+      if pending is not None:
+        return self._finish(ctx, command, params, pending, started_at)
+      if command.record is not None or self.leader is not None:
+        self._save(command, ctx.database_name, params, ctx.username)
+    except CustomException as err:
+      if ctx.transaction is not None and not command.in_transaction:
+        ctx.transaction_failed = True
+      return _fail(ctx, command, params, err, started_at)
+    except Exception:
+      # A bug in a command fails only that command, the server keeps serving the other clients
+      logging.exception(f'{command.name} failed unexpectedly')
+      return _fail(ctx, command, params, InternalError, started_at)
+    _measure(ctx, command, params, started_at)
+    return True
+
+  async def _finish(self, ctx: Context, command: Command, params: Tuple[str, ...], pending: Awaitable[None],
+                    started_at: int) -> bool:
+    try:
+      await pending
+      self._save(command, ctx.database_name, params, ctx.username)
+    except CustomException as err:
+      return _fail(ctx, command, params, err, started_at)
+    except Exception:
+      logging.exception(f'{command.name} failed unexpectedly')
+      return _fail(ctx, command, params, InternalError, started_at)
+    _measure(ctx, command, params, started_at)
+    return True
+
+  def _exec(self, ctx: Context) -> None:
+    '''
+    Runs the queued commands in a single event loop step, so no other client sees the state in between,
+    and logs the changes as a single record. As in redis, a command failing here (i.e. incr of a value that
+    is not a number) does not stop the others. The response lists the responses of the commands in order.
+    '''
+    if ctx.transaction is None:
+      raise ExecWithoutMultiError
+    queued = ctx.transaction
+    failed = ctx.transaction_failed
+    ctx.transaction = None
+    ctx.transaction_failed = False
+    if failed:
+      raise TransactionAbortedError
+    responses: List[Optional[str]] = list()
+    records: List[List[str]] = list()
+    for route, params in queued:
+      command = self._routes[route]
+      started_at = perf_counter_ns()
+      ctx.response = None
+      ctx.params = params
       try:
-        route, params = validate_route(line)
-        ctx.params = params
-        for handler in self._routes[route]:
-          handler(ctx)
+        if command.makes_room and ctx.database is not None:
+          self._store.make_room(db_name=ctx.database_name, database=ctx.database)
+        command.handler(ctx)
       except CustomException as err:
-        logging.warning(err)
-        ctx.response = str(err)
-      except Exception as err:
-        logging.error(err)
-        print(err)
-        exit(1)
+        _fail(ctx, command, params, err, started_at)
       else:
-        self.save_successful_command(ctx.database_name, route, params)
-      finally:
-        writer.write(f'{ctx.response}\n'.encode())
-        await writer.drain()
-        ctx.response = None
+        if command.record is not None:
+          records.append(command.record(command.name, ctx.database_name, params, ctx.username))
+        _measure(ctx, command, params, started_at)
+      responses.append(ctx.response)
+    if len(records) == 1:
+      self._log(records[0])
+    elif len(records) > 1:
+      self._log([Route.exec.value, *[part for record in records for part in (str(len(record)), *record)]])
+    ctx.response = str(responses)
 
-  def save_successful_command(self, database_name: DatabaseName, route: Route, params: Tuple[str, ...]) -> None:
+  def save_successful_command(self, database_name: DatabaseName, route: Route, params: Tuple[str, ...],
+                              username: Username) -> None:
     '''
     Should be called when command ran successfully. It saves the params,
     route, and database name together with the execution time in order to
-    be able to run these again in case the process dies.
+    be able to run these again in case the process dies. The record is only
+    buffered here, the write-ahead log commits it from its writer thread.
+    The same record, and the changes of users, are streamed to the replicas.
     '''
-    command = None
-    if route == Route.delete:
-      key = params[0]
-      command = [route.value, database_name, key]
-    elif route in [Route.put, Route.update]:
-      key = params[0]
-      value = params[1]
-      command = [route.value, database_name, key, value]
-      try:
-        ttl_string = params[2]
-        command = [*command, ttl_string]
-      except IndexError:
-        pass
-    elif route in [Route.delete_db, Route.create_db]:
-      db_name = params[0]
-      command = [route.value, db_name]
-    if command is not None:
-      if self._file is None:
-        self._file = open(SEQUENTIAL_SAVE_FILENAME, 'a')
-      self._file.write(f'{custom_time.time}\t{" ".join(command)}\n')
-      self._file.flush()
-
-  def load_sequential_save_file(self) -> None:
-    'Load and execute the saved commands when the process did not shut down gracefully.'
-    try:
-      with open(SEQUENTIAL_SAVE_FILENAME, 'r') as file:
-        for line in file:
-          exec_time_str, command_str_with_db_name, = line.rstrip().split('\t')
-          custom_time.time = int(exec_time_str)
-          route_str, *params = command_str_with_db_name.split()
-          route = Route[route_str]
-          if route in [Route.delete, Route.put, Route.update]:
-            db_name, *params = params
-            database: Database = self._store.get_database_by_name(username=ROOT_USER, db_name=db_name)
-            if route == Route.delete:
-              database.delete(key=params[0])
-            elif route == Route.put:
-              database.put(key=params[0], value=params[1])
-            elif route == Route.update:
-              database.update(key=params[0], value=params[1])
-          elif route == Route.create_db:
-            self._store.create_database(new_db_name=params[0], username=ROOT_USER)
-          elif route == Route.delete_db:
-            self._store.delete_database(db_to_delete=params[0], username=ROOT_USER)
-        custom_time.time = None
-        self._store.delete_expired_keys_from_dbs()
-    except FileNotFoundError:
-      logging.info(f'no {SEQUENTIAL_SAVE_FILENAME} file found')
-    else:
-      logging.info(f'loaded {SEQUENTIAL_SAVE_FILENAME}')
-      self.delete_sequential_save_file()
+    self._save(self._routes[route], database_name, params, username)
+
+  def _save(self, command: Command, database_name: DatabaseName, params: Tuple[str, ...], username: Username) -> None:
+    if command.record is not None:
+      self._log(command.record(command.name, database_name, params, username))
+    elif self.leader is not None and command.route in METADATA_ROUTES:
+      self.leader.feed_metadata(exec_time=custom_time.time, route=command.route, params=params)
+
+  def _log(self, record: List[str]) -> None:
+    exec_time = custom_time.time
+    self._wal.append(exec_time=exec_time, command=record)
+    if self.leader is not None:
+      self.leader.feed(exec_time=exec_time, command=record)
+
+  def load_sequential_save_file(self, generation: int) -> None:
+    '''
+    Load and execute the saved commands when the process did not shut down gracefully.
+    Only the segments written after the snapshot of the given generation are replayed.
+    They are kept, so the state survives another crash, only their torn tail is cut off.
+    '''
+    if self._shards is None and os.path.exists(LEGACY_SEQUENTIAL_SAVE_FILENAME):
+      # Left by a crash before the upgrade, it holds the commands after the snapshot, which covers no segment yet
+      converted = migrate_legacy_log(legacy_filepath=LEGACY_SEQUENTIAL_SAVE_FILENAME,
+                                     segment_filepath=self._wal_filename_format.format(generation + 1))
+      logging.info(f'converted {converted} records of {LEGACY_SEQUENTIAL_SAVE_FILENAME}')
+    segments = self._wal.segments()
+    if len(segments) == 0:
+      logging.info(f'no {self._wal_filename_format.format("*")} file found')
+    recovery = Recovery(store=self._store)
+    for segment_generation, filepath in segments:
+      if segment_generation > generation:
+        recovery.replay_segment(filepath=filepath)
+        logging.info(f'loaded {filepath}')
+    recovery.report()
+    self._store.delete_expired_keys_from_dbs()
+    # Segments left behind by a crash right after a snapshot are already covered by it
+    self._wal.delete_segments(up_to=generation)
+    self._wal.start(generation=max([generation, *[segment_generation for segment_generation, _ in segments]]) + 1)
+
+  def rotate_sequential_save_file(self) -> int:
+    'Starts a new segment and returns the generation a snapshot taken right now covers.'
+    return self._wal.rotate()
+
+  def truncate_sequential_save_file(self, generation: int) -> None:
+    'Deletes the segments covered by a snapshot of the given generation.'
+    self._wal.delete_segments(up_to=generation)
+    logging.info(f'deleted segments up to {self._wal_filename_format.format(generation)}')
 
   def delete_sequential_save_file(self) -> None:
-    try:
-      if self._file is not None:
-        self._file.close()
-      os.remove(SEQUENTIAL_SAVE_FILENAME)
-    except OSError:
-      logging.info(f'no {SEQUENTIAL_SAVE_FILENAME} file found')
-    else:
-      logging.info(f'deleted {SEQUENTIAL_SAVE_FILENAME}')
+    self._wal.close()
+    self._wal.delete_segments(up_to=self._wal.generation)
+    logging.info(f'deleted {self._wal_filename_format.format("*")}')
+
+
+def _fail(ctx: Context, command: Optional[Command], params: Tuple[str, ...], err: CustomException,
+          started_at: int) -> bool:
+  logging.warning(err)
+  ctx.response = str(err)
+  if command is None:
+    metrics.invalid_commands += 1
+  else:
+    command.stats.errors += 1
+    _measure(ctx, command, params, started_at)
+  return False
+
+
+def _measure(ctx: Context, command: Command, params: Tuple[str, ...], started_at: int) -> None:
+  'Records how long a command took since it was taken, and logs it if it was slow.'
+  duration_us = (perf_counter_ns() - started_at) // 1000
+  command.stats.latency.record(duration_us)
+  if duration_us >= SLOWER_THAN_US:
+    slowlog.record(duration_us=duration_us, route=command.route, params=params, username=ctx.username,
+                   database_name=ctx.database_name)
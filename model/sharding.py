@@ -0,0 +1,254 @@
+import os
+import glob
+import mmap
+import zlib
+import array
+import socket
+import asyncio
+import logging
+from asyncio import Transport
+from typing import Awaitable, Callable, List, Set, Tuple
+from constants import DBS_FILENAME, HANDOFF_SOCKET_FILENAME, RELAY_SOCKET_FILENAME, SEQUENTIAL_SAVE_FILENAME, SHARD_DBS_FILENAME
+from constants import SHARD_DIRNAME, SHARD_SEQUENTIAL_SAVE_FILENAME
+from model.context import Context
+from model.framing import Protocol
+from model.route import Route
+from model.write_ahead_log import RECORD_HEADER, decode_payload, encode_record
+
+# Session tokens are kept in the memory of the first worker, so every route touching them runs there
+FIRST_WORKER_ROUTES = frozenset([Route.login_token, Route.login_with_token, Route.delete_user])
+# Routes that run on the worker owning the database named by their first param
+NAMED_DATABASE_ROUTES = frozenset([Route.create_db, Route.select_db, Route.delete_db])
+# Routes that run on the worker owning the selected database
+SELECTED_DATABASE_ROUTES = frozenset([Route.get, Route.put, Route.delete, Route.update, Route.mget,
+                                      Route.mput, Route.mdelete, Route.list_users, Route.memory_usage,
+                                      Route.db_info, Route.scan, Route.incr, Route.decr, Route.incrby,
+                                      Route.append, Route.getset, Route.hset, Route.hget, Route.hmget,
+                                      Route.hdel, Route.hgetall, Route.set_compression])
+
+# Published messages are relayed to the other workers in batches of about this many bytes,
+# at least once per step of the event loop
+RELAY_BATCH_BYTES = 64 * 1024
+# and of at most this many messages, so a burst of empty messages does not make a record of countless args
+RELAY_BATCH_MESSAGES = 4096
+# Upper bound of a relayed datagram, larger ones cannot be sent through a unix socket anyway
+RELAY_MAX_DATAGRAM_BYTES = 1024 * 1024
+# Datagrams delivered in one go before other callbacks of the event loop get to run
+RELAY_DATAGRAMS_PER_WAKEUP = 64
+
+# Called with the socket of a connection handed over by another worker, the username, the selected
+# database name and the protocol of its session, and the bytes that were not processed yet
+Adopter = Callable[[socket.socket, str, str, Protocol, bytes], Awaitable[None]]
+
+
+def layout_matches(workers: int) -> bool:
+  'Tells whether the state files on disk were written by a server running the same number of workers.'
+  shards = len(glob.glob(SHARD_DIRNAME.format('*')))
+  if workers == 1:
+    return shards == 0
+  unsharded = os.path.isfile(DBS_FILENAME) or len(glob.glob(SEQUENTIAL_SAVE_FILENAME.format('*'))) > 0
+  return not unsharded and shards in (0, workers)
+
+
+def bind_handoff_sockets(workers: int) -> List[socket.socket]:
+  'Binds the unix socket of every worker before any of them is started, so a handoff never finds its target missing.'
+  listeners: List[socket.socket] = []
+  for worker_id in range(workers):
+    filepath = HANDOFF_SOCKET_FILENAME.format(worker_id)
+    if os.path.exists(filepath):
+      os.remove(filepath)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(filepath)
+    listener.listen()
+    listeners.append(listener)
+  return listeners
+
+
+def bind_relay_sockets(workers: int) -> List[socket.socket]:
+  'Binds the datagram socket of every worker, the messages published on one worker reach the others through them.'
+  sockets: List[socket.socket] = []
+  for worker_id in range(workers):
+    filepath = RELAY_SOCKET_FILENAME.format(worker_id)
+    if os.path.exists(filepath):
+      os.remove(filepath)
+    relay_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    relay_socket.bind(filepath)
+    sockets.append(relay_socket)
+  return sockets
+
+
+def map_keyspace_flags(workers: int) -> mmap.mmap:
+  'Maps a byte per worker telling whether it has subscribers of keyspace channels, shared with the workers forked afterwards.'
+  return mmap.mmap(-1, workers)
+
+
+class Shards():
+  '''
+  A worker process' view of a sharded server. Databases are assigned to the workers by the crc32
+  of their name, each worker keeps its own snapshot and write-ahead log. Every worker accepts
+  connections on the shared port, and a connection is handed over with its session to the worker
+  that owns the database of its next command, so the commands of a connection still run one
+  after the other, and every database is only ever touched by a single process.
+  '''
+
+  def __init__(self, worker_id: int, workers: int, listeners: List[socket.socket],
+               relay_sockets: List[socket.socket], keyspace_flags: mmap.mmap) -> None:
+    self.worker_id = worker_id
+    self.workers = workers
+    self._listener = listeners[worker_id]
+    for listener in listeners:
+      if listener is not self._listener:
+        listener.close()
+    self._relay_socket = relay_sockets[worker_id]
+    for relay_socket in relay_sockets:
+      if relay_socket is not self._relay_socket:
+        relay_socket.close()
+    self._relay_sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self._relay_sender.setblocking(False)
+    # Channels and messages waiting to be relayed, one after the other
+    self._relay_batch: List[str] = []
+    self._relay_batch_bytes = 0
+    # Written by every worker for itself, and read by the others before relaying keyspace events
+    self._keyspace_flags = keyspace_flags
+    # The event loop only keeps weak references to tasks, the adopted connections are served by these
+    self._adopting: Set['asyncio.Task[None]'] = set()
+    os.makedirs(SHARD_DIRNAME.format(worker_id), exist_ok=True)
+    self.dbs_filename = SHARD_DBS_FILENAME.format(worker_id)
+    self.wal_filename_format = SHARD_SEQUENTIAL_SAVE_FILENAME.format(worker_id)
+
+  def shard_of(self, db_name: str) -> int:
+    'Returns the id of the worker owning the database, which does not depend on the hash seed of the process.'
+    return zlib.crc32(db_name.encode(errors='surrogateescape')) % self.workers
+
+  def home_of(self, ctx: Context, route: Route, params: Tuple[str, ...]) -> int:
+    'Returns the id of the worker that has to run the command.'
+    if route in SELECTED_DATABASE_ROUTES and ctx.database_name != '':
+      return self.shard_of(ctx.database_name)
+    if route in NAMED_DATABASE_ROUTES and len(params) > 0:
+      return self.shard_of(params[0])
+    if route in FIRST_WORKER_ROUTES:
+      return 0
+    return self.worker_id
+
+  async def hand_off(self, worker_id: int, transport: Transport, ctx: Context, pending: bytes) -> None:
+    '''
+    Passes the socket of the connection to another worker together with the session and the
+    bytes that were read but not processed yet. The caller stops reading and flushes the replies first.
+    '''
+    record = encode_record(0, [ctx.username, ctx.database_name, ctx.protocol.value,
+                               pending.decode(errors='surrogateescape')])
+    fd = transport.get_extra_info('socket').fileno()
+    try:
+      await asyncio.get_running_loop().run_in_executor(None, _send_handoff, worker_id, fd, record)
+    except OSError as err:
+      logging.error(f'handing off connection to worker {worker_id} failed: {err}')
+    # Closing this process' descriptor leaves the connection open in the other worker
+    transport.close()
+
+  async def serve(self, adopt: Adopter) -> None:
+    'Accepts the connections handed over by the other workers and passes them to adopt.'
+    loop = asyncio.get_running_loop()
+    self._listener.setblocking(False)
+    while True:
+      connection, _ = await loop.sock_accept(self._listener)
+      task = asyncio.create_task(self._adopt(connection, adopt))
+      self._adopting.add(task)
+      task.add_done_callback(self._adopting.discard)
+
+  async def _adopt(self, connection: socket.socket, adopt: Adopter) -> None:
+    try:
+      fd, payload = await asyncio.get_running_loop().run_in_executor(None, _receive_handoff, connection)
+    except (OSError, ValueError) as err:
+      logging.error(f'receiving a connection failed: {err}')
+      return None
+    _, (username, database_name, protocol_name, pending) = decode_payload(payload)
+    await adopt(socket.socket(fileno=fd), username, database_name, Protocol(protocol_name),
+                pending.encode(errors='surrogateescape'))
+
+  def relay(self, channel: str, message: str) -> None:
+    'Queues a published message for the subscribers of the other workers, the batch is sent when the loop gets to it.'
+    if len(self._relay_batch) == 0:
+      asyncio.get_running_loop().call_soon(self._flush_relay)
+    self._relay_batch += [channel, message]
+    self._relay_batch_bytes += len(channel) + len(message)
+    if self._relay_batch_bytes >= RELAY_BATCH_BYTES or len(self._relay_batch) >= 2 * RELAY_BATCH_MESSAGES:
+      self._flush_relay()
+
+  def share_keyspace_subscribed(self, subscribed: bool) -> None:
+    'Tells the other workers whether this one has subscribers of keyspace channels.'
+    self._keyspace_flags[self.worker_id] = int(subscribed)
+
+  def keyspace_subscribed_elsewhere(self) -> bool:
+    'Tells whether another worker has subscribers of keyspace channels, it is asked on every write.'
+    flags = self._keyspace_flags
+    return flags.find(b'\x01', 0, self.worker_id) >= 0 or flags.find(b'\x01', self.worker_id + 1) >= 0
+
+  def _flush_relay(self) -> None:
+    if len(self._relay_batch) == 0:
+      return None
+    datagram = encode_record(0, self._relay_batch)
+    self._relay_batch = []
+    self._relay_batch_bytes = 0
+    for worker_id in range(self.workers):
+      if worker_id == self.worker_id:
+        continue
+      try:
+        # Never blocks: messages to a worker that cannot keep up are dropped, like for a slow subscriber
+        self._relay_sender.sendto(datagram, RELAY_SOCKET_FILENAME.format(worker_id))
+      except OSError as err:
+        logging.warning(f'relaying published messages to worker {worker_id} failed: {err}')
+
+  def receive_relayed(self, deliver: Callable[[str, str], int]) -> None:
+    'Passes the messages published on the other workers to deliver, which sends them to the subscribers of this one.'
+    self._relay_socket.setblocking(False)
+    asyncio.get_running_loop().add_reader(self._relay_socket.fileno(), self._receive_relayed, deliver)
+
+  def _receive_relayed(self, deliver: Callable[[str, str], int]) -> None:
+    for _ in range(RELAY_DATAGRAMS_PER_WAKEUP):
+      try:
+        datagram = self._relay_socket.recv(RELAY_MAX_DATAGRAM_BYTES)
+      except BlockingIOError:
+        return None
+      _, args = decode_payload(memoryview(datagram)[RECORD_HEADER.size:])
+      for channel, message in zip(args[0::2], args[1::2]):
+        deliver(channel, message)
+
+
+def _send_handoff(worker_id: int, fd: int, record: bytes) -> None:
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as handoff_socket:
+    handoff_socket.connect(HANDOFF_SOCKET_FILENAME.format(worker_id))
+    # The descriptor travels with the header, the payload follows as plain bytes
+    handoff_socket.sendmsg([record[:RECORD_HEADER.size]],
+                           [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+    handoff_socket.sendall(record[RECORD_HEADER.size:])
+
+
+def _receive_handoff(connection: socket.socket) -> Tuple[int, bytes]:
+  'Returns the received descriptor and the payload of the record sent with it.'
+  fds = array.array('i')
+  with connection:
+    connection.setblocking(True)
+    header, ancillary_data, _, _ = connection.recvmsg(RECORD_HEADER.size, socket.CMSG_SPACE(fds.itemsize))
+    for level, kind, data in ancillary_data:
+      if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+        fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if len(fds) != 1:
+      raise ValueError(f'expected a single descriptor, got {len(fds)}')
+    header += _receive_exactly(connection, RECORD_HEADER.size - len(header))
+    length, checksum = RECORD_HEADER.unpack(header)
+    payload = _receive_exactly(connection, length)
+  if zlib.crc32(payload) != checksum:
+    os.close(fds[0])
+    raise ValueError('corrupt handoff record')
+  return (fds[0], payload)
+
+
+def _receive_exactly(connection: socket.socket, length: int) -> bytes:
+  chunks: List[bytes] = []
+  while length > 0:
+    chunk = connection.recv(length)
+    if chunk == b'':
+      raise ValueError('handoff connection closed early')
+    chunks.append(chunk)
+    length -= len(chunk)
+  return b''.join(chunks)
@@ -0,0 +1,72 @@
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Tuple
+from config import SLOWLOG_MAX_LEN, SLOWLOG_SLOWER_THAN_US
+from model.route import Route
+
+# Commands taking at least this long are logged, the check is a single comparison for the others
+SLOWER_THAN_US = SLOWLOG_SLOWER_THAN_US if SLOWLOG_MAX_LEN > 0 else float('inf')
+# Params kept of a logged command, and characters kept of every param
+MAX_PARAMS = 8
+MAX_PARAM_LENGTH = 64
+# Positions of the params that are never logged
+SECRET_PARAMS: Dict[Route, Tuple[int, ...]] = {Route.login: (1,), Route.login_with_token: (1,), Route.register_user: (1,)}
+
+
+class SlowCommand():
+  'A command that ran longer than the threshold, with the session it ran in.'
+
+  __slots__ = ('id', 'started_at', 'duration_us', 'route', 'params', 'username', 'database_name')
+
+  def __init__(self, entry_id: int, duration_us: int, route: Route, params: List[str], username: str,
+               database_name: str) -> None:
+    self.id = entry_id
+    self.started_at = int(time.time()) - duration_us // 1_000_000
+    self.duration_us = duration_us
+    self.route = route
+    self.params = params
+    self.username = username
+    self.database_name = database_name
+
+  def to_dict(self) -> Dict[str, Any]:
+    return {'id': self.id, 'started_at': self.started_at, 'duration_us': self.duration_us, 'route': self.route.value,
+            'params': self.params, 'user': self.username, 'database': self.database_name}
+
+
+class SlowLog():
+  '''
+  The last SLOWLOG_MAX_LEN commands that ran for SLOWLOG_SLOWER_THAN_US or longer, the oldest ones
+  are dropped as new ones come. Only the slow commands are copied, so the others cost nothing here.
+  '''
+
+  def __init__(self) -> None:
+    self._entries: Deque[SlowCommand] = deque(maxlen=max(SLOWLOG_MAX_LEN, 0))
+    self._next_id = 0
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def record(self, duration_us: int, route: Route, params: Tuple[str, ...], username: str, database_name: str) -> None:
+    secret = SECRET_PARAMS.get(route, ())
+    kept = [_truncate(param) if index not in secret else '(redacted)' for index, param in enumerate(params[:MAX_PARAMS])]
+    if len(params) > MAX_PARAMS:
+      kept.append(f'... ({len(params) - MAX_PARAMS} more params)')
+    self._entries.append(SlowCommand(entry_id=self._next_id, duration_us=duration_us, route=route, params=kept,
+                                     username=username, database_name=database_name))
+    self._next_id += 1
+
+  def get(self, count: int) -> List[SlowCommand]:
+    'Returns the given number of the latest entries, the latest first.'
+    return [self._entries[-index] for index in range(1, min(count, len(self._entries)) + 1)]
+
+  def reset(self) -> None:
+    self._entries.clear()
+
+
+def _truncate(param: str) -> str:
+  if len(param) <= MAX_PARAM_LENGTH:
+    return param
+  return f'{param[:MAX_PARAM_LENGTH]}... ({len(param) - MAX_PARAM_LENGTH} more characters)'
+
+
+slowlog = SlowLog()
@@ -0,0 +1,183 @@
+import heapq
+import mmap
+import pickle
+import struct
+from array import array
+from itertools import accumulate, islice
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+from model.database import FLAT_FIELD_HEADER, NO_EXPIRATION, SLOT_HEADER, CompressedSlot, Database, HashTable, Key, Slot
+
+# A database section of a snapshot: the keys back to back, the slots back to back, the table of the key
+# lengths, the table of the slot lengths, the kind of every slot, the positions of the keys with a ttl and
+# their expiration times, the rest of the state of the database (counters, codec) pickled, then the trailer.
+# The tables are in the byte order of the machine, snapshots never leave it. The indexes of the database
+# are rebuilt from the tables when it is read, the slots of the keys without a ttl are never looked into.
+SECTION_TRAILER = struct.Struct('<QQQQQ8s')
+SECTION_MAGIC = b'imdbsec1'
+# Keys and slots are encoded and written this many at a time, so a section is written with large
+# sequential writes without a copy of the whole database
+SECTION_CHUNK_KEYS = 65536
+LENGTH_TYPECODE = 'I'
+EXPIRE_AT_TYPECODE = 'q'
+
+# Kinds of slots, a large hash is flat encoded in the section whatever its size
+STRING = 0
+COMPRESSED = 1
+FLAT_HASH = 2
+HASH_TABLE = 3
+SLOT_KINDS: Dict[type, int] = {bytes: STRING, CompressedSlot: COMPRESSED, bytearray: FLAT_HASH, HashTable: HASH_TABLE}
+
+
+def write_database(file: BinaryIO, database: Database) -> None:
+  '''
+  Writes the section of a database at the current position of the file. Besides the chunk being
+  written, only the length tables grow with the number of keys, unlike the memo of a pickle.
+  '''
+  state = database.__getstate__()
+  dictionary: Dict[Key, Slot] = state.pop('_dictionary')
+  # The sample keys are rebuilt in the order of the dictionary, as if they were compacted
+  state['_sample_keys_dropped'] += len(state.pop('_sample_keys')) - len(dictionary)
+  for name in ('_expiry_wheel', '_expiry_seconds', '_expiry_wheel_entries'):
+    del state[name]
+  expiring_positions = array(LENGTH_TYPECODE)
+  expire_ats = array(EXPIRE_AT_TYPECODE)
+  key_lengths = array(LENGTH_TYPECODE)
+  key_bytes = 0
+  keys = iter(dictionary)
+  while True:
+    chunk: List[str] = list(islice(keys, SECTION_CHUNK_KEYS))
+    if len(chunk) == 0:
+      break
+    joined = ''.join(chunk)
+    if joined.isascii():
+      key_lengths.extend(map(len, chunk))
+      encoded = joined.encode('ascii')
+    else:
+      encoded_keys = [key.encode('utf-8', 'surrogateescape') for key in chunk]
+      key_lengths.extend(map(len, encoded_keys))
+      encoded = b''.join(encoded_keys)
+    file.write(encoded)
+    key_bytes += len(encoded)
+  slot_lengths = array(LENGTH_TYPECODE)
+  kinds = bytearray()
+  slot_bytes = 0
+  slots = iter(dictionary.values())
+  while True:
+    slot_chunk: List[Slot] = list(islice(slots, SECTION_CHUNK_KEYS))
+    if len(slot_chunk) == 0:
+      break
+    chunk_kinds = bytes(map(SLOT_KINDS.__getitem__, map(type, slot_chunk)))
+    if HASH_TABLE in chunk_kinds:
+      slot_chunk = [_flat_hash(slot) if type(slot) is HashTable else slot for slot in slot_chunk]
+    if state['_expiring_keys'] > 0:
+      for position, slot in enumerate(slot_chunk, start=len(kinds)):
+        expire_at = SLOT_HEADER.unpack_from(slot)[0]
+        if expire_at != NO_EXPIRATION:
+          expiring_positions.append(position)
+          expire_ats.append(expire_at)
+    kinds += chunk_kinds
+    slot_lengths.extend(map(len, slot_chunk))
+    encoded = b''.join(slot_chunk)
+    file.write(encoded)
+    slot_bytes += len(encoded)
+  encoded_state = pickle.dumps(state)
+  file.write(key_lengths)
+  file.write(slot_lengths)
+  file.write(kinds)
+  file.write(expiring_positions)
+  file.write(expire_ats)
+  file.write(encoded_state)
+  file.write(SECTION_TRAILER.pack(len(dictionary), key_bytes, slot_bytes, len(expire_ats), len(encoded_state),
+                                  SECTION_MAGIC))
+
+
+def read_database(file: BinaryIO, offset: int, length: int) -> Database:
+  '''
+  Reads the database written at offset, a section or a pickle written before sections were. The file
+  is mapped into memory, so keys and slots are copied straight from the page cache without a read buffer.
+  '''
+  with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+    end = offset + length
+    if mapping[end - len(SECTION_MAGIC):end] != SECTION_MAGIC:
+      pickled: Database = pickle.loads(mapping[offset:end])
+      return pickled
+    count, key_bytes, slot_bytes, expiring, state_length, _ = SECTION_TRAILER.unpack_from(
+        mapping, end - SECTION_TRAILER.size)
+    tables_offset = offset + key_bytes + slot_bytes
+    key_lengths = _table(mapping, tables_offset, LENGTH_TYPECODE, count)
+    tables_offset += key_lengths.itemsize * count
+    slot_lengths = _table(mapping, tables_offset, LENGTH_TYPECODE, count)
+    tables_offset += slot_lengths.itemsize * count
+    kinds = mapping[tables_offset:tables_offset + count]
+    tables_offset += count
+    expiring_positions = _table(mapping, tables_offset, LENGTH_TYPECODE, expiring)
+    tables_offset += expiring_positions.itemsize * expiring
+    expire_ats = _table(mapping, tables_offset, EXPIRE_AT_TYPECODE, expiring)
+    tables_offset += expire_ats.itemsize * expiring
+    state = pickle.loads(mapping[tables_offset:tables_offset + state_length])
+    encoded_keys = mapping[offset:offset + key_bytes]
+    decoded_keys = encoded_keys.decode('utf-8', 'surrogateescape')
+    if len(decoded_keys) == key_bytes:
+      # Every byte decoded into a single character, the keys are sliced out of one decoded string
+      keys = [decoded_keys[start:stop] for start, stop in _bounds(key_lengths, 0)]
+    else:
+      keys = [encoded_keys[start:stop].decode('utf-8', 'surrogateescape') for start, stop in _bounds(key_lengths, 0)]
+    del encoded_keys, decoded_keys
+    slots: List[Slot] = [mapping[start:stop] for start, stop in _bounds(slot_lengths, offset + key_bytes)]
+  if kinds.count(STRING) != count:
+    for index, kind in enumerate(kinds):
+      if kind != STRING:
+        slots[index] = _slot(kind, slots[index])
+  expiry_wheel: Dict[int, List[str]] = dict()
+  for position, expire_at in zip(expiring_positions, expire_ats):
+    wheel_keys = expiry_wheel.get(expire_at)
+    if wheel_keys is None:
+      wheel_keys = expiry_wheel[expire_at] = list()
+    wheel_keys.append(keys[position])
+  state['_expiry_wheel'] = expiry_wheel
+  state['_expiry_seconds'] = list(expiry_wheel)
+  heapq.heapify(state['_expiry_seconds'])
+  state['_expiry_wheel_entries'] = expiring
+  state['_dictionary'] = dict(zip(keys, slots))
+  state['_sample_keys'] = keys
+  database: Database = Database.__new__(Database)
+  database.__setstate__(state)
+  return database
+
+
+def _bounds(lengths: 'array[int]', offset: int) -> Iterator[Tuple[int, int]]:
+  'Iterates through the start and the end of every item of a table of lengths, the first one starting at offset.'
+  return zip(accumulate(lengths, initial=offset), islice(accumulate(lengths, initial=offset), 1, None))
+
+
+def _table(mapping: mmap.mmap, offset: int, typecode: str, count: int) -> 'array[int]':
+  table = array(typecode)
+  table.frombytes(mapping[offset:offset + table.itemsize * count])
+  return table
+
+
+def _flat_hash(slot: HashTable) -> bytes:
+  parts = [bytes(slot)]
+  for field, value in slot.fields.items():
+    encoded_field = field.encode('utf-8', 'surrogateescape')
+    encoded_value = value.encode('utf-8', 'surrogateescape')
+    parts += (FLAT_FIELD_HEADER.pack(len(encoded_field), len(encoded_value)), encoded_field, encoded_value)
+  return b''.join(parts)
+
+
+def _slot(kind: int, encoded: Slot) -> Slot:
+  'Returns the slot of a kind other than a plain string.'
+  if kind == COMPRESSED:
+    return CompressedSlot(encoded)
+  if kind == FLAT_HASH:
+    return bytearray(encoded)
+  fields: Dict[str, str] = dict()
+  offset = SLOT_HEADER.size
+  while offset < len(encoded):
+    field_length, value_length = FLAT_FIELD_HEADER.unpack_from(encoded, offset)
+    offset += FLAT_FIELD_HEADER.size
+    field = encoded[offset:offset + field_length].decode('utf-8', 'surrogateescape')
+    offset += field_length
+    fields[field] = encoded[offset:offset + value_length].decode('utf-8', 'surrogateescape')
+    offset += value_length
+  return HashTable(bytes(encoded[:SLOT_HEADER.size]), fields)
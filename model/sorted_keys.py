@@ -0,0 +1,71 @@
+from bisect import bisect_left, insort
+from typing import Iterable, Iterator, List
+
+# Keys per chunk, a chunk is split in two once it grows to twice this size
+CHUNK_SIZE = 512
+
+
+class SortedKeys():
+  '''
+  An ordered set of keys kept in sorted chunks, with the greatest key of every chunk in a separate
+  list. Adding or removing a key bisects that list, then shifts a single chunk, so both cost
+  O(log n + CHUNK_SIZE) instead of moving half of one large sorted list.
+  '''
+
+  def __init__(self, keys: Iterable[str] = ()) -> None:
+    ordered = sorted(keys)
+    self._chunks: List[List[str]] = [ordered[start:start + CHUNK_SIZE] for start in range(0, len(ordered), CHUNK_SIZE)]
+    self._maxes: List[str] = [chunk[-1] for chunk in self._chunks]
+    self._len = len(ordered)
+
+  def __len__(self) -> int:
+    return self._len
+
+  def add(self, key: str) -> None:
+    'Adds a key that is not in the set yet.'
+    if len(self._maxes) == 0:
+      self._chunks.append([key])
+      self._maxes.append(key)
+      self._len += 1
+      return None
+    index = bisect_left(self._maxes, key)
+    if index == len(self._maxes):
+      # Greater than every key, it goes to the end of the last chunk
+      index -= 1
+      chunk = self._chunks[index]
+      chunk.append(key)
+      self._maxes[index] = key
+    else:
+      chunk = self._chunks[index]
+      insort(chunk, key)
+    self._len += 1
+    if len(chunk) >= 2 * CHUNK_SIZE:
+      self._chunks[index:index + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+      self._maxes[index:index + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+  def discard(self, key: str) -> None:
+    'Removes a key if it is in the set, otherwise nothing happens.'
+    index = bisect_left(self._maxes, key)
+    if index == len(self._maxes):
+      return None
+    chunk = self._chunks[index]
+    position = bisect_left(chunk, key)
+    if chunk[position] != key:
+      return None
+    del chunk[position]
+    self._len -= 1
+    if len(chunk) == 0:
+      del self._chunks[index]
+      del self._maxes[index]
+    elif position == len(chunk):
+      self._maxes[index] = chunk[-1]
+
+  def irange(self, start: str) -> Iterator[str]:
+    'Iterates through the keys greater than or equal to start in order. The set must not change meanwhile.'
+    index = bisect_left(self._maxes, start)
+    if index == len(self._maxes):
+      return None
+    chunk = self._chunks[index]
+    yield from chunk[bisect_left(chunk, start):]
+    for chunk in self._chunks[index + 1:]:
+      yield from chunk
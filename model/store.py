@@ -1,96 +1,328 @@
 import os
+import time
+import signal
+import struct
+import tempfile
+import asyncio
+import hmac
 import hashlib
+import secrets
 import pickle
+import random
 import logging
-from typing import Dict, List, NewType, Tuple
-from config import PBKDF2_HMAC_ITERATIONS, ROOT_PASSWORD, ROOT_USER
-from model.database import Database
-from model.persistent_dictionary import PersistentDictionary
-from constants import DBS_OF_USERS_JSON_FILENAME, DBS_FILENAME, USERS_JSON_FILENAME, USERS_OF_DBS_JSON_FILENAME
-from model.exception import DbAlreadyExistsError, DbNotExistError, UserNotExistError, UsernameAlreadyTakenError
+import fcntl
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, NewType, Optional, TextIO, Tuple
+from config import DB_MAXMEMORY_BYTES, KDF_THREADS, MAXMEMORY_BYTES, MAXMEMORY_SAMPLES, PBKDF2_HMAC_ITERATIONS
+from config import NOTIFY_KEYSPACE_EVENTS, ROOT_PASSWORD, ROOT_USER, SESSION_TOKEN_TTL_S, SESSION_TOKENS_PER_USER
+from model.custom_time import custom_time
+from model.database import Database, Key, MemoryAccount
+from model.snapshot import read_database, write_database
+from model.pubsub import KEYSPACE_SEPARATOR, PubSub
+from model.persistent_dictionary import PersistentDictionary, PersistentSetDictionary
+from constants import DBS_OF_USERS_JSON_FILENAME, DBS_FILENAME, METADATA_LOCK_FILENAME, USERS_JSON_FILENAME, USERS_OF_DBS_JSON_FILENAME
+from model.exception import DbAlreadyExistsError, DbNotExistError, OutOfMemoryError, UserNotExistError, UsernameAlreadyTakenError
 
 
 DatabaseName = NewType('DatabaseName', str)
 Username = NewType('Username', str)
 KeyAndSalt = NewType('KeyAndSalt', bytes)
+# A database that is not in memory: the file, the offset and the length of its section
+DatabaseLocation = Tuple[BinaryIO, int, int]
+# Called with a database name and the keys the store deleted on its own, i.e. to stream them to the replicas
+Deletions = Callable[[DatabaseName, List[Key]], None]
+
+# Snapshots start with this line, then hold the section of every database (see model/snapshot.py) one after the
+# other, the pickled index of the generation and the offsets and lengths of the sections, and the offset and length
+# of the index
+SNAPSHOT_MAGIC = b'in-memo-db snapshot 1\n'
+SNAPSHOT_TRAILER = struct.Struct('!QQ')
+# Bytes copied at once from a snapshot or a spill file into a new snapshot
+SNAPSHOT_COPY_CHUNK_SIZE = 1024 * 1024
 
 
 class Store():
   'Server wide object that stores the collection of users, databases and their relations.'
 
-  def __init__(self) -> None:
+  def __init__(self, dbs_filename: str = DBS_FILENAME, shared_metadata: bool = False,
+               maxmemory_bytes: int = MAXMEMORY_BYTES) -> None:
+    '''
+    With shared metadata, the users and ownership files are shared by several worker processes,
+    which change them while holding a lock and pick up each other's changes before reading them.
+    '''
+    # Databases in memory, and the ones only on disk, which are loaded on their first use
     self._dbs: Dict[DatabaseName, Database] = dict()
-    self._users = PersistentDictionary[Username, str](filepath=USERS_JSON_FILENAME)
-    self._users_of_dbs = PersistentDictionary[DatabaseName, Tuple[Username, ...]](filepath=USERS_OF_DBS_JSON_FILENAME)
-    self._dbs_of_users = PersistentDictionary[Username, Tuple[DatabaseName, ...]](filepath=DBS_OF_USERS_JSON_FILENAME)
-    try:
-      self.create_user(Username(ROOT_USER), ROOT_PASSWORD)
-      logging.info('registered root user from env vars')
-    except BaseException:
-      logging.info('root user was already registered')
+    self._on_disk: Dict[DatabaseName, DatabaseLocation] = dict()
+    # The last time every database in memory was selected, idle ones may be spilled to disk
+    self._used_at: Dict[DatabaseName, int] = dict()
+    # Connections having every database in memory selected, a selected database is never spilled
+    self._selections: Dict[DatabaseName, int] = dict()
+    # The snapshot the databases on disk were indexed from, kept open so it can be read after a new one replaced it
+    self._snapshot_file: Optional[BinaryIO] = None
+    # Memory used by every database of the store, kept under the ceiling by make_room()
+    self._memory = MemoryAccount()
+    self._maxmemory_bytes = maxmemory_bytes
+    # Databases in memory that may hold keys to evict, and their positions in the list, so evictions sample
+    # them in O(1). Every write adds its database back, a sample drops the ones without an eviction candidate.
+    self._evictable: List[DatabaseName] = list()
+    self._evictable_positions: Dict[DatabaseName, int] = dict()
+    # Channels and their subscribers, the databases publish their keyspace events here
+    self.pubsub = PubSub()
+    # Set on a leader, expired and evicted keys are deleted on the replicas by the records of the leader
+    self.propagate_deletions: Optional[Deletions] = None
+    self._dbs_filename = dbs_filename
+    self._snapshot_child: Optional[_Child] = None
+    self._metadata_lock_file: Optional[TextIO] = open(METADATA_LOCK_FILENAME, 'a') if shared_metadata else None
+    self._metadata_lock_depth = 0
+    with self._lock_metadata():
+      self._users = PersistentDictionary[Username, str](filepath=USERS_JSON_FILENAME)
+      # Ownership is indexed by sets in both directions, so adding or removing an owner is O(1)
+      self._users_of_dbs = PersistentSetDictionary[DatabaseName](filepath=USERS_OF_DBS_JSON_FILENAME)
+      self._dbs_of_users = PersistentSetDictionary[Username](filepath=DBS_OF_USERS_JSON_FILENAME)
+      if ROOT_USER not in self._users:
+        self._add_user(Username(ROOT_USER), self._hash_password(ROOT_PASSWORD.encode()))
+        logging.info('registered root user from env vars')
+      else:
+        logging.info('root user was already registered')
+    # PBKDF2 releases the GIL, so hashing in threads keeps the event loop responsive during logins
+    self._kdf_executor = ThreadPoolExecutor(max_workers=KDF_THREADS, thread_name_prefix='kdf')
+    # Short-lived session tokens of the users with their expiration time, kept in memory only
+    self._session_tokens: Dict[Username, Dict[str, int]] = dict()
 
-  def delete_expired_keys_from_dbs(self) -> None:
-    'Calls delete expired keys in all existing databses.'
-    for _, db in self._dbs.items():
-      db.delete_expired_keys()
+  def delete_expired_keys_from_dbs(self, time_budget: Optional[float] = None) -> bool:
+    '''
+    Calls delete expired keys in all existing databses. If a time budget is given in seconds,
+    the sweep stops once it is used up. Returns whether every expired key has been deleted.
+    '''
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    propagate = self.propagate_deletions
+    for name, db in self._dbs.items():
+      if propagate is None:
+        done = db.delete_expired_keys(deadline=deadline)
+      else:
+        expired: List[Key] = []
+        done = db.delete_expired_keys(deadline=deadline, expired=expired)
+        if len(expired) > 0:
+          propagate(name, expired)
+      if not done:
+        return False
+    return True
 
   def create_database(self, username: Username, new_db_name: DatabaseName) -> None:
     '''
     Creates a new database with the given name if it did not exist earlier.
     Sets user as the owner of the database.
     '''
-    if new_db_name in self._dbs:
+    if self._exists(new_db_name):
       raise DbAlreadyExistsError
-    self._dbs[new_db_name] = Database()
-    self._users_of_dbs[new_db_name] = tuple(self._users_of_dbs[new_db_name]
-                                            ) if new_db_name in self._users_of_dbs else tuple()
-    self.add_user_to_owners(username=username, db_name=new_db_name)
+    with self._change_metadata():
+      if username not in self._users:
+        raise UserNotExistError
+      self._dbs[new_db_name] = Database()
+      self._attach(name=new_db_name, database=self._dbs[new_db_name])
+      if new_db_name not in self._users_of_dbs:
+        self._users_of_dbs[new_db_name] = set()
+      self.add_user_to_owners(username=username, db_name=new_db_name)
+
+  def _attach(self, name: DatabaseName, database: Database) -> None:
+    # Databases created before their names were checked may contain the separator, their events would
+    # be published on the channels of another database
+    notifies = NOTIFY_KEYSPACE_EVENTS and KEYSPACE_SEPARATOR not in name
+    database.attach(self._memory, notify=self.pubsub.keyspace_notifier(name) if notifies else None)
+    self._used_at[name] = custom_time.time
+    self._add_evictable(name)
+
+  def _exists(self, db_name: DatabaseName) -> bool:
+    return db_name in self._dbs or db_name in self._on_disk
+
+  def _resident(self, db_name: DatabaseName) -> Database:
+    'Returns an existing database, loading it if it is only on disk.'
+    database = self._dbs.get(db_name)
+    return self._load(db_name) if database is None else database
+
+  def _load(self, db_name: DatabaseName) -> Database:
+    'Reads a database that is only on disk, it is served from memory from now on.'
+    started_at = time.monotonic()
+    file, offset, length = self._on_disk.pop(db_name)
+    database = read_database(file, offset, length)
+    if file is not self._snapshot_file:
+      # The temporary file of a spilled database is deleted when it is closed
+      file.close()
+    self._dbs[db_name] = database
+    self._attach(name=db_name, database=database)
+    logging.info(f'loaded database {db_name} ({length / 2**20:.1f} MiB) in {time.monotonic() - started_at:.3f}s')
+    return database
+
+  def spill_idle_databases(self, idle_s: int) -> None:
+    '''
+    Writes the databases that were not selected for idle_s seconds into temporary files and drops them
+    from memory, they are loaded again on their next use. Databases selected by a connection are
+    never spilled, so none is dropped while a connection could still change it.
+    '''
+    now = custom_time.time
+    for db_name in [db_name for db_name, used_at in self._used_at.items()
+                    if now - used_at >= idle_s and db_name not in self._selections]:
+      database = self._dbs[db_name]
+      file = tempfile.TemporaryFile(dir=os.path.dirname(self._dbs_filename) or '.')
+      write_database(file, database)
+      file.flush()
+      length = file.tell()
+      database.detach()
+      del self._dbs[db_name]
+      del self._used_at[db_name]
+      self._discard_evictable(db_name)
+      self._on_disk[db_name] = (file, 0, length)
+      logging.info(f'spilled idle database {db_name} ({length / 2**20:.1f} MiB) to disk')
+
+  def select(self, db_name: DatabaseName) -> None:
+    'Counts a connection selecting a database it got from the store.'
+    self._selections[db_name] = self._selections.get(db_name, 0) + 1
+
+  def release(self, db_name: DatabaseName, database: Database) -> None:
+    'Counts a connection leaving the database it selected, unless the database was dropped meanwhile.'
+    if self._dbs.get(db_name) is not database:
+      return None
+    selections = self._selections[db_name] - 1
+    if selections == 0:
+      del self._selections[db_name]
+    else:
+      self._selections[db_name] = selections
+
+  def owns_database(self, username: Username, db_name: DatabaseName) -> bool:
+    'Tells whether the user is one of the owners of the database, which may be served by another worker process.'
+    self._refresh_metadata()
+    return db_name in self._users_of_dbs and username in self._users_of_dbs[db_name]
 
   def add_user_to_owners(self, username: Username, db_name: DatabaseName) -> None:
     'Sets user as the owner of the specified database if it exists.'
-    if username not in self._users:
-      raise UserNotExistError
-    if username not in self._users_of_dbs[db_name]:
-      self._users_of_dbs[db_name] = (username, *self._users_of_dbs[db_name])
-    if db_name not in self._dbs_of_users[username]:
-      self._dbs_of_users[username] = (db_name, *self._dbs_of_users[username])
+    with self._change_metadata():
+      if username not in self._users:
+        raise UserNotExistError
+      if db_name not in self._users_of_dbs:
+        raise DbNotExistError
+      self._users_of_dbs.add(db_name, username)
+      self._dbs_of_users.add(username, db_name)
 
   def delete_database(self, username: Username, db_to_delete: DatabaseName) -> None:
     '''
     Deletes the specified database if the user is an owner. Removes all
     ownership pertaining to this database before deletion.
     '''
-    if db_to_delete not in self._dbs or username not in self._users_of_dbs[db_to_delete]:
-      return None
-    del self._dbs[db_to_delete]
-    db_users = self._users_of_dbs[db_to_delete]
-    for db_user in db_users:
-      self._dbs_of_users[db_user] = tuple(db for db in self._dbs_of_users[db_user] if db != db_to_delete)
-    del self._users_of_dbs[db_to_delete]
+    with self._change_metadata():
+      if not self._exists(db_to_delete) or username not in self._users_of_dbs[db_to_delete]:
+        return None
+      self.drop_database(db_to_delete=db_to_delete)
+
+  def drop_database(self, db_to_delete: DatabaseName) -> None:
+    'Deletes a database and its ownership whoever owns it, i.e. when a replica follows its leader.'
+    with self._change_metadata():
+      database = self._dbs.pop(db_to_delete, None)
+      location = self._on_disk.pop(db_to_delete, None)
+      if database is None and location is None:
+        return None
+      self._used_at.pop(db_to_delete, None)
+      self._selections.pop(db_to_delete, None)
+      self._discard_evictable(db_to_delete)
+      if database is not None:
+        database.detach()
+      if location is not None and location[0] is not self._snapshot_file:
+        location[0].close()
+      for db_user in self._users_of_dbs[db_to_delete]:
+        self._dbs_of_users.discard(db_user, db_to_delete)
+      del self._users_of_dbs[db_to_delete]
 
   def delete_user(self, user_to_delete: Username) -> None:
     '''
     If the specified user exists, then it get deleted, and removes
     user from the owner list of all databases.
     '''
-    if user_to_delete not in self._users:
+    self._session_tokens.pop(user_to_delete, None)
+    with self._change_metadata():
+      if user_to_delete not in self._users:
+        return None
+      del self._users[user_to_delete]
+      for database in self._dbs_of_users[user_to_delete]:
+        self._users_of_dbs.discard(database, user_to_delete)
+      del self._dbs_of_users[user_to_delete]
+
+  def make_room(self, db_name: DatabaseName, database: Database) -> None:
+    '''
+    Evicts keys until the database and the whole store are under their memory ceilings, it is
+    called before every write. Raises OutOfMemoryError if the eviction policy cannot free enough.
+    '''
+    while DB_MAXMEMORY_BYTES > 0 and database.used_memory > DB_MAXMEMORY_BYTES:
+      candidate = database.eviction_candidate()
+      if candidate is None:
+        raise OutOfMemoryError
+      self._evict(db_name=db_name, database=database, key=candidate[1])
+    if self._maxmemory_bytes <= 0:
+      return None
+    if db_name not in self._evictable_positions:
+      self._add_evictable(db_name)
+    while self._memory.used > self._maxmemory_bytes:
+      # The best candidate of a few sampled databases is evicted, so a single eviction stays cheap with many databases
+      candidates: List[Tuple[Tuple[int, Key], DatabaseName, Database]] = list()
+      while len(candidates) == 0:
+        if len(self._evictable) == 0:
+          raise OutOfMemoryError
+        for name in random.sample(self._evictable, min(len(self._evictable), MAXMEMORY_SAMPLES)):
+          db = self._dbs.get(name)
+          candidate = None if db is None else db.eviction_candidate()
+          if db is None or candidate is None:
+            self._discard_evictable(name)
+          else:
+            candidates.append((candidate, name, db))
+      (_, key), name, db = max(candidates, key=lambda candidate_name_and_db: candidate_name_and_db[0][0])
+      self._evict(db_name=name, database=db, key=key)
+
+  def _add_evictable(self, db_name: DatabaseName) -> None:
+    self._evictable_positions[db_name] = len(self._evictable)
+    self._evictable.append(db_name)
+
+  def _discard_evictable(self, db_name: DatabaseName) -> None:
+    'Removes a database from the evictable ones in O(1), the last one takes its position.'
+    position = self._evictable_positions.pop(db_name, None)
+    if position is None:
       return None
-    del self._users[user_to_delete]
-    dbs_of_user = self._dbs_of_users[user_to_delete]
-    for database in dbs_of_user:
-      self._users_of_dbs[database] = tuple(user for user in self._users_of_dbs[database] if user != user_to_delete)
-    del self._dbs_of_users[user_to_delete]
+    last = self._evictable.pop()
+    if last != db_name:
+      self._evictable[position] = last
+      self._evictable_positions[last] = position
+
+  def _evict(self, db_name: DatabaseName, database: Database, key: Key) -> None:
+    database.evict(key=key)
+    if self.propagate_deletions is not None:
+      self.propagate_deletions(db_name, [key])
+
+  def info(self) -> Dict[str, Any]:
+    '''
+    Returns the memory used by the store, its ceiling, the number of databases only on disk
+    and the figures of every database this process serves from memory.
+    '''
+    return {'used_memory': self._memory.used, 'maxmemory': self._maxmemory_bytes, 'databases_on_disk': len(self._on_disk),
+            'databases': {name: db.info() for name, db in self._dbs.items()}}
 
   def get_database_by_name(self, username: Username, db_name: DatabaseName) -> Database:
     'Returns a database if the specified user is within the owners of the database. Raises DbNotExistError otherwise.'
-    if db_name not in self._dbs or username not in self._users_of_dbs[db_name]:
+    self._refresh_metadata()
+    if not self._exists(db_name) or username not in self._users_of_dbs[db_name]:
       raise DbNotExistError
-    return self._dbs[db_name]
+    self._used_at[db_name] = custom_time.time
+    return self._resident(db_name)
+
+  def database(self, db_name: DatabaseName) -> Database:
+    'Returns a database whoever owns it, i.e. to apply the changes streamed by a leader. Raises DbNotExistError.'
+    if not self._exists(db_name):
+      raise DbNotExistError
+    self._used_at[db_name] = custom_time.time
+    return self._resident(db_name)
 
   def _hash_password(self, password: bytes) -> KeyAndSalt:
     'Uses pbkdf2 hmac algorithm to hash a password iterations number of times.'
     salt = os.urandom(32)
-    # 100 000 iterations would prevent the server from responding for ~50ms since we run single threadedly
+    # 100 000 iterations take ~50ms, so outside of startup this only runs in the kdf executor
     key = hashlib.pbkdf2_hmac('sha256', password=password, salt=salt, iterations=PBKDF2_HMAC_ITERATIONS)
     return KeyAndSalt(key + salt)
 
@@ -103,47 +335,368 @@ class Store():
     salt = key_and_salt[32:]
     key_to_verify = hashlib.pbkdf2_hmac('sha256', password=password_to_verify,
                                         salt=salt, iterations=PBKDF2_HMAC_ITERATIONS)
-    return key_to_verify == key
+    return hmac.compare_digest(key_to_verify, key)
+
+  def _add_user(self, username: Username, key_and_salt: KeyAndSalt) -> None:
+    with self._users.batch(), self._dbs_of_users.batch():
+      self._users[username] = key_and_salt.hex()
+      self._dbs_of_users[username] = set()
 
-  def create_user(self, username_to_create: Username, password: str) -> None:
-    'Creates a new user if it does not exist already. Raises UsernameAlreadyTakenError otherwise.'
+  @contextmanager
+  def _lock_metadata(self) -> Iterator[None]:
+    'Holds the lock of the shared metadata files, does nothing when they are not shared. Can be nested.'
+    if self._metadata_lock_file is None:
+      yield None
+      return None
+    if self._metadata_lock_depth == 0:
+      fcntl.flock(self._metadata_lock_file, fcntl.LOCK_EX)
+    self._metadata_lock_depth += 1
+    try:
+      yield None
+    finally:
+      self._metadata_lock_depth -= 1
+      if self._metadata_lock_depth == 0:
+        fcntl.flock(self._metadata_lock_file, fcntl.LOCK_UN)
+
+  @contextmanager
+  def _change_metadata(self) -> Iterator[None]:
+    '''
+    Changes made inside the block are written with one durable write per file. Shared metadata
+    is locked and brought up to date first, so the checks made inside the block hold while it runs.
+    '''
+    with self._lock_metadata():
+      self._refresh_metadata()
+      with self._users.batch(), self._users_of_dbs.batch(), self._dbs_of_users.batch():
+        yield None
+
+  def _refresh_metadata(self) -> None:
+    'Picks up the changes other worker processes made to the shared metadata files.'
+    if self._metadata_lock_file is None:
+      return None
+    self._users.refresh()
+    self._users_of_dbs.refresh()
+    self._dbs_of_users.refresh()
+
+  async def create_user(self, username_to_create: Username, password: str) -> None:
+    '''
+    Creates a new user if it does not exist already. Raises UsernameAlreadyTakenError otherwise.
+    The password is hashed in the kdf executor, other clients are served meanwhile.
+    '''
     if username_to_create in self._users:
       raise UsernameAlreadyTakenError
     # TODO: check for invalid characters
-    self._users[username_to_create] = self._hash_password(password.encode()).hex()
-    self._dbs_of_users[username_to_create] = tuple()
+    key_and_salt = await asyncio.get_running_loop().run_in_executor(
+        self._kdf_executor, self._hash_password, password.encode(errors='surrogateescape'))
+    # Another client could have registered the same name while the password was hashed
+    with self._change_metadata():
+      if username_to_create in self._users:
+        raise UsernameAlreadyTakenError
+      self._add_user(username_to_create, key_and_salt)
+
+  def password_hash(self, username: Username) -> str:
+    'Returns the stored key and salt of a user in hex, so a replica can authenticate the user without the password.'
+    return self._users[username]
 
-  def authenticate_user(self, username: Username, password: str) -> bool:
-    'Returns True if user with the provided username exists and the given password string is right.'
+  def add_user_with_password_hash(self, username: Username, key_and_salt: str) -> None:
+    'Registers or updates a user with the key and salt a leader streamed in hex.'
+    with self._change_metadata():
+      if username in self._users:
+        self._users[username] = key_and_salt
+      else:
+        self._add_user(username, KeyAndSalt(bytes.fromhex(key_and_salt)))
+
+  async def authenticate_user(self, username: Username, password: str) -> bool:
+    '''
+    Returns True if user with the provided username exists and the given password string is right.
+    The password is verified in the kdf executor, other clients are served meanwhile.
+    '''
+    self._refresh_metadata()
     if username not in self._users:
       return False
     key_and_salt = bytes.fromhex(self._users[username])
-    return self._verify_password(password_to_verify=password.encode(), key_and_salt=key_and_salt)
+    return await asyncio.get_running_loop().run_in_executor(
+        self._kdf_executor, self._verify_password, password.encode(errors='surrogateescape'), key_and_salt)
+
+  def issue_session_token(self, username: Username) -> str:
+    '''
+    Creates a random token that lets the user log in without a password until it expires. Past
+    SESSION_TOKENS_PER_USER live tokens, the oldest ones are revoked.
+    '''
+    tokens = self._live_session_tokens(username)
+    # Tokens are kept in the order they were issued
+    for oldest in list(tokens)[:max(0, len(tokens) - SESSION_TOKENS_PER_USER + 1)]:
+      del tokens[oldest]
+    token = secrets.token_hex(32)
+    tokens[token] = custom_time.time + SESSION_TOKEN_TTL_S
+    self._session_tokens[username] = tokens
+    return token
+
+  def authenticate_session_token(self, username: Username, token: str) -> bool:
+    'Returns True if the token was issued to the user and has not expired yet, without running PBKDF2.'
+    self._refresh_metadata()
+    if username not in self._users:
+      return False
+    tokens = self._live_session_tokens(username)
+    if len(tokens) == 0:
+      self._session_tokens.pop(username, None)
+    else:
+      self._session_tokens[username] = tokens
+    encoded_token = token.encode(errors='surrogateescape')
+    authenticated = False
+    # Every token of the user is compared in constant time, so the timing does not leak a valid prefix
+    for issued_token in tokens:
+      if hmac.compare_digest(issued_token.encode(), encoded_token):
+        authenticated = True
+    return authenticated
+
+  def _live_session_tokens(self, username: Username) -> Dict[str, int]:
+    'Returns the tokens of the user that have not expired yet, in the order they were issued.'
+    now = custom_time.time
+    return {token: expire_at for token, expire_at in self._session_tokens.get(username, dict()).items()
+            if expire_at >= now}
 
   def list_users_of_db(self, db_name: DatabaseName) -> List[Username]:
     'Retreives a list of usernames of whom the database is owned by.'
-    if db_name not in self._dbs:
+    self._refresh_metadata()
+    if not self._exists(db_name):
       raise DbNotExistError
-    return list(self._users_of_dbs[db_name])
+    return [Username(username) for username in self._users_of_dbs[db_name]]
 
   def list_dbs_of_user(self, username: Username) -> List[DatabaseName]:
     'Retreives a list of database names owned by the specified user.'
+    self._refresh_metadata()
     if username not in self._users:
       raise UserNotExistError
-    return list(self._dbs_of_users[username])
+    return [DatabaseName(db_name) for db_name in self._dbs_of_users[username]]
 
-  def load_dbs_from_disk(self) -> None:
-    'Loads databases dict() object from the pickle file during startup.'
+  def load_dbs_from_disk(self) -> int:
+    '''
+    Reads the index of the snapshot during startup, every database is loaded on its first use.
+    Returns the generation of the last write-ahead log segment the snapshot covers.
+    '''
+    generation = 0
     try:
-      with open(DBS_FILENAME, 'rb') as file:
-        self._dbs = pickle.load(file=file)
+      file = open(self._dbs_filename, 'rb')
     except FileNotFoundError:
-      logging.info(f'no {DBS_FILENAME} file found')
+      logging.info(f'no {self._dbs_filename} file found')
+      return generation
+    if file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+      generation, index = _read_index(file)
+      self._snapshot_file = file
+      self._on_disk = {db_name: (file, offset, length) for db_name, (offset, length) in index.items()}
+      logging.info(f'{len(index)} databases indexed in {self._dbs_filename}, each is loaded on its first use')
+      return generation
+    # Snapshots written before the index was introduced are a single pickle, loaded as a whole
+    with file:
+      file.seek(0)
+      snapshot = pickle.load(file=file)
+    # Files written before snapshots were taken periodically only hold the databases
+    if isinstance(snapshot, tuple):
+      generation, self._dbs = snapshot
     else:
-      logging.info(f'state loaded from {DBS_FILENAME}')
+      self._dbs = snapshot
+    for db_name, database in self._dbs.items():
+      self._attach(name=db_name, database=database)
+    logging.info(f'state loaded from {self._dbs_filename}')
+    return generation
+
+  def save_dbs_to_disk(self, generation: int) -> None:
+    'Writes the snapshot of the databases during graceful shutdown.'
+    self._stop_background_save()
+    self._write_snapshot(generation=generation)
+    logging.info(f'state saved in {self._dbs_filename}')
+
+  def close(self) -> None:
+    'Closes the files the store keeps open, called at shutdown once the snapshot is saved.'
+    for disk_file, _, _ in self._on_disk.values():
+      if disk_file is not self._snapshot_file:
+        disk_file.close()
+    if self._snapshot_file is not None:
+      self._snapshot_file.close()
+    self._users.close()
+    self._users_of_dbs.close()
+    self._dbs_of_users.close()
+    if self._metadata_lock_file is not None:
+      self._metadata_lock_file.close()
+    self._kdf_executor.shutdown(wait=False)
 
-  def save_dbs_to_disk(self) -> None:
-    'Saves databases dict() object to a pickle file during graceful shutdown.'
-    with open(DBS_FILENAME, 'wb') as file:
-      pickle.dump(self._dbs, file=file)
-      logging.info(f'state saved in {DBS_FILENAME}')
+  async def save_dbs_in_background(self, generation: int) -> bool:
+    '''
+    Forks a child process that writes its copy-on-write view of the databases, so
+    the event loop keeps serving clients meanwhile. Returns whether the snapshot was saved.
+    '''
+    on_disk = dict(self._on_disk)
+    child = self._snapshot_child = _fork(lambda: self._write_snapshot(generation=generation))
+    started_at = time.monotonic()
+    saved = await asyncio.wrap_future(child.exited_successfully)
+    if self._snapshot_child is child:
+      self._snapshot_child = None
+    if saved:
+      self._switch_snapshot(on_disk=on_disk)
+      logging.info(f'state saved in {self._dbs_filename} in the background in {time.monotonic() - started_at:.3f}s')
+    else:
+      logging.error(f'background save of {self._dbs_filename} failed')
+    return saved
+
+  def _switch_snapshot(self, on_disk: Dict[DatabaseName, DatabaseLocation]) -> None:
+    '''
+    Reads the databases that were on disk when a new snapshot was taken, and still are, from the new snapshot
+    from now on, so the previous snapshot and the temporary files of the spilled databases can be closed.
+    '''
+    file = open(self._dbs_filename, 'rb')
+    _, index = _read_index(file)
+    for db_name, location in on_disk.items():
+      if self._on_disk.get(db_name) is location:
+        self._on_disk[db_name] = (file, *index[db_name])
+        if location[0] is not self._snapshot_file:
+          location[0].close()
+    if self._snapshot_file is not None:
+      self._snapshot_file.close()
+    self._snapshot_file = file
+
+  async def save_replica_snapshot(self, filename: str) -> bool:
+    '''
+    Pickles the databases, the users and the ownership for a replica in a forked child, like a background
+    save. A command run after the call is not in the snapshot. Returns whether the snapshot was saved.
+    '''
+    metadata = ({username: self._users[username] for username in self._users},
+                {db_name: set(self._users_of_dbs[db_name]) for db_name in self._users_of_dbs},
+                {username: set(self._dbs_of_users[username]) for username in self._dbs_of_users})
+
+    def write() -> None:
+      # Loading the databases that are only on disk changes the memory of the child only
+      for db_name in list(self._on_disk):
+        self._dbs[db_name] = read_database(*self._on_disk.pop(db_name))
+      with open(filename, 'wb') as file:
+        pickle.dump((self._dbs, *metadata), file=file)
+    return await asyncio.wrap_future(_fork(write).exited_successfully)
+
+  def load_replica_snapshot(self, filename: str) -> None:
+    'Replaces every database, user and owner with the ones of a snapshot made by save_replica_snapshot().'
+    with open(filename, 'rb') as file:
+      dbs, users, users_of_dbs, dbs_of_users = pickle.load(file=file)
+    for database in self._dbs.values():
+      database.detach()
+    for disk_file, _, _ in self._on_disk.values():
+      if disk_file is not self._snapshot_file:
+        disk_file.close()
+    self._on_disk = dict()
+    self._used_at = dict()
+    # The connections keep the databases they selected before, releasing them counts nothing
+    self._selections = dict()
+    self._evictable = list()
+    self._evictable_positions = dict()
+    self._dbs = dbs
+    for db_name, database in self._dbs.items():
+      self._attach(name=db_name, database=database)
+    with self._change_metadata():
+      for dictionary, replacement in ((self._users, users), (self._users_of_dbs, users_of_dbs),
+                                      (self._dbs_of_users, dbs_of_users)):
+        for key in [key for key in dictionary if key not in replacement]:
+          del dictionary[key]
+        for key, value in replacement.items():
+          dictionary[key] = value
+
+  def _stop_background_save(self) -> None:
+    'Kills the child of a running background save, so it cannot replace a newer snapshot.'
+    if self._snapshot_child is None:
+      return None
+    self._snapshot_child.kill()
+    self._snapshot_child = None
+
+  def _write_snapshot(self, generation: int) -> None:
+    '''
+    Writes the databases with the covered generation into a temporary file, then renames it over
+    the snapshot, so a crash never leaves a half written snapshot behind. The sections of the databases
+    in memory are written, the ones of the databases on disk are copied as they are. Does not log, since
+    it also runs in forked children.
+    '''
+    temporary_filename = f'{self._dbs_filename}.{os.getpid()}.tmp'
+    index: Dict[DatabaseName, Tuple[int, int]] = dict()
+    with open(temporary_filename, 'wb') as file:
+      file.write(SNAPSHOT_MAGIC)
+      for db_name, database in self._dbs.items():
+        offset = file.tell()
+        write_database(file, database)
+        index[db_name] = (offset, file.tell() - offset)
+      for db_name, (source, source_offset, length) in self._on_disk.items():
+        index[db_name] = (file.tell(), length)
+        for chunk_offset in range(0, length, SNAPSHOT_COPY_CHUNK_SIZE):
+          file.write(_read(source, source_offset + chunk_offset, min(SNAPSHOT_COPY_CHUNK_SIZE, length - chunk_offset)))
+      index_offset = file.tell()
+      pickle.dump((generation, index), file=file)
+      file.write(SNAPSHOT_TRAILER.pack(index_offset, file.tell() - index_offset))
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(temporary_filename, self._dbs_filename)
+
+
+def _read(file: BinaryIO, offset: int, length: int) -> bytes:
+  'Reads length bytes at offset without moving the position of the file, which children share after a fork.'
+  chunks: List[bytes] = []
+  while length > 0:
+    chunk = os.pread(file.fileno(), length, offset)
+    if len(chunk) == 0:
+      raise EOFError(f'{file.name} ended before offset {offset + length}')
+    chunks.append(chunk)
+    offset += len(chunk)
+    length -= len(chunk)
+  return b''.join(chunks)
+
+
+def _read_index(file: BinaryIO) -> Tuple[int, Dict[DatabaseName, Tuple[int, int]]]:
+  'Returns the generation and the offsets and lengths of the databases of a snapshot.'
+  size = os.fstat(file.fileno()).st_size
+  index_offset, index_length = SNAPSHOT_TRAILER.unpack(_read(file, size - SNAPSHOT_TRAILER.size, SNAPSHOT_TRAILER.size))
+  index: Tuple[int, Dict[DatabaseName, Tuple[int, int]]] = pickle.loads(_read(file, index_offset, index_length))
+  return index
+
+
+class _Child():
+  '''
+  A forked child process, reaped by a thread of its own only. The thread waits for the child to exit
+  without reaping it first, so the child can be killed until then without its pid being reused meanwhile.
+  '''
+
+  def __init__(self, pid: int) -> None:
+    self.pid = pid
+    # Set to whether the child exited successfully once it is reaped
+    self.exited_successfully: 'Future[bool]' = Future()
+    self._lock = threading.Lock()
+    self._exited = False
+    threading.Thread(target=self._reap, name=f'reaper-{pid}', daemon=True).start()
+
+  def _reap(self) -> None:
+    try:
+      os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT)
+      with self._lock:
+        self._exited = True
+      _, status = os.waitpid(self.pid, 0)
+    except OSError as err:
+      logging.error(f'waiting for child {self.pid} failed: {err}')
+      # Nothing tells what became of the pid, so it is never killed
+      with self._lock:
+        self._exited = True
+      self.exited_successfully.set_result(False)
+      return None
+    self.exited_successfully.set_result(os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+
+  def kill(self) -> None:
+    'Kills the child unless it exited already, and waits until it is reaped.'
+    with self._lock:
+      if not self._exited:
+        os.kill(self.pid, signal.SIGKILL)
+    self.exited_successfully.result()
+
+
+def _fork(write: Callable[[], None]) -> _Child:
+  'Runs write in a child process, which sees a copy-on-write view of the parent.'
+  pid = os.fork()
+  if pid == 0:
+    exit_code = 1
+    try:
+      write()
+      exit_code = 0
+    finally:
+      os._exit(exit_code)
+  return _Child(pid)
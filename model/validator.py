@@ -1,15 +1,21 @@
-from typing import Tuple
+from typing import Tuple, Union
 from model.route import Route
-from model.exception import InvalidCommandError
 
+# Multi-key routes take an arbitrary number of params, every other route is capped
+VARIADIC_ROUTES = (Route.mget, Route.mput, Route.mdelete, Route.hset, Route.hmget, Route.hdel,
+                   Route.subscribe, Route.unsubscribe)
+# scan takes the most: a cursor, then match and count with their arguments
+MAX_PARAMS = 5
 
-def validate_route(line: bytes) -> Tuple[Route, Tuple[str, ...]]:
-  'Validates raw bytes and returns a route object and a string tuple containing the params.'
-  route_str, *params = line.decode().rstrip().split()
-  if len(params) > 4:
-    raise InvalidCommandError
-  try:
-    route = Route[route_str]
-  except KeyError:
-    raise InvalidCommandError
-  return (route, tuple(params))
+
+def parse_line(line: Union[bytes, bytearray]) -> Tuple[bytes, Tuple[str, ...]]:
+  '''
+  Returns the raw name of the route of a line, empty for a blank line, and its params: the rest
+  of the line is decoded at once and split at whitespace.
+  '''
+  parts = line.split(None, 1)
+  if len(parts) == 0:
+    return (bytes(), tuple())
+  if len(parts) == 1:
+    return (bytes(parts[0]), tuple())
+  return (bytes(parts[0]), tuple(str(parts[1], 'utf-8', 'surrogateescape').split()))
@@ -0,0 +1,332 @@
+import os
+import glob
+import functools
+import time
+import struct
+import zlib
+import logging
+import asyncio
+import threading
+from enum import Enum, unique
+from typing import BinaryIO, Iterator, List, Optional, Sequence, Tuple, Union
+from config import COMPRESSION_MIN_BYTES
+from model.compression import Codec, compress, decompress
+from model.metrics import metrics
+
+# Record: payload length and crc32 of the payload, then the payload itself
+RECORD_HEADER = struct.Struct('!II')
+# Payload: execution time and number of args, a table of arg lengths, then the args back to back
+PAYLOAD_HEADER = struct.Struct('!qI')
+# Segments start with this, the ones without it were written when the number of args was 16 bits
+SEGMENT_MAGIC = b'IMDBWAL2'
+LEGACY_PAYLOAD_HEADER = struct.Struct('!qH')
+
+# A payload without args holds a compressed batch of records instead
+BATCH_ARG_COUNT = 0
+
+LogRecord = Tuple[int, List[str]]
+
+
+@unique
+class FsyncPolicy(Enum):
+  always = 'always'
+  everysec = 'everysec'
+  never = 'never'
+
+
+@functools.lru_cache(maxsize=None)
+def _arg_lengths(arg_count: int) -> struct.Struct:
+  return struct.Struct(f'!{arg_count}I')
+
+
+def encode_record(exec_time: int, command: Sequence[str]) -> bytes:
+  'Encodes a command and its execution time into a checksummed, length-prefixed record.'
+  encoded_args = [arg.encode('utf-8', 'surrogateescape') for arg in command]
+  payload = b''.join([PAYLOAD_HEADER.pack(exec_time, len(encoded_args)),
+                      _arg_lengths(len(encoded_args)).pack(*map(len, encoded_args)), *encoded_args])
+  return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_payload(payload: Union[bytes, memoryview], header: struct.Struct = PAYLOAD_HEADER) -> LogRecord:
+  'Decodes the payload of a record into the execution time and the command, header is the one of its segment.'
+  exec_time, arg_count = header.unpack_from(payload)
+  lengths = _arg_lengths(arg_count).unpack_from(payload, header.size)
+  start = header.size + 4 * arg_count
+  args = str(payload[start:], 'utf-8', 'surrogateescape')
+  command: List[str] = []
+  offset = 0
+  if len(args) == len(payload) - start:
+    # Every byte decoded into a single character, the args are sliced out of one decoded string
+    for length in lengths:
+      command.append(args[offset:offset + length])
+      offset += length
+  else:
+    for length in lengths:
+      command.append(str(payload[start + offset:start + offset + length], 'utf-8', 'surrogateescape'))
+      offset += length
+  return (exec_time, command)
+
+
+def is_batch(payload: Union[bytes, memoryview], header: struct.Struct = PAYLOAD_HEADER) -> bool:
+  'Tells whether the payload is a compressed batch of records, which decode_batch() decodes.'
+  arg_count: int = header.unpack_from(payload)[1]
+  return arg_count == BATCH_ARG_COUNT
+
+
+def encode_batch(codec: Codec, batch: Union[bytes, bytearray]) -> bytes:
+  'Compresses records into a single record.'
+  payload = PAYLOAD_HEADER.pack(0, BATCH_ARG_COUNT) + compress(codec, batch)
+  return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_batch(payload: Union[bytes, memoryview], header: struct.Struct = PAYLOAD_HEADER) -> Iterator[LogRecord]:
+  'Decodes the records of a compressed batch in order.'
+  encoded = decompress(bytes(payload), header.size)
+  position = 0
+  while position < len(encoded):
+    length, _ = RECORD_HEADER.unpack_from(encoded, position)
+    position += RECORD_HEADER.size
+    yield decode_payload(encoded[position:position + length], header)
+    position += length
+
+
+def migrate_legacy_log(legacy_filepath: str, segment_filepath: str) -> int:
+  '''
+  Converts the text log of the versions before the segments into a segment, so it is replayed
+  like any other. A line is the execution time, a tab, then the route and params separated by spaces.
+  The segment is made durable before the text log is deleted, a crash in between converts it again
+  into the same segment. Returns the number of converted records, the torn last line is dropped.
+  '''
+  records = bytearray(SEGMENT_MAGIC)
+  converted = 0
+  with open(legacy_filepath, 'r', encoding='utf-8', errors='surrogateescape') as legacy_file:
+    for line in legacy_file:
+      exec_time_str, _, command_str = line.rstrip('\n').partition('\t')
+      if not line.endswith('\n') or not exec_time_str.isdigit() or command_str == '':
+        logging.warning(f'skipping invalid line {converted + 1} of {legacy_filepath}')
+        continue
+      records += encode_record(int(exec_time_str), command_str.split())
+      converted += 1
+  temporary_filepath = f'{segment_filepath}.tmp'
+  with open(temporary_filepath, 'wb') as file:
+    file.write(records)
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(temporary_filepath, segment_filepath)
+  os.remove(legacy_filepath)
+  return converted
+
+
+class WriteAheadLog():
+  '''
+  Append-only log of the successful mutating commands. Appends are only buffered on the
+  event loop, a writer thread commits them in groups when the group commit interval
+  elapses or the buffer reaches the size threshold, and calls fsync according to the policy.
+  The log is split into numbered segments (generations), so a snapshot can cover
+  every segment up to a generation, which are deleted once it is written. With a codec,
+  the writer thread compresses every batch of at least COMPRESSION_MIN_BYTES into a single record.
+  '''
+
+  def __init__(self, filename_format: str, fsync_policy: FsyncPolicy, group_commit_interval: float,
+               group_commit_size: int, codec: Codec = Codec.none) -> None:
+    self._filename_format = filename_format
+    self._fsync_policy = fsync_policy
+    self._codec = codec
+    self._group_commit_interval = group_commit_interval
+    self._group_commit_size = group_commit_size
+    # Held directly by append(), which runs for every command, the condition wraps the same lock
+    self._lock = threading.Lock()
+    self._condition = threading.Condition(self._lock)
+    self._generation = 1
+    self._buffer = bytearray()
+    # Buffers of the generations that were rotated out before the writer thread reached them
+    self._sealed: List[Tuple[int, bytearray]] = list()
+    self._obsolete_generation: Optional[int] = None
+    self._appended = 0
+    self._committed = 0
+    self._waiters: List[Tuple[int, 'asyncio.Future[None]']] = list()
+    self._closing = False
+    self._thread: Optional[threading.Thread] = None
+
+  @property
+  def generation(self) -> int:
+    'Returns the generation of the segment that new records are appended to.'
+    return self._generation
+
+  def segments(self) -> List[Tuple[int, str]]:
+    'Returns the generation and path of every segment on disk in ascending order.'
+    prefix, suffix = self._filename_format.split('{}')
+    found: List[Tuple[int, str]] = list()
+    for filepath in glob.glob(self._filename_format.format('*')):
+      generation_str = filepath[len(prefix):len(filepath) - len(suffix)]
+      if generation_str.isdigit():
+        found.append((int(generation_str), filepath))
+    return sorted(found)
+
+  def start(self, generation: int) -> None:
+    'Sets the generation new records are appended to, should be called before the first append.'
+    self._generation = generation
+
+  def append(self, exec_time: int, command: Sequence[str]) -> None:
+    'Buffers a command, the writer thread is started on the first append.'
+    record = encode_record(exec_time, command)
+    with self._lock:
+      self._buffer += record
+      self._appended += len(record)
+      # The writer thread sleeps until the first record of a batch, then until the batch is full or due
+      if len(self._buffer) == len(record) or len(self._buffer) >= self._group_commit_size:
+        self._condition.notify()
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run_writer, name='write-ahead-log', daemon=True)
+      self._thread.start()
+
+  def rotate(self) -> int:
+    '''
+    Seals the current segment, records appended from now on go to the next generation.
+    Returns the sealed generation, which holds the last record appended before the call.
+    '''
+    with self._condition:
+      sealed_generation = self._generation
+      self._sealed.append((sealed_generation, self._buffer))
+      self._buffer = bytearray()
+      self._generation += 1
+      self._condition.notify()
+    return sealed_generation
+
+  def delete_segments(self, up_to: int) -> None:
+    'Deletes the segments up to and including the given generation once every record of them is written.'
+    with self._condition:
+      if self._thread is not None:
+        self._obsolete_generation = up_to
+        self._condition.notify()
+        return None
+    self._delete_segments(up_to=up_to)
+
+  def _delete_segments(self, up_to: int) -> None:
+    for generation, filepath in self.segments():
+      if generation <= up_to:
+        os.remove(filepath)
+
+  def synced(self) -> bool:
+    'Tells whether sync() would return right away, the records appended so far are committed or need not be waited for.'
+    # The writer thread only ever raises the committed count, so reading it without the lock errs on the safe side
+    return self._fsync_policy != FsyncPolicy.always or self._committed >= self._appended
+
+  async def sync(self) -> None:
+    '''
+    With the always fsync policy it waits until every record appended so far is on disk,
+    so a reply is never sent before its command is durable. Concurrent callers share one
+    commit. With the other policies it returns immediately.
+    '''
+    if self._fsync_policy != FsyncPolicy.always:
+      return None
+    with self._condition:
+      if self._committed >= self._appended:
+        return None
+      future = asyncio.get_running_loop().create_future()
+      self._waiters.append((self._appended, future))
+      self._condition.notify()
+    await future
+
+  def _run_writer(self) -> None:
+    try:
+      self._write_batches()
+    except Exception as err:
+      # Acknowledged commands could not be made durable, the same as any other unexpected error
+      logging.error(err)
+      os._exit(1)
+
+  def _write_batches(self) -> None:
+    last_fsync = time.monotonic()
+    unsynced = False
+    file: Optional[BinaryIO] = None
+    file_generation = 0
+    while True:
+      with self._condition:
+        # Nothing to write means no timeout, except for the pending fsync of the everysec policy
+        idle_timeout: Optional[float] = None
+        if unsynced and self._fsync_policy == FsyncPolicy.everysec:
+          idle_timeout = max(0.0, last_fsync + 1.0 - time.monotonic())
+        self._condition.wait_for(lambda: len(self._buffer) > 0 or self._due(), timeout=idle_timeout)
+        if len(self._buffer) > 0:
+          self._condition.wait_for(self._due, timeout=self._group_commit_interval)
+        batches = [*self._sealed, (self._generation, self._buffer)]
+        self._sealed = list()
+        self._buffer = bytearray()
+        obsolete_generation = self._obsolete_generation
+        self._obsolete_generation = None
+        target = self._appended
+        closing = self._closing
+      written = 0
+      write_started_at = time.perf_counter_ns()
+      for generation, batch in batches:
+        if file is not None and file_generation != generation:
+          # A rotated segment is made durable before the next one is started
+          if unsynced:
+            self._fsync(file)
+            unsynced = False
+          file.close()
+          file = None
+        if len(batch) > 0:
+          if file is None:
+            file = open(self._filename_format.format(generation), 'ab')
+            file_generation = generation
+            if os.fstat(file.fileno()).st_size == 0:
+              file.write(SEGMENT_MAGIC)
+          metrics.wal_record_bytes += len(batch)
+          written_batch: Union[bytes, bytearray] = batch
+          if self._codec is not Codec.none and len(batch) >= COMPRESSION_MIN_BYTES:
+            compressed = encode_batch(self._codec, batch)
+            if len(compressed) < len(batch):
+              written_batch = compressed
+          file.write(written_batch)
+          file.flush()
+          written += len(written_batch)
+          unsynced = True
+      if written > 0:
+        metrics.wal_writes.record((time.perf_counter_ns() - write_started_at) // 1000)
+        metrics.wal_bytes += written
+      now = time.monotonic()
+      if file is not None and unsynced and (self._fsync_policy == FsyncPolicy.always or closing or (
+              self._fsync_policy == FsyncPolicy.everysec and now - last_fsync >= 1.0)):
+        self._fsync(file)
+        last_fsync = now
+        unsynced = False
+      if obsolete_generation is not None:
+        self._delete_segments(up_to=obsolete_generation)
+      with self._condition:
+        self._committed = target
+        done = [future for (offset, future) in self._waiters if offset <= target]
+        self._waiters = [(offset, future) for (offset, future) in self._waiters if offset > target]
+      for future in done:
+        future.get_loop().call_soon_threadsafe(_resolve, future)
+      if closing:
+        if file is not None:
+          file.close()
+        return None
+
+  def _due(self) -> bool:
+    'Tells whether the writer thread should write without waiting for the group commit interval, holding the lock.'
+    return (self._closing or len(self._waiters) > 0 or len(self._sealed) > 0 or self._obsolete_generation is not None
+            or len(self._buffer) >= self._group_commit_size)
+
+  def _fsync(self, file: BinaryIO) -> None:
+    started_at = time.perf_counter_ns()
+    os.fsync(file.fileno())
+    metrics.wal_fsyncs.record((time.perf_counter_ns() - started_at) // 1000)
+
+  def close(self) -> None:
+    'Commits the buffered records, fsyncs the segment and stops the writer thread.'
+    if self._thread is None:
+      return None
+    with self._condition:
+      self._closing = True
+      self._condition.notify()
+    self._thread.join()
+    self._thread = None
+    self._closing = False
+
+
+def _resolve(future: 'asyncio.Future[None]') -> None:
+  if not future.done():
+    future.set_result(None)
@@ -0,0 +1,5 @@
+import os
+
+# Set before config is imported: logins stay fast, and every command is durable once router.sync() returns
+os.environ.setdefault('PBKDF2_HMAC_ITERATIONS', '1000')
+os.environ.setdefault('WAL_FSYNC_POLICY', 'always')
@@ -0,0 +1,51 @@
+import os
+import asyncio
+import shutil
+import tempfile
+import unittest
+from typing import Any, List, Protocol, TypeVar
+from constants import STATE_FILES_DIRNAME
+
+
+class Closable(Protocol):
+  def close(self) -> None: ...
+
+
+C = TypeVar('C', bound=Closable)
+
+
+class StateDirectoryTestCase(unittest.TestCase):
+  'Runs every test in a temporary working directory, so the state files of the server are never touched.'
+
+  def setUp(self) -> None:
+    self._working_directory = os.getcwd()
+    self.directory = tempfile.mkdtemp(prefix='in-memo-db-test-')
+    os.chdir(self.directory)
+    os.mkdir(STATE_FILES_DIRNAME)
+
+  def closing(self, resource: C) -> C:
+    'Closes the resource (i.e. a store or a persistent dictionary) at the end of the test.'
+    self.addCleanup(resource.close)
+    return resource
+
+  def tearDown(self) -> None:
+    os.chdir(self._working_directory)
+    shutil.rmtree(self.directory)
+
+
+class RecordingTransport(asyncio.Transport):
+  'Keeps what is written into it instead of sending it.'
+
+  def __init__(self) -> None:
+    super().__init__()
+    self.written: List[bytes] = list()
+    self.closed = False
+
+  def write(self, data: Any) -> None:
+    self.written.append(bytes(data))
+
+  def close(self) -> None:
+    self.closed = True
+
+  def is_closing(self) -> bool:
+    return self.closed
@@ -0,0 +1,70 @@
+import asyncio
+from typing import cast
+from config import MAX_LINE_BYTES, ROOT_USER
+from model.connection import Connection
+from model.context import Context
+from model.exception import LineTooLongError
+from model.router import Router
+from model.store import Store, Username
+from tests.support import RecordingTransport, StateDirectoryTestCase
+
+
+class _FailingRouter:
+  'Stands for a router whose write-ahead log cannot be synced.'
+
+  async def sync(self) -> None:
+    raise OSError('no space left on device')
+
+
+class ResumeTest(StateDirectoryTestCase):
+
+  def test_failed_sync_closes_the_connection(self) -> None:
+    'The replies waiting for a sync that failed are never sent, and the connection stops waiting.'
+    store = self.closing(Store())
+    connection = Connection(router=cast(Router, _FailingRouter()), ctx=Context(store=store, username=Username(ROOT_USER)))
+    transport = RecordingTransport()
+    connection.connection_made(transport)
+    connection._replies += b'ok\n'
+
+    async def wait() -> None:
+      connection._wait(None)
+      self.assertIsNotNone(connection._waiting)
+      await cast('asyncio.Task[None]', connection._waiting)
+
+    with self.assertLogs(level='ERROR'):
+      asyncio.run(wait())
+    self.assertIsNone(connection._waiting)
+    self.assertTrue(transport.closed)
+    self.assertEqual(transport.written, [])
+    connection.connection_lost(None)
+
+
+class LineLengthTest(StateDirectoryTestCase):
+
+  def _connection(self) -> Connection:
+    store = self.closing(Store())
+    connection = Connection(router=Router(store=store), ctx=Context(store=store, username=Username(ROOT_USER)))
+    self.transport = RecordingTransport()
+    connection.connection_made(self.transport)
+    return connection
+
+  def test_line_without_newline(self) -> None:
+    'A client that never sends a newline used to grow the buffer without bound.'
+    connection = self._connection()
+    connection.data_received(b'whoami\nget ')
+    connection.data_received(b'k' * (MAX_LINE_BYTES - len(b'get ')))
+    self.assertFalse(self.transport.closed)
+    with self.assertLogs(level='WARNING'):
+      connection.data_received(b'k')
+    self.assertEqual(b''.join(self.transport.written), f'{ROOT_USER}\n{LineTooLongError}\n'.encode())
+    self.assertTrue(self.transport.closed)
+    self.assertEqual(len(connection._buffer), 0)
+    connection.connection_lost(None)
+
+  def test_long_line(self) -> None:
+    connection = self._connection()
+    with self.assertLogs(level='WARNING'):
+      connection.data_received(b'get ' + b'k' * MAX_LINE_BYTES + b'\nwhoami\n')
+    self.assertEqual(b''.join(self.transport.written), f'{LineTooLongError}\n'.encode())
+    self.assertTrue(self.transport.closed)
+    connection.connection_lost(None)
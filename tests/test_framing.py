@@ -0,0 +1,32 @@
+import unittest
+from model.framing import ERROR_STATUS, OK_STATUS, REPLY_HEADER, FrameError, encode_frame, encode_reply, read_frame
+
+
+class FrameTest(unittest.TestCase):
+
+  def test_round_trip(self) -> None:
+    args = ['mput', 'key with spaces', 'line\nbreak', '', 'välue\udcff']
+    frame = encode_frame(args)
+    self.assertEqual(read_frame(bytearray(frame), 0), (len(frame), b'mput', tuple(args[1:])))
+
+  def test_frames_back_to_back(self) -> None:
+    buffer = bytearray(encode_frame(['get', 'a']) + encode_frame(['put', 'b', 'c']))
+    first = read_frame(buffer, 0)
+    assert first is not None
+    self.assertEqual(first[1:], (b'get', ('a',)))
+    self.assertEqual(read_frame(buffer, first[0]), (len(buffer), b'put', ('b', 'c')))
+
+  def test_incomplete_frame(self) -> None:
+    frame = encode_frame(['put', 'key', 'value'])
+    for length in range(len(frame)):
+      self.assertIsNone(read_frame(bytearray(frame[:length]), 0))
+
+  def test_invalid_arg_count(self) -> None:
+    with self.assertRaises(FrameError):
+      read_frame(bytearray(b'\x00\x00\x00\x00'), 0)
+
+  def test_reply(self) -> None:
+    reply = encode_reply(True, 'välue')
+    self.assertEqual(REPLY_HEADER.unpack_from(reply), (OK_STATUS, len('välue'.encode())))
+    self.assertEqual(reply[REPLY_HEADER.size:].decode(), 'välue')
+    self.assertEqual(encode_reply(False, 'error')[:1], ERROR_STATUS)
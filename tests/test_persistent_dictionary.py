@@ -0,0 +1,58 @@
+import json
+import os
+from typing import Set, Tuple
+from model.persistent_dictionary import COMPACTION_MIN_ENTRIES, PersistentDictionary, PersistentSetDictionary
+from tests.support import StateDirectoryTestCase
+
+FILEPATH = 'dictionary.jsonl'
+
+
+class PersistentDictionaryTest(StateDirectoryTestCase):
+
+  def test_changes_survive_reopening(self) -> None:
+    dictionary = self.closing(PersistentDictionary[str, Tuple[str, ...]](filepath=FILEPATH))
+    dictionary['kept'] = ('a', 'b')
+    dictionary['deleted'] = ('c',)
+    del dictionary['deleted']
+    reopened = self.closing(PersistentDictionary[str, Tuple[str, ...]](filepath=FILEPATH))
+    self.assertEqual(dict((key, reopened[key]) for key in reopened), {'kept': ('a', 'b')})
+
+  def test_batch_is_a_single_write(self) -> None:
+    dictionary = self.closing(PersistentDictionary[str, str](filepath=FILEPATH))
+    size = os.path.getsize(FILEPATH)
+    with dictionary.batch():
+      dictionary['first'] = '1'
+      dictionary['second'] = '2'
+      self.assertEqual(os.path.getsize(FILEPATH), size)
+    self.assertEqual(len(self.closing(PersistentDictionary[str, str](filepath=FILEPATH))), 2)
+
+  def test_torn_entry_is_cut_off(self) -> None:
+    dictionary = self.closing(PersistentDictionary[str, str](filepath=FILEPATH))
+    dictionary['key'] = 'value'
+    valid_length = os.path.getsize(FILEPATH)
+    with open(FILEPATH, 'a') as file:
+      file.write(json.dumps(['set', 'torn', 'value'])[:-3])
+    reopened = self.closing(PersistentDictionary[str, str](filepath=FILEPATH))
+    self.assertEqual(list(reopened), ['key'])
+    self.assertEqual(os.path.getsize(FILEPATH), valid_length)
+    reopened['next'] = 'value'
+    self.assertEqual(list(self.closing(PersistentDictionary[str, str](filepath=FILEPATH))), ['key', 'next'])
+
+  def test_file_is_compacted(self) -> None:
+    dictionary = self.closing(PersistentDictionary[str, str](filepath=FILEPATH))
+    for index in range(2 * COMPACTION_MIN_ENTRIES):
+      dictionary['key'] = str(index)
+    with open(FILEPATH) as file:
+      self.assertLess(len(file.readlines()), COMPACTION_MIN_ENTRIES)
+    reopened = self.closing(PersistentDictionary[str, str](filepath=FILEPATH))
+    self.assertEqual(reopened['key'], str(2 * COMPACTION_MIN_ENTRIES - 1))
+
+  def test_refresh_applies_changes_of_others(self) -> None:
+    first = self.closing(PersistentSetDictionary[str](filepath=FILEPATH))
+    second = self.closing(PersistentSetDictionary[str](filepath=FILEPATH))
+    first.add('db', 'alice')
+    first.add('db', 'bob')
+    first.discard('db', 'alice')
+    second.refresh()
+    members: Set[str] = second['db']
+    self.assertEqual(members, {'bob'})
@@ -0,0 +1,73 @@
+import unittest
+from typing import List, Tuple
+from config import ROOT_USER
+from model.context import Context
+from model.exception import InvalidDbNameError
+from model.framing import Protocol
+from model.pubsub import PubSub, Subscriber, keyspace_database
+from model.router import Router
+from model.store import DatabaseName, Store, Username
+from model.sharding import Shards, map_keyspace_flags
+from tests.support import RecordingTransport, StateDirectoryTestCase
+
+
+class KeyspaceRelayTest(unittest.TestCase):
+  'On a sharded server, keyspace events are only relayed while another worker has subscribers of keyspace channels.'
+
+  def setUp(self) -> None:
+    self.pubsub = PubSub()
+    self.relayed: List[Tuple[str, str]] = list()
+    self.pubsub.relay = lambda channel, message: self.relayed.append((channel, message))
+    self.elsewhere = False
+    self.pubsub.keyspace_subscribed_elsewhere = lambda: self.elsewhere
+    self.shared: List[bool] = list()
+    self.pubsub.share_keyspace_subscribed = self.shared.append
+    self.notify = self.pubsub.keyspace_notifier('db')
+
+  def test_events_are_relayed_to_subscribed_workers_only(self) -> None:
+    self.notify('set', 'key')
+    self.assertEqual(self.relayed, [])
+    self.elsewhere = True
+    self.notify('set', 'key')
+    self.assertEqual(self.relayed, [('__keyspace@db__:key', 'set'), ('__keyevent@db__:set', 'key')])
+
+  def test_keyspace_subscriptions_are_shared(self) -> None:
+    subscriber = Subscriber(transport=RecordingTransport(), protocol=Protocol.line)
+    self.pubsub.subscribe(subscriber=subscriber, channel='news')
+    self.assertEqual(self.shared, [])
+    self.pubsub.subscribe(subscriber=subscriber, channel='__keyspace@db__:key')
+    self.pubsub.subscribe(subscriber=subscriber, channel='__keyevent@db__:set')
+    self.pubsub.unsubscribe(subscriber=subscriber, channel='__keyspace@db__:key')
+    self.pubsub.unsubscribe_all(subscriber=subscriber)
+    self.assertEqual(self.shared, [True, True, True, False])
+
+  def test_flags_of_the_other_workers(self) -> None:
+    flags = map_keyspace_flags(workers=3)
+    workers = [Shards.__new__(Shards) for _ in range(3)]
+    for worker_id, shards in enumerate(workers):
+      shards.worker_id = worker_id
+      shards._keyspace_flags = flags
+    workers[1].share_keyspace_subscribed(True)
+    self.assertEqual([shards.keyspace_subscribed_elsewhere() for shards in workers], [True, False, True])
+    workers[1].share_keyspace_subscribed(False)
+    self.assertEqual([shards.keyspace_subscribed_elsewhere() for shards in workers], [False, False, False])
+    flags.close()
+
+
+class KeyspaceChannelTest(StateDirectoryTestCase):
+
+  def test_database_of_a_channel(self) -> None:
+    self.assertEqual(keyspace_database('__keyspace@db__:key'), 'db')
+    self.assertEqual(keyspace_database('__keyevent@db__:set'), 'db')
+    self.assertEqual(keyspace_database('__keyspace@db__:key__:with__:separators'), 'db')
+    self.assertIsNone(keyspace_database('news'))
+
+  def test_database_name_cannot_contain_the_separator(self) -> None:
+    'The channels of a database named a__:x would be taken for the channels of the key x__:k of the database a.'
+    store = self.closing(Store())
+    router = Router(store=store)
+    ctx = Context(store=store, username=Username(ROOT_USER))
+    self.assertFalse(router.execute(ctx, b'create_db', ('a__:x',)))
+    self.assertEqual(ctx.response, str(InvalidDbNameError))
+    self.assertTrue(router.execute(ctx, b'create_db', ('a',)))
+    self.assertEqual(store.list_dbs_of_user(username=Username(ROOT_USER)), [DatabaseName('a')])
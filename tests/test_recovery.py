@@ -0,0 +1,110 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import List
+import config
+from constants import SEQUENTIAL_SAVE_FILENAME
+from model.database import Key
+from model.recovery import Recovery
+from model.store import DatabaseName, Store, Username
+from model.write_ahead_log import FsyncPolicy, WriteAheadLog, encode_record
+from tests.support import StateDirectoryTestCase
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+# Seconds a server gets to start listening
+STARTUP_TIMEOUT_S = 30.0
+
+
+def _store() -> Store:
+  store = Store()
+  store.create_database(username=Username(config.ROOT_USER), new_db_name=DatabaseName('db'))
+  return store
+
+
+class TornTailTest(StateDirectoryTestCase):
+  'A crash in the middle of a write leaves a torn record at the end of the segment, which is cut off.'
+
+  def setUp(self) -> None:
+    super().setUp()
+    wal = WriteAheadLog(filename_format=SEQUENTIAL_SAVE_FILENAME, fsync_policy=FsyncPolicy.always,
+                        group_commit_interval=0.01, group_commit_size=1024 * 1024)
+    for index in range(3):
+      wal.append(exec_time=0, command=['put', 'db', f'key:{index}', 'value'])
+    wal.close()
+    self.filepath = SEQUENTIAL_SAVE_FILENAME.format(1)
+    self.valid_length = os.path.getsize(self.filepath)
+
+  def _replay(self) -> Store:
+    store = self.closing(_store())
+    recovery = Recovery(store=store)
+    recovery.replay_segment(self.filepath)
+    self.assertEqual(recovery.records, 3)
+    self.assertEqual(os.path.getsize(self.filepath), self.valid_length)
+    return store
+
+  def test_torn_record_is_truncated(self) -> None:
+    record = encode_record(0, ['put', 'db', 'torn', 'value'])
+    for length in (1, len(record) // 2, len(record) - 1):
+      with self.subTest(length=length):
+        with open(self.filepath, 'ab') as file:
+          file.write(record[:length])
+        store = self._replay()
+        self.assertEqual(len(store.database(DatabaseName('db'))), 3)
+
+  def test_corrupt_record_is_truncated(self) -> None:
+    record = bytearray(encode_record(0, ['put', 'db', 'corrupt', 'value']))
+    record[-1] ^= 0xff
+    with open(self.filepath, 'ab') as file:
+      file.write(record)
+    store = self._replay()
+    self.assertEqual(store.database(DatabaseName('db')).get(key=Key('key:2')), 'value')
+
+
+class KillTest(StateDirectoryTestCase):
+  'Every command acknowledged with the always fsync policy survives the server being killed.'
+
+  def _start(self, port: int) -> 'subprocess.Popen[bytes]':
+    env = {**os.environ, 'PORT': str(port), 'HOST': '127.0.0.1', 'WAL_FSYNC_POLICY': 'always',
+           'SNAPSHOT_INTERVAL_S': '0', 'REPLICATION_PORT': '0', 'METRICS_PORT': '0', 'WORKERS': '1'}
+    server = subprocess.Popen([sys.executable, MAIN], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT_S
+    while True:
+      try:
+        socket.create_connection(('127.0.0.1', port)).close()
+        return server
+      except ConnectionRefusedError:
+        if time.monotonic() > deadline or server.poll() is not None:
+          server.kill()
+          raise
+        time.sleep(0.05)
+
+  def _run(self, port: int, lines: List[str]) -> List[str]:
+    with socket.create_connection(('127.0.0.1', port)) as connection, connection.makefile('rb') as replies:
+      connection.sendall(''.join(f'{line}\n' for line in lines).encode())
+      return [replies.readline().decode().rstrip('\n') for _ in lines]
+
+  def test_recovery_after_kill(self) -> None:
+    with socket.socket() as probe:
+      probe.bind(('127.0.0.1', 0))
+      port = probe.getsockname()[1]
+    login = f'login {config.ROOT_USER} {config.ROOT_PASSWORD}'
+    server = self._start(port)
+    try:
+      replies = self._run(port, [login, 'create_db db', 'select_db db', *[f'put key:{index} value:{index}' for index in range(100)],
+                                 'multi', 'put a 1', 'incr a', 'exec', 'hset h f v', 'delete key:0'])
+      self.assertEqual(replies[-1], 'delete: ok')
+    finally:
+      server.send_signal(signal.SIGKILL)
+      server.wait()
+    server = self._start(port)
+    try:
+      replies = self._run(port, [login, 'select_db db', 'get key:0', 'get key:99', 'get a', 'hget h f'])
+    finally:
+      server.send_signal(signal.SIGKILL)
+      server.wait()
+    self.assertEqual(replies[1], 'select_db: ok')
+    self.assertNotEqual(replies[2], 'value:0')
+    self.assertEqual(replies[3:], ['value:99', '2', 'v'])
@@ -0,0 +1,52 @@
+from typing import List, Tuple
+from unittest import mock
+from config import ROOT_USER
+from model.custom_time import custom_time
+from model.database import ExpireAtEpoch, Key, Value
+from model.eviction import EvictionPolicy
+from model.replication import Replay
+from model.route import Route
+from model.store import DatabaseName, Store, Username
+from tests.support import StateDirectoryTestCase
+
+
+class PropagatedDeletionsTest(StateDirectoryTestCase):
+  'The keys a leader deletes on its own reach the replicas as records, replicas never evict.'
+
+  def setUp(self) -> None:
+    super().setUp()
+    self.deletions: List[Tuple[DatabaseName, List[Key]]] = []
+    self.store = self.closing(Store())
+    self.store.propagate_deletions = lambda db_name, keys: self.deletions.append((db_name, keys))
+    self.store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName('db'))
+    self.database = self.store.database(DatabaseName('db'))
+
+  def tearDown(self) -> None:
+    custom_time.time = None
+    super().tearDown()
+
+  def test_expired_keys_are_propagated(self) -> None:
+    now = custom_time.time
+    self.database.put(key=Key('expiring'), value=Value('value'), expire_at=ExpireAtEpoch(now + 1))
+    self.database.put(key=Key('kept'), value=Value('value'))
+    custom_time.time = now + 2
+    self.assertTrue(self.store.delete_expired_keys_from_dbs())
+    self.assertEqual(self.deletions, [('db', ['expiring'])])
+
+  def test_evicted_keys_are_propagated(self) -> None:
+    for index in range(100):
+      self.database.put(key=Key(f'key:{index}'), value=Value('value' * 10))
+    self.store._maxmemory_bytes = self.database.used_memory // 2
+    with mock.patch('model.database.EVICTION_POLICY', EvictionPolicy.allkeys_random):
+      self.store.make_room(db_name=DatabaseName('db'), database=self.database)
+    evicted = [key for _, keys in self.deletions for key in keys]
+    self.assertGreater(len(evicted), 0)
+    self.assertEqual(len(self.database) + len(evicted), 100)
+    replica = self.closing(Store(dbs_filename='replica_dbs'))
+    replica.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName('db'))
+    replay = Replay(store=replica)
+    for index in range(100):
+      replay.apply(exec_time=0, command=[Route.put.value, 'db', f'key:{index}', 'value' * 10])
+    for db_name, keys in self.deletions:
+      replay.apply(exec_time=0, command=[Route.mdelete.value, db_name, *keys])
+    self.assertEqual(sorted(replica.database(DatabaseName('db'))._dictionary), sorted(self.database._dictionary))
@@ -0,0 +1,57 @@
+import asyncio
+from typing import Awaitable, Union
+from config import ROOT_USER
+from model.context import Context
+from model.exception import InternalError, InvalidCredentialsError
+from model.router import Router
+from model.store import Store, Username
+from model.validator import parse_line
+from tests.support import StateDirectoryTestCase
+
+
+def _result(result: Union[bool, Awaitable[bool]]) -> bool:
+  if isinstance(result, bool):
+    return result
+
+  async def wait() -> bool:
+    return await result
+  return asyncio.run(wait())
+
+
+class UndecodableParamsTest(StateDirectoryTestCase):
+  'Params that are not utf-8 are decoded with surrogates, which have to survive being encoded again.'
+
+  def setUp(self) -> None:
+    super().setUp()
+    self.store = self.closing(Store())
+    self.router = Router(store=self.store)
+    self.ctx = Context(store=self.store)
+
+  def test_login(self) -> None:
+    name, params = parse_line(f'login {ROOT_USER} \xff\xfe'.encode('latin-1'))
+    self.assertFalse(_result(self.router.execute(self.ctx, name, params)))
+    self.assertEqual(self.ctx.response, str(InvalidCredentialsError))
+
+  def test_register_and_login(self) -> None:
+    name, params = parse_line(b'register_user someone \xff\xfe')
+    self.assertTrue(_result(self.router.execute(self.ctx, name, params)), self.ctx.response)
+    name, params = parse_line(b'login someone \xff\xfe')
+    self.assertTrue(_result(self.router.execute(self.ctx, name, params)))
+    self.assertEqual(self.ctx.username, 'someone')
+
+
+class UnexpectedErrorTest(StateDirectoryTestCase):
+
+  def test_command_fails_with_an_error_reply(self) -> None:
+    'A bug in a command used to exit the server.'
+    store = self.closing(Store())
+    router = Router(store=store)
+    ctx = Context(store=store, username=Username(ROOT_USER))
+
+    def broken(ctx: Context) -> None:
+      raise KeyError('bug')
+    router._commands[b'whoami'].handler = broken
+    with self.assertLogs(level='ERROR'):
+      self.assertFalse(router.execute(ctx, b'whoami', ()))
+    self.assertEqual(ctx.response, str(InternalError))
+    self.assertTrue(router.execute(ctx, b'list_dbs', ()))
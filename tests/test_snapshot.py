@@ -0,0 +1,80 @@
+import pickle
+from config import ROOT_USER
+from model.compression import Codec
+from model.custom_time import custom_time
+from model.database import Database, ExpireAtEpoch, Key, Value
+from model.snapshot import read_database, write_database
+from model.store import DatabaseName, Store, Username
+from tests.support import StateDirectoryTestCase
+
+FILEPATH = 'section'
+
+
+def _database() -> Database:
+  'A database with a slot of every kind: strings, a compressed value, a flat hash, a hash table and keys with a ttl.'
+  database = Database()
+  database.set_compression(codec=Codec.zlib)
+  for index in range(1000):
+    database.put(key=Key(f'key:{index}'), value=Value(f'value:{index}'))
+  database.put(key=Key('kéy\udcff'), value=Value('välue'))
+  database.put(key=Key('compressed'), value=Value('compressible ' * 1000))
+  database.put(key=Key('expiring'), value=Value('value'), expire_at=ExpireAtEpoch(custom_time.time + 10))
+  database.hset(key=Key('flat'), items=[('field', 'value')])
+  database.hset(key=Key('table'), items=[(f'field:{index}', 'value') for index in range(1000)])
+  return database
+
+
+class SectionTest(StateDirectoryTestCase):
+
+  def tearDown(self) -> None:
+    custom_time.time = None
+    super().tearDown()
+
+  def _assert_same(self, database: Database) -> None:
+    self.assertEqual(len(database), 1005)
+    self.assertEqual(database.get(key=Key('key:999')), 'value:999')
+    self.assertEqual(database.get(key=Key('kéy\udcff')), 'välue')
+    self.assertEqual(database.get(key=Key('compressed')), 'compressible ' * 1000)
+    self.assertEqual(database.hgetall(key=Key('flat')), {'field': 'value'})
+    self.assertEqual(database.hgetall(key=Key('table')), {f'field:{index}': 'value' for index in range(1000)})
+    custom_time.time = custom_time.time + 20
+    database.delete_expired_keys()
+    self.assertEqual(len(database), 1004)
+
+  def test_round_trip(self) -> None:
+    with open(FILEPATH, 'wb') as file:
+      file.write(b'before')
+      write_database(file, _database())
+      length = file.tell() - len(b'before')
+    with open(FILEPATH, 'rb') as file:
+      self._assert_same(read_database(file, len(b'before'), length))
+
+  def test_pickled_database(self) -> None:
+    'Snapshots written before sections held every database pickled.'
+    with open(FILEPATH, 'wb') as file:
+      pickle.dump(_database(), file=file)
+      length = file.tell()
+    with open(FILEPATH, 'rb') as file:
+      self._assert_same(read_database(file, 0, length))
+
+
+class LazyLoadTest(StateDirectoryTestCase):
+
+  def test_databases_are_loaded_on_first_use(self) -> None:
+    store = self.closing(Store())
+    for name in ('first', 'second'):
+      store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName(name))
+      store.database(DatabaseName(name)).put(key=Key('key'), value=Value(name))
+    store.save_dbs_to_disk(generation=7)
+    loaded = self.closing(Store())
+    self.assertEqual(loaded.load_dbs_from_disk(), 7)
+    self.assertEqual(loaded.info()['databases_on_disk'], 2)
+    database = loaded.get_database_by_name(username=Username(ROOT_USER), db_name=DatabaseName('second'))
+    self.assertEqual(database.get(key=Key('key')), 'second')
+    self.assertEqual(loaded.info()['databases_on_disk'], 1)
+    loaded.spill_idle_databases(idle_s=0)
+    loaded.save_dbs_to_disk(generation=8)
+    reloaded = self.closing(Store())
+    self.assertEqual(reloaded.load_dbs_from_disk(), 8)
+    for name in ('first', 'second'):
+      self.assertEqual(reloaded.database(DatabaseName(name)).get(key=Key('key')), name)
@@ -0,0 +1,131 @@
+import time
+import asyncio
+from unittest import mock
+from config import ROOT_USER, SESSION_TOKEN_TTL_S, SESSION_TOKENS_PER_USER
+from model.context import Context
+from model.custom_time import custom_time
+from model.database import Key, Value
+from model.eviction import EvictionPolicy
+from model.store import DatabaseName, Store, Username
+from tests.support import StateDirectoryTestCase
+
+
+class SpillTest(StateDirectoryTestCase):
+
+  def setUp(self) -> None:
+    super().setUp()
+    self.store = self.closing(Store())
+    for name in ('selected', 'idle'):
+      self.store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName(name))
+      self.store.database(DatabaseName(name)).put(key=Key('key'), value=Value(name))
+
+  def _select(self, ctx: Context, name: str) -> None:
+    ctx.select(database_name=DatabaseName(name),
+               database=self.store.get_database_by_name(username=Username(ROOT_USER), db_name=DatabaseName(name)))
+
+  def test_selected_database_is_not_spilled(self) -> None:
+    ctx = Context(store=self.store, username=Username(ROOT_USER))
+    self._select(ctx, 'selected')
+    self.store.spill_idle_databases(idle_s=0)
+    self.assertEqual(self.store.info()['databases_on_disk'], 1)
+    self.assertIn('selected', self.store.info()['databases'])
+    ctx.select(database_name=DatabaseName(''), database=None)
+    self.store.spill_idle_databases(idle_s=0)
+    self.assertEqual(self.store.info()['databases_on_disk'], 2)
+    self._select(ctx, 'selected')
+    self.assertEqual(self.store.database(DatabaseName('selected')).get(key=Key('key')), 'selected')
+
+  def test_every_selection_is_released(self) -> None:
+    first = Context(store=self.store, username=Username(ROOT_USER))
+    second = Context(store=self.store, username=Username(ROOT_USER))
+    self._select(first, 'selected')
+    self._select(second, 'selected')
+    self._select(second, 'selected')
+    self._select(first, 'idle')
+    self.store.spill_idle_databases(idle_s=0)
+    self.assertEqual(self.store.info()['databases_on_disk'], 0)
+    second.select(database_name=DatabaseName(''), database=None)
+    self.store.spill_idle_databases(idle_s=0)
+    self.assertEqual(list(self.store.info()['databases']), ['idle'])
+
+  def test_dropped_database_is_released(self) -> None:
+    ctx = Context(store=self.store, username=Username(ROOT_USER))
+    self._select(ctx, 'selected')
+    self.store.drop_database(db_to_delete=DatabaseName('selected'))
+    self.store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName('selected'))
+    ctx.select(database_name=DatabaseName(''), database=None)
+    self._select(Context(store=self.store, username=Username(ROOT_USER)), 'selected')
+    self.store.spill_idle_databases(idle_s=0)
+    self.assertIn('selected', self.store.info()['databases'])
+
+
+class SessionTokenTest(StateDirectoryTestCase):
+
+  def setUp(self) -> None:
+    super().setUp()
+    self.store = self.closing(Store())
+
+  def tearDown(self) -> None:
+    custom_time.time = None
+    super().tearDown()
+
+  def test_oldest_tokens_are_revoked(self) -> None:
+    tokens = [self.store.issue_session_token(username=Username(ROOT_USER)) for _ in range(SESSION_TOKENS_PER_USER + 2)]
+    self.assertFalse(self.store.authenticate_session_token(username=Username(ROOT_USER), token=tokens[0]))
+    self.assertFalse(self.store.authenticate_session_token(username=Username(ROOT_USER), token=tokens[1]))
+    for token in tokens[2:]:
+      self.assertTrue(self.store.authenticate_session_token(username=Username(ROOT_USER), token=token))
+
+  def test_expired_tokens_are_pruned_on_login(self) -> None:
+    token = self.store.issue_session_token(username=Username(ROOT_USER))
+    custom_time.time = custom_time.time + SESSION_TOKEN_TTL_S + 1
+    self.assertFalse(self.store.authenticate_session_token(username=Username(ROOT_USER), token=token))
+    self.assertNotIn(ROOT_USER, self.store._session_tokens)
+
+  def test_undecodable_token(self) -> None:
+    self.store.issue_session_token(username=Username(ROOT_USER))
+    self.assertFalse(self.store.authenticate_session_token(username=Username(ROOT_USER), token='\udcff\udcfe'))
+
+
+class EvictionTest(StateDirectoryTestCase):
+
+  @mock.patch('model.database.EVICTION_POLICY', EvictionPolicy.allkeys_random)
+  def test_empty_databases_are_not_sampled(self) -> None:
+    'Keys are evicted from the few databases holding any, however many empty ones there are.'
+    store = self.closing(Store(maxmemory_bytes=64 * 1024))
+    for index in range(1000):
+      store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName(f'empty:{index}'))
+    for name in ('first', 'second'):
+      store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName(name))
+    for index in range(2000):
+      name = DatabaseName('first' if index % 2 == 0 else 'second')
+      database = store.database(name)
+      store.make_room(db_name=name, database=database)
+      database.put(key=Key(f'key:{index}'), value=Value('v' * 100))
+    self.assertLessEqual(store.info()['used_memory'], 64 * 1024 + 1024)
+    self.assertGreater(len(store.database(DatabaseName('first'))), 0)
+    self.assertGreater(len(store.database(DatabaseName('second'))), 0)
+    self.assertEqual(sorted(store._evictable), ['first', 'second'])
+
+
+class BackgroundSaveTest(StateDirectoryTestCase):
+
+  def test_stopped_while_waited_for(self) -> None:
+    'The shutdown kills a running background save, which used to be reaped by both of them.'
+    store = self.closing(Store())
+    store._write_snapshot = lambda generation: time.sleep(30)  # type: ignore
+
+    async def save() -> bool:
+      saving = asyncio.create_task(store.save_dbs_in_background(generation=1))
+      await asyncio.sleep(0.1)
+      store._stop_background_save()
+      return await saving
+    with self.assertLogs(level='ERROR'):
+      self.assertFalse(asyncio.run(save()))
+
+  def test_saved(self) -> None:
+    store = self.closing(Store())
+    store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName('db'))
+    self.assertTrue(asyncio.run(store.save_dbs_in_background(generation=1)))
+    store._stop_background_save()
+    self.assertEqual(self.closing(Store()).load_dbs_from_disk(), 1)
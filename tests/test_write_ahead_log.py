@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+import struct
+import zlib
+from config import ROOT_USER
+from constants import LEGACY_SEQUENTIAL_SAVE_FILENAME, SEQUENTIAL_SAVE_FILENAME
+from model.context import Context
+from model.database import Key
+from model.recovery import Recovery
+from model.router import Router
+from model.store import DatabaseName, Store, Username
+from model.write_ahead_log import LEGACY_PAYLOAD_HEADER, RECORD_HEADER, FsyncPolicy, WriteAheadLog, decode_payload, encode_record
+from tests.support import StateDirectoryTestCase
+
+# More args than the 16-bit count of the records written before it was widened could hold
+MANY_ARGS = 80_000
+
+
+def _write_ahead_log() -> WriteAheadLog:
+  return WriteAheadLog(filename_format=SEQUENTIAL_SAVE_FILENAME, fsync_policy=FsyncPolicy.always,
+                       group_commit_interval=0.01, group_commit_size=1024 * 1024)
+
+
+class RecordTest(StateDirectoryTestCase):
+
+  def test_round_trip(self) -> None:
+    command = ['put', 'db', 'key with spaces', 'välue\n\udcff', '']
+    record = encode_record(1234, command)
+    self.assertEqual(decode_payload(record[RECORD_HEADER.size:]), (1234, command))
+
+  def test_round_trip_of_many_args(self) -> None:
+    command = ['mput', 'db', *[f'arg:{index}' for index in range(MANY_ARGS)]]
+    record = encode_record(0, command)
+    self.assertEqual(decode_payload(record[RECORD_HEADER.size:]), (0, command))
+
+  def test_recovery_of_many_args(self) -> None:
+    store = self.closing(Store())
+    store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName('db'))
+    wal = _write_ahead_log()
+    wal.append(exec_time=0, command=['mput', 'db', *[f'key:{index // 2}' for index in range(MANY_ARGS)]])
+    wal.close()
+    store = self.closing(Store())
+    store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName('db'))
+    recovery = Recovery(store=store)
+    recovery.replay_segment(SEQUENTIAL_SAVE_FILENAME.format(1))
+    self.assertEqual(recovery.records, 1)
+    self.assertEqual(len(store.database(DatabaseName('db'))), MANY_ARGS // 2)
+
+  def test_recovery_of_legacy_segment(self) -> None:
+    'Segments without the magic were written with a 16-bit arg count.'
+    encoded_args = [arg.encode() for arg in ['put', 'db', 'key', 'value']]
+    payload = b''.join([LEGACY_PAYLOAD_HEADER.pack(0, len(encoded_args)),
+                        struct.pack(f'!{len(encoded_args)}I', *map(len, encoded_args)), *encoded_args])
+    with open(SEQUENTIAL_SAVE_FILENAME.format(1), 'wb') as file:
+      file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+    store = self.closing(Store())
+    store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName('db'))
+    Recovery(store=store).replay_segment(SEQUENTIAL_SAVE_FILENAME.format(1))
+    self.assertEqual(store.database(DatabaseName('db')).get(key=Key('key')), 'value')
+
+
+class WriterTest(StateDirectoryTestCase):
+
+  def test_idle_writer_sleeps(self) -> None:
+    'Once the log is committed the writer thread waits for the next append instead of every group commit interval.'
+    wal = _write_ahead_log()
+    wakeups = 0
+    due = wal._due
+
+    def counting_due() -> bool:
+      nonlocal wakeups
+      wakeups += 1
+      return due()
+    setattr(wal, '_due', counting_due)
+    wal.append(exec_time=0, command=['put', 'db', 'key', 'value'])
+    asyncio.run(wal.sync())
+    settled = wakeups
+    time.sleep(0.1)
+    self.assertEqual(wakeups, settled)
+    wal.append(exec_time=0, command=['put', 'db', 'key', 'other'])
+    asyncio.run(wal.sync())
+    wal.close()
+    store = self.closing(Store())
+    store.create_database(username=Username(ROOT_USER), new_db_name=DatabaseName('db'))
+    recovery = Recovery(store=store)
+    recovery.replay_segment(SEQUENTIAL_SAVE_FILENAME.format(1))
+    self.assertEqual(recovery.records, 2)
+
+
+class RouterTest(StateDirectoryTestCase):
+
+  def test_legacy_log_is_migrated(self) -> None:
+    'The text log of a crash before the upgrade becomes the first segment, its torn last line is dropped.'
+    with open(LEGACY_SEQUENTIAL_SAVE_FILENAME, 'w') as file:
+      file.write('0\tcreate_db db\n0\tput db key value\n0\tput db other value\n0\tdelete db other\n0\tput db torn')
+    for _ in range(2):
+      store = self.closing(Store())
+      router = Router(store=store)
+      router.load_sequential_save_file(generation=0)
+      database = store.get_database_by_name(username=Username(ROOT_USER), db_name=DatabaseName('db'))
+      self.assertEqual(database.get(key=Key('key')), 'value')
+      self.assertEqual(len(database), 1)
+      self.assertFalse(os.path.exists(LEGACY_SEQUENTIAL_SAVE_FILENAME))
+    router.delete_sequential_save_file()
+
+  def test_command_with_many_args_is_logged(self) -> None:
+    'A command past the 16-bit arg count used to be applied, then fail to be logged without a reply.'
+    store = self.closing(Store())
+    router = Router(store=store)
+    router.load_sequential_save_file(generation=0)
+    ctx = Context(store=store, username=Username(ROOT_USER))
+    self.assertTrue(router.execute(ctx, b'create_db', ('db',)))
+    self.assertTrue(router.execute(ctx, b'select_db', ('db',)))
+    params = tuple(f'key:{index // 2}' for index in range(MANY_ARGS))
+    self.assertTrue(router.execute(ctx, b'mput', params))
+    asyncio.run(router.sync())
+    recovered_store = self.closing(Store())
+    recovered = Router(store=recovered_store)
+    recovered.load_sequential_save_file(generation=0)
+    database = recovered_store.get_database_by_name(username=Username(ROOT_USER), db_name=DatabaseName('db'))
+    self.assertEqual(len(database), MANY_ARGS // 2)
+    router.delete_sequential_save_file()
+    recovered.delete_sequential_save_file()
+
+  def test_transaction_with_many_args_is_logged(self) -> None:
+    'The records of a transaction are logged flat in a single exec record, past the 16-bit arg count.'
+    store = self.closing(Store())
+    router = Router(store=store)
+    router.load_sequential_save_file(generation=0)
+    ctx = Context(store=store, username=Username(ROOT_USER))
+    self.assertTrue(router.execute(ctx, b'create_db', ('db',)))
+    self.assertTrue(router.execute(ctx, b'select_db', ('db',)))
+    self.assertTrue(router.execute(ctx, b'multi', ()))
+    for index in range(MANY_ARGS // 4):
+      self.assertTrue(router.execute(ctx, b'put', (f'key:{index}', 'value')))
+    self.assertTrue(router.execute(ctx, b'exec', ()))
+    asyncio.run(router.sync())
+    recovered_store = self.closing(Store())
+    recovered = Router(store=recovered_store)
+    recovered.load_sequential_save_file(generation=0)
+    database = recovered_store.get_database_by_name(username=Username(ROOT_USER), db_name=DatabaseName('db'))
+    self.assertEqual(len(database), MANY_ARGS // 4)
+    router.delete_sequential_save_file()
+    recovered.delete_sequential_save_file()